@@ -1,49 +1,273 @@
 from modules.EC2 import Ec2
 from modules.VPC import Vpc
 from modules.RDS import Rds
+from modules.CDN import Cdn
+from modules.ElastiCache import ElastiCache
+from base.deploy_cache import DeployCache, content_hash
+from base.template_diff import diff_templates, format_diff
+from base.stack_progress import StackProgress, SUCCESS_STATUSES
+from base.layers import TEMPLATE_SECTIONS, split_template, deploy_waves
+from base.fanout import deploy_in_parallel, format_report, DEFAULT_PARALLELISM
+from base.template_output import TEMPLATE_BODY_LIMIT, expand_shared_values, load_template, serialise_template, \
+    template_source
+from base.lazy_import import lazy_import
 from troposphere import Ref, Template
+from collections import OrderedDict
+from contextlib import contextmanager
 import datetime
-import boto3
-import botocore
+import functools
+import json
 
+# Only needed to deploy, not to build templates
+boto3 = lazy_import('boto3')
+botocore = lazy_import('botocore')
+
+# Outcomes returned by generate_stack()
+STACK_CREATED = 'created'
+STACK_UPDATED = 'updated'
+STACK_UNCHANGED = 'unchanged'
+STACK_FAILED = 'failed'
+# A layer not deployed because a layer it depends on failed
+STACK_SKIPPED = 'skipped'
+
+# Stack statuses after which a deploy can be skipped as unchanged
+DEPLOYED_STATUSES = ('CREATE_COMPLETE', 'UPDATE_COMPLETE', 'IMPORT_COMPLETE')
+
+# Adaptive retries back off client-side when CloudFormation throttles, which matters when many stacks deploy at once
+CLIENT_CONFIG = {
+    'retries': {'mode': 'adaptive', 'max_attempts': 10},
+    'max_pool_connections': 10,
+}
+
+
+def cloudformation_client(region, session=None):
+    """
+    Create a CloudFormation client for a region. boto3 sessions aren't thread safe, so each concurrent deployment
+    should use its own session (the default).
+
+    :param region: Region for the client
+    :param session: boto3 Session to create the client from (default: a new session for the region)
+    :return: CloudFormation client
+    """
+    session = session or boto3.session.Session(region_name=region)
+    return session.client('cloudformation', region_name=region, config=botocore.config.Config(**CLIENT_CONFIG))
+
+
+def stack_status(client, stack_name):
+    """
+    :param client: CloudFormation client
+    :param stack_name: Name of the stack
+    :return: The stack's status, or None if it doesn't exist
+    """
+    try:
+        return client.describe_stacks(StackName=stack_name)['Stacks'][0]['StackStatus']
+    except botocore.exceptions.ClientError as e:
+        if 'does not exist' in e.response['Error'].get('Message', ''):
+            return None
+        raise
+
+
+def deployed_template(client, stack_name):
+    """
+    :param client: CloudFormation client
+    :param stack_name: Name of the stack
+    :return: The template the stack was last deployed with, as a dict (with any values --compact shared put back in
+             place), or None if the stack doesn't exist
+    """
+    try:
+        body = client.get_template(StackName=stack_name, TemplateStage='Original')['TemplateBody']
+    except botocore.exceptions.ClientError as e:
+        if 'does not exist' in e.response['Error'].get('Message', ''):
+            return None
+        raise
+    # boto3 parses JSON templates, but returns YAML ones as a string
+    return expand_shared_values(load_template(body) if isinstance(body, str) else body)
+
+
+class BaseLayer(Ec2, Vpc, Rds, Cdn, ElastiCache):
+    # Stack outputs printed once a watched deploy completes
+    watch_outputs = ()
 
-class BaseLayer(Ec2, Vpc, Rds):
     def __init__(self, **kwargs):
         self.template = Template()
         self.ref_stack_id = Ref('AWS::StackId')
         self.ref_region = Ref('AWS::Region')
         self.ref_stack_name = Ref('AWS::StackName')
         self.args_dict = kwargs
+        self.deploy_cache = DeployCache(kwargs.get('deploy_cache_dir'))
+        # How templates are sent to CloudFormation (see template_arguments)
+        self.template_format = kwargs.get('template_format', 'json')
+        self.compact_template = kwargs.get('compact_template', False)
+        self.template_store = kwargs.get('template_store')
+        # Layer name -> {section: names} of what was added to the template inside each layer() block
+        self.layers = OrderedDict()
+
+    def template_members(self):
+        return dict((section, set(getattr(self.template, section))) for section in TEMPLATE_SECTIONS)
 
-    def generate_stack(self, stack_name, region, parameters=[]):
+    @contextmanager
+    def layer(self, name):
+        """
+        Assign everything added to the template inside the block to a layer, for generate_layers. A layer can be
+        entered more than once.
 
+        :param name: Layer name, eg. 'network'
+        """
+        before = self.template_members()
+        yield
+        members = self.layers.setdefault(name, dict((section, set()) for section in TEMPLATE_SECTIONS))
+        for section, names in self.template_members().items():
+            members[section].update(names - before[section])
+
+    def watch_stack(self, progress, stack_name, region):
+        """
+        Stream a stack's events until it finishes. A failed deploy is dropped from the deploy cache so that the next
+        run retries it rather than skipping it as unchanged.
+
+        :param progress: StackProgress for the stack
+        :param stack_name: Name of the stack
+        :param region: Region of the stack
+        :return: True if the stack finished successfully
+        """
+        if progress.watch() in SUCCESS_STATUSES:
+            self.deploy_cache.confirm(stack_name, region)
+            return True
+        self.deploy_cache.invalidate(stack_name, region)
+        return False
+
+    def template_arguments(self, stack_name, region, template):
+        """
+        Serialise a template to send to CloudFormation - compacted if configured, or if it is too big to send inline
+        and there is no template store, and uploaded to the template store if it is still too big to send inline
+
+        :param stack_name: Name of the stack, for progress messages
+        :param region: Region of the stack, for progress messages
+        :param template: Template JSON
+        :return: {'TemplateBody': body} or {'TemplateURL': url}
+        """
+        body, compact = self.template_body(template)
+        if body is not template:
+            print("Stack: {} ({}) template {:,} bytes -> {:,} bytes ({}{})".format(
+                stack_name, region, len(template.encode('utf-8')), len(body.encode('utf-8')),
+                'compact ' if compact else '', self.template_format))
+        arguments = template_source(body, self.template_store, self.template_format)
+        if 'TemplateURL' in arguments:
+            print("Stack: {} ({}) template uploaded to {}".format(stack_name, region, arguments['TemplateURL']))
+        return arguments
+
+    def template_body(self, template):
+        """
+        :param template: Template JSON
+        :return: Tuple of the template as it is sent to CloudFormation - compacted if configured, or if it is too big
+                 to send inline and there is no template store - and whether it was compacted
+        """
+        compact = self.compact_template or (self.template_store is None and
+                                            len(template.encode('utf-8')) > TEMPLATE_BODY_LIMIT)
+        if compact or self.template_format != 'json':
+            return serialise_template(json.loads(template), self.template_format, compact=compact), compact
+        return template, compact
+
+    def oversized_templates(self, stack_name, layered=False):
+        """
+        Find the templates too big to send inline, for when there is no template store to upload them to
+
+        :param stack_name: Name of the stack (the base name of the layers' stacks, if layered)
+        :param layered: Check each layer's template rather than the whole template
+        :return: Dict of stack name -> template size in bytes, as sent, for those over TEMPLATE_BODY_LIMIT
+        """
         template = self.template.to_json()
-        client = boto3.client('cloudformation')
+        templates = {stack_name: template}
+        if layered:
+            templates = dict((layer['stack_name'], json.dumps(layer['template'], indent=4, sort_keys=True))
+                             for layer in split_template(json.loads(template), self.layers, stack_name).values())
+        sizes = dict((name, len(self.template_body(body)[0].encode('utf-8'))) for name, body in templates.items())
+        return dict((name, size) for name, size in sizes.items() if size > TEMPLATE_BODY_LIMIT)
+
+    def generate_stack(self, stack_name, region, parameters=[], force=False, session=None, watch=False,
+                       client=None, template_body=None):
+        """
+        Create the stack, or submit a change set if it already exists. If the template and parameters match what was
+        last deployed from this machine, and that deploy succeeded, nothing is sent to CloudFormation; otherwise a
+        local resource-level diff against that deploy is printed first. A deploy that wasn't watched to the end is
+        only known to have been submitted, so the next run looks up whether it succeeded before skipping it.
+
+        :param stack_name: Name of the stack
+        :param region: Region to deploy into
+        :param parameters: CloudFormation Parameters list
+        :param force: Deploy even if the template and parameters are unchanged
+        :param session: boto3 Session to deploy with (default: a new session for the region)
+        :param watch: Stream stack events until the create/update finishes, rather than returning once it has started
+        :param client: CloudFormation client to deploy with (default: one created from session)
+        :param template_body: Template JSON to deploy (default: the whole template)
+        :return: One of STACK_CREATED, STACK_UPDATED, STACK_UNCHANGED or STACK_FAILED
+        """
+        template = template_body or self.template.to_json()
+        cached = self.deploy_cache.load(stack_name, region)
+        if cached:
+            if cached['hash'] != content_hash(template, parameters):
+                print("Stack: {} ({}) changes since last deploy:\n{}".format(
+                    stack_name, region, format_diff(diff_templates(cached['template'], json.loads(template)))))
+            elif not force:
+                status = 'confirmed'
+                if not cached.get('confirmed'):
+                    # Submitted but not watched to the end - check it succeeded before skipping it
+                    client = client or cloudformation_client(region, session)
+                    try:
+                        status = stack_status(client, stack_name)
+                    except botocore.exceptions.ClientError as e:
+                        # eg. throttled or denied - say nothing about the stack either way
+                        print('Stack: {} ({}) unexpected error encountered: {}\n\n'.format(
+                            stack_name, region, e.response))
+                        return STACK_FAILED
+                if status == 'confirmed' or status in DEPLOYED_STATUSES:
+                    self.deploy_cache.confirm(stack_name, region)
+                    print("Stack: {} ({}) unchanged since last deploy - skipping".format(stack_name, region))
+                    return STACK_UNCHANGED
+                if status and status.endswith('_IN_PROGRESS'):
+                    print("Stack: {} ({}) last deploy still in progress ({}) - skipping".format(
+                        stack_name, region, status))
+                    return STACK_UNCHANGED
+                print("Stack: {} ({}) last deploy didn't succeed ({}) - retrying".format(
+                    stack_name, region, status or 'stack not found'))
+                self.deploy_cache.invalidate(stack_name, region)
+
+        try:
+            template_arguments = self.template_arguments(stack_name, region, template)
+        except ValueError as e:
+            print('Stack: {} ({}) cannot be deployed: {}'.format(stack_name, region, e))
+            return STACK_FAILED
+
+        client = client or cloudformation_client(region, session)
+        progress = StackProgress(client, stack_name, label='Stack: {} ({})'.format(stack_name, region),
+                                 output_keys=self.watch_outputs)
         try:
-            boto3.setup_default_session(region_name=region)
             client.create_stack(
                 StackName=stack_name,
-                TemplateBody=template,
                 Capabilities=[
                     'CAPABILITY_IAM',
                 ],
                 Parameters=parameters,
-                EnableTerminationProtection=False
+                EnableTerminationProtection=False,
+                **template_arguments
             )
-            print("Stack: {} creating...".format(stack_name))
+            self.deploy_cache.save(stack_name, region, template, parameters)
+            print("Stack: {} ({}) creating...".format(stack_name, region))
+            if watch and not self.watch_stack(progress, stack_name, region):
+                return STACK_FAILED
+            return STACK_CREATED
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == 'AlreadyExistsException':
-                print("Stack: {} already exists - submitting change set...".format(stack_name))
+                print("Stack: {} ({}) already exists - submitting change set...".format(stack_name, region))
                 change_set_name = 'changeset' + datetime.datetime.now().isoformat().replace(
                     "-", "").replace(".", "").replace(":", "")
                 client.create_change_set(
                     ChangeSetName=change_set_name,
                     StackName=stack_name,
-                    TemplateBody=template,
                     Capabilities=[
                         'CAPABILITY_IAM',
                     ],
-                    Parameters=parameters)
+                    Parameters=parameters,
+                    **template_arguments)
 
                 try:
                     client.get_waiter('change_set_create_complete').wait(ChangeSetName=change_set_name, StackName=stack_name)
@@ -53,12 +277,72 @@ class BaseLayer(Ec2, Vpc, Rds):
                 resp = client.describe_change_set(ChangeSetName=change_set_name, StackName=stack_name)
                 if "didn't contain changes" in resp.get('StatusReason', ''):
                     client.delete_change_set(ChangeSetName=change_set_name, StackName=stack_name)
-                    return
+                    self.deploy_cache.save(stack_name, region, template, parameters, confirmed=True)
+                    return STACK_UNCHANGED
 
+                if watch:
+                    progress.mark()
                 client.execute_change_set(
                     ChangeSetName=change_set_name,
                     StackName=stack_name,
                 )
+                self.deploy_cache.save(stack_name, region, template, parameters)
+                if watch and not self.watch_stack(progress, stack_name, region):
+                    return STACK_FAILED
+                return STACK_UPDATED
             else:
-                print('Unexpected error encountered: {}\n\n'.format(e.response))
+                print('Stack: {} ({}) unexpected error encountered: {}\n\n'.format(stack_name, region, e.response))
+                return STACK_FAILED
+
+    def generate_layers(self, stack_name, region, parameters=[], force=False, client=None,
+                        parallelism=DEFAULT_PARALLELISM):
+        """
+        Deploy each layer as its own stack, named '<stack_name>-<layer>'. Layers are joined by exports and imports,
+        and deployed in waves - layers whose dependencies have all finished deploy in parallel. Only layers whose
+        template changed since the last deploy from this machine are submitted (see generate_stack), and the layers
+        depending on a failed one are skipped.
 
+        :param stack_name: Base name of the stacks
+        :param region: Region to deploy into
+        :param parameters: CloudFormation Parameters list - each layer gets the ones its template declares
+        :param force: Deploy every layer even if unchanged
+        :param client: CloudFormation client to deploy with (default: a new client per layer, as clients created from
+                       a shared session aren't thread safe)
+        :param parallelism: Maximum number of layers deployed at once
+        :return: Ordered dict of layer -> one of STACK_CREATED, STACK_UPDATED, STACK_UNCHANGED, STACK_FAILED or
+                 STACK_SKIPPED
+        """
+        layers = split_template(json.loads(self.template.to_json()), self.layers, stack_name)
+        outcomes = OrderedDict()
+        results = []
+        for wave in deploy_waves(dict((name, layer['depends_on']) for name, layer in layers.items())):
+            names, deployments = [], []
+            for name in wave:
+                layer = layers[name]
+                failed = [dep for dep in layer['depends_on'] if outcomes[dep] in (STACK_FAILED, STACK_SKIPPED)]
+                if failed:
+                    print("Stack: {} ({}) skipped - depends on failed layer(s) {}".format(
+                        layer['stack_name'], region, ', '.join(failed)))
+                    outcomes[name] = STACK_SKIPPED
+                    continue
+                declared = layer['template'].get('Parameters', {})
+                names.append(name)
+                deployments.append(('{} ({})'.format(layer['stack_name'], region), functools.partial(
+                    self.generate_stack,
+                    stack_name=layer['stack_name'],
+                    region=region,
+                    parameters=[p for p in parameters if p['ParameterKey'] in declared],
+                    force=force,
+                    # A layer's exports only exist once its stack has finished, so always wait for it
+                    watch=True,
+                    client=client,
+                    template_body=json.dumps(layer['template'], indent=4, sort_keys=True)
+                )))
+            if not deployments:
+                continue
+            for name, result in zip(names, deploy_in_parallel(deployments, parallelism)):
+                outcomes[name] = result.status
+                results.append(result)
+        if results:
+            print(format_report(results))
+        return OrderedDict((name, outcomes[name]) for name in layers)
@@ -0,0 +1,101 @@
+"""
+Build many troposphere objects of one type in a single pass, for the mixins' bulk builders (add_subnets,
+add_security_groups_from_dicts, add_target_groups). troposphere type-checks every property as it is set, so a large
+fleet checks the same VPC, AZ or port over and over; here each distinct value is checked once per class and property.
+A whole table is checked before anything is added to the template, and troposphere's required-property checks still
+run once, when the template is serialised.
+"""
+from troposphere import AWSHelperFn
+import troposphere
+
+# Values that are checked once and then trusted for every row using them
+CACHEABLE_TYPES = (str, int, float, bool, type(None))
+
+
+def spec_rows(specs, columns, defaults=None, required=()):
+    """
+    Normalise a spec table - rows as dicts, or as tuples in column order - into dicts
+
+    :param specs: Iterable of rows
+    :param columns: Column names, in the order tuple rows give them
+    :param defaults: Values for columns a row leaves out
+    :param required: Columns every row must have, from the row itself or from defaults
+    :return: List of dicts
+    """
+    rows = []
+    for spec in specs:
+        if isinstance(spec, dict):
+            unknown = set(spec) - set(columns)
+            if unknown:
+                raise ValueError('Unknown column(s) {} - expected {}'.format(
+                    ', '.join(sorted(unknown)), ', '.join(columns)))
+            row = dict(defaults or {}, **spec)
+        else:
+            if len(spec) > len(columns):
+                raise ValueError('Row {} has more than the {} columns {}'.format(
+                    spec, len(columns), ', '.join(columns)))
+            row = dict(defaults or {}, **dict(zip(columns, spec)))
+        missing = [column for column in required if row.get(column) is None]
+        if missing:
+            raise ValueError('Row {} is missing {}'.format(row.get('name', spec), ', '.join(missing)))
+        rows.append(row)
+    return rows
+
+
+def build_objects(object_class, rows):
+    """
+    :param object_class: troposphere class, eg. troposphere.ec2.Subnet
+    :param rows: Iterable of (title, {property: value}) - title is None for property objects, and properties whose
+                 value is None are left unset
+    :return: List of objects, in the order of rows
+    """
+    prototype = object_class(None)
+    checked = {}
+    built = []
+    for title, properties in rows:
+        values = {}
+        for name, value in properties.items():
+            if value is None:
+                continue
+            if isinstance(value, AWSHelperFn):
+                # troposphere can't check these either
+                values[name] = value
+                continue
+            key = (name, type(value), value) if isinstance(value, CACHEABLE_TYPES) else None
+            if key is None or key not in checked:
+                # Checked as troposphere would, on a stand-in carrying the row's title for its error messages
+                prototype.title = title
+                setattr(prototype, name, value)
+                if key is None:
+                    values[name] = prototype.properties[name]
+                    continue
+                checked[key] = prototype.properties[name]
+            values[name] = checked[key]
+        item = object_class(title)
+        item.properties.update(values)
+        built.append(item)
+    return built
+
+
+def add_objects(template, resources=(), outputs=()):
+    """
+    Add resources and outputs to a template all at once. Nothing is added if any of them clashes with another or
+    with the template, or if they would take the template over troposphere's limits.
+
+    :param template: troposphere Template
+    :param resources: Resources to add, in order
+    :param outputs: Outputs to add, in order
+    """
+    for existing, added, limit, kind in ((template.resources, resources, troposphere.MAX_RESOURCES, 'resources'),
+                                         (template.outputs, outputs, troposphere.MAX_OUTPUTS, 'outputs')):
+        titles = set()
+        for item in added:
+            if item.title in existing or item.title in titles:
+                template.handle_duplicate_key(item.title)
+            titles.add(item.title)
+        if len(existing) + len(titles) > limit:
+            raise ValueError('Maximum number of {} {} reached'.format(kind, limit))
+    for resource in resources:
+        template.add_resource(resource)
+    for output in outputs:
+        template.add_output(output)
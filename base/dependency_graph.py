@@ -0,0 +1,278 @@
+"""
+Offline analysis of the dependency graph of a synthesised template: cycles, dangling references, the critical path
+that sets how long a stack takes to create, and explicit DependsOn edges that serialise creation.
+"""
+import re
+from base.layers import references
+
+# Rough seconds CloudFormation takes to create each resource type, once the resources it depends on exist
+RESOURCE_DURATIONS = {
+    'AWS::EC2::VPC': 15,
+    'AWS::EC2::Subnet': 10,
+    'AWS::EC2::RouteTable': 10,
+    'AWS::EC2::Route': 5,
+    'AWS::EC2::SubnetRouteTableAssociation': 5,
+    'AWS::EC2::InternetGateway': 15,
+    'AWS::EC2::VPCGatewayAttachment': 15,
+    'AWS::EC2::EIP': 5,
+    'AWS::EC2::EIPAssociation': 15,
+    'AWS::EC2::NatGateway': 120,
+    'AWS::EC2::SecurityGroup': 10,
+    'AWS::EC2::SecurityGroupIngress': 5,
+    'AWS::EC2::SecurityGroupEgress': 5,
+    'AWS::EC2::Instance': 60,
+    'AWS::EC2::LaunchTemplate': 5,
+    'AWS::EC2::PlacementGroup': 5,
+    'AWS::AutoScaling::LaunchConfiguration': 5,
+    'AWS::AutoScaling::AutoScalingGroup': 90,
+    'AWS::AutoScaling::ScalingPolicy': 5,
+    'AWS::AutoScaling::ScheduledAction': 5,
+    'AWS::CloudWatch::Alarm': 5,
+    'AWS::ElasticLoadBalancingV2::LoadBalancer': 180,
+    'AWS::ElasticLoadBalancingV2::TargetGroup': 10,
+    'AWS::ElasticLoadBalancingV2::Listener': 5,
+    'AWS::ElasticLoadBalancingV2::ListenerRule': 5,
+    'AWS::CloudFront::Distribution': 300,
+    'AWS::CloudFront::CachePolicy': 5,
+    'AWS::CloudFront::OriginRequestPolicy': 5,
+    'AWS::ElastiCache::SubnetGroup': 5,
+    'AWS::ElastiCache::ParameterGroup': 5,
+    'AWS::ElastiCache::ReplicationGroup': 600,
+    'AWS::RDS::DBSubnetGroup': 5,
+    'AWS::RDS::DBParameterGroup': 5,
+    'AWS::RDS::DBInstance': 600,
+    'AWS::RDS::DBProxy': 300,
+    'AWS::RDS::DBProxyTargetGroup': 60,
+    'AWS::IAM::Role': 15,
+}
+DEFAULT_DURATION = 30
+# Rough seconds from an instance launching to it running cfn-signal, for resources with a ResourceSignal
+SIGNAL_DURATION = 300
+
+# Explicit dependencies CloudFormation needs even though nothing is referenced - eg. a route to an internet gateway
+# fails if the gateway isn't attached to the VPC yet
+REQUIRED_DEPENDENCIES = {
+    ('AWS::EC2::Route', 'AWS::EC2::VPCGatewayAttachment'),
+    ('AWS::EC2::EIP', 'AWS::EC2::VPCGatewayAttachment'),
+    ('AWS::EC2::EIPAssociation', 'AWS::EC2::VPCGatewayAttachment'),
+    ('AWS::EC2::NatGateway', 'AWS::EC2::VPCGatewayAttachment'),
+    ('AWS::EC2::Instance', 'AWS::EC2::VPCGatewayAttachment'),
+    ('AWS::AutoScaling::AutoScalingGroup', 'AWS::EC2::VPCGatewayAttachment'),
+}
+
+ISO_DURATION = re.compile(r'^PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?$')
+
+
+def iso_duration_seconds(value):
+    """
+    :param value: ISO 8601 duration as used by ResourceSignal timeouts, eg. 'PT15M'
+    :return: Seconds, or None if value isn't of that form
+    """
+    match = ISO_DURATION.match(value) if isinstance(value, str) else None
+    if not match:
+        return None
+    hours, minutes, seconds = (int(group or 0) for group in match.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def resource_duration(resource, durations=RESOURCE_DURATIONS):
+    """
+    Estimate how long a resource takes to create, including waiting for any resource signals
+
+    :param resource: Resource, as a template dict
+    :param durations: Dict of resource type -> seconds
+    :return: Seconds
+    """
+    duration = durations.get(resource.get('Type'), DEFAULT_DURATION)
+    signal = resource.get('CreationPolicy', {}).get('ResourceSignal')
+    if signal:
+        timeout = iso_duration_seconds(signal.get('Timeout', 'PT5M'))
+        duration += min(SIGNAL_DURATION, timeout) if timeout is not None else SIGNAL_DURATION
+    return duration
+
+
+def explicit_dependencies(resource):
+    depends_on = resource.get('DependsOn', [])
+    return [depends_on] if isinstance(depends_on, str) else list(depends_on)
+
+
+class DependencyGraph(object):
+    def __init__(self, template, durations=RESOURCE_DURATIONS):
+        """
+        :param template: Synthesised template, as a dict
+        :param durations: Dict of resource type -> estimated seconds to create
+        """
+        self.resources = template.get('Resources', {})
+        self.parameters = template.get('Parameters', {})
+        self.durations = dict((name, resource_duration(resource, durations))
+                              for name, resource in self.resources.items())
+        # Resource -> resources it refers to, and -> resources it names in DependsOn
+        self.implicit = {}
+        self.explicit = {}
+        self.dangling = []
+        for name, resource in sorted(self.resources.items()):
+            found = references(dict((key, value) for key, value in resource.items() if key != 'DependsOn'))
+            self.implicit[name] = set()
+            for kind in ('Ref', 'GetAtt'):
+                for target in sorted(found[kind]):
+                    if target in self.resources:
+                        self.implicit[name].add(target)
+                    elif not (kind == 'Ref' and (target in self.parameters or target.startswith('AWS::'))):
+                        self.dangling.append((name, kind, target))
+            self.explicit[name] = set()
+            for target in explicit_dependencies(resource):
+                if target in self.resources:
+                    self.explicit[name].add(target)
+                else:
+                    self.dangling.append((name, 'DependsOn', target))
+
+    def dependencies(self, name, skip=None):
+        """
+        :param name: Resource name
+        :param skip: (resource, dependency) DependsOn edge to leave out, if any
+        :return: Names of the resources that must be created before name
+        """
+        return self.implicit[name] | set(dep for dep in self.explicit[name] if (name, dep) != skip)
+
+    def cycles(self):
+        """
+        :return: List of cycles, each a list of resource names in dependency order
+        """
+        found = []
+        state = {}
+        for start in sorted(self.resources):
+            if start in state:
+                continue
+            # Iterative depth-first search: 1 = on the current path, 2 = done
+            path = [start]
+            pending = [iter(sorted(self.dependencies(start)))]
+            state[start] = 1
+            while pending:
+                dep = next(pending[-1], None)
+                if dep is None:
+                    state[path.pop()] = 2
+                    pending.pop()
+                elif state.get(dep) == 1:
+                    found.append(path[path.index(dep):] + [dep])
+                elif dep not in state:
+                    state[dep] = 1
+                    path.append(dep)
+                    pending.append(iter(sorted(self.dependencies(dep))))
+        return found
+
+    def critical_path(self, skip=None):
+        """
+        Estimate when each resource finishes if everything is created as soon as its dependencies are
+
+        :param skip: (resource, dependency) DependsOn edge to leave out, if any
+        :return: Tuple of total seconds and the chain of resource names that takes that long
+        """
+        finish = {}
+        previous = {}
+
+        def finish_time(name):
+            if name not in finish:
+                # Only ever called on an acyclic graph - see analyze()
+                deps = sorted(self.dependencies(name, skip), key=lambda dep: (-finish_time(dep), dep))
+                previous[name] = deps[0] if deps else None
+                finish[name] = (finish_time(deps[0]) if deps else 0) + self.durations[name]
+            return finish[name]
+
+        if not self.resources:
+            return 0, []
+        last = sorted(self.resources, key=lambda name: (-finish_time(name), name))[0]
+        chain = []
+        while last is not None:
+            chain.append(last)
+            last = previous[last]
+        return finish[chain[0]], list(reversed(chain))
+
+    def implied(self, name, dep):
+        """
+        :return: Whether name would still wait for dep without its explicit DependsOn on it
+        """
+        seen = set()
+        pending = list(self.dependencies(name, skip=(name, dep)))
+        while pending:
+            current = pending.pop()
+            if current == dep:
+                return True
+            if current not in seen:
+                seen.add(current)
+                pending.extend(self.dependencies(current))
+        return False
+
+    def serialisation(self):
+        """
+        Classify every explicit DependsOn edge
+
+        :return: List of dicts with 'resource', 'depends_on', 'kind' (one of 'redundant' - already implied by
+                 references, 'required' - needed by CloudFormation, or 'review') and 'saving' - estimated seconds
+                 off the critical path if the edge were removed
+        """
+        total, _ = self.critical_path()
+        edges = []
+        for name in sorted(self.explicit):
+            for dep in sorted(self.explicit[name]):
+                if self.implied(name, dep):
+                    kind = 'redundant'
+                elif (self.resources[name].get('Type'), self.resources[dep].get('Type')) in REQUIRED_DEPENDENCIES:
+                    kind = 'required'
+                else:
+                    kind = 'review'
+                edges.append({
+                    'resource': name,
+                    'depends_on': dep,
+                    'kind': kind,
+                    'saving': total - self.critical_path(skip=(name, dep))[0],
+                })
+        return edges
+
+
+def analyze(template, durations=RESOURCE_DURATIONS):
+    """
+    Analyse a template's dependency graph
+
+    :param template: Synthesised template, as a dict
+    :param durations: Dict of resource type -> estimated seconds to create
+    :return: Dict with 'cycles', 'dangling', 'critical_path' ((seconds, chain), or None if there are cycles),
+             'durations' and 'serialisation'
+    """
+    graph = DependencyGraph(template, durations)
+    cycles = graph.cycles()
+    return {
+        'resources': len(graph.resources),
+        'cycles': cycles,
+        'dangling': graph.dangling,
+        'durations': graph.durations,
+        'critical_path': None if cycles else graph.critical_path(),
+        'serialisation': [] if cycles else graph.serialisation(),
+    }
+
+
+def format_analysis(analysis):
+    """
+    Render an analysis (see analyze)
+
+    :param analysis: Analysis dict
+    :return: Printable string
+    """
+    lines = ['{} resources'.format(analysis['resources'])]
+    for cycle in analysis['cycles']:
+        lines.append('Cycle: {}'.format(' -> '.join(cycle)))
+    for name, kind, target in analysis['dangling']:
+        lines.append('Dangling {} in {}: {}'.format(kind, name, target))
+    if analysis['critical_path']:
+        total, chain = analysis['critical_path']
+        lines.append('Critical path (~{}s to create):'.format(total))
+        elapsed = 0
+        for name in chain:
+            elapsed += analysis['durations'][name]
+            lines.append('  {:>6}s  {}'.format(elapsed, name))
+    for edge in analysis['serialisation']:
+        lines.append('DependsOn {} -> {}: {}{}'.format(
+            edge['resource'], edge['depends_on'], edge['kind'],
+            ' (~{}s off the critical path without it)'.format(edge['saving']) if edge['saving'] else ''))
+    if not analysis['cycles'] and not analysis['dangling']:
+        lines.append('No cycles or dangling references')
+    return '\n'.join(lines)
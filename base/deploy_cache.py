@@ -0,0 +1,96 @@
+"""
+Local cache of the last deployed template and parameters per stack and region, so unchanged deploys can be skipped
+without calling CloudFormation.
+"""
+import datetime
+import hashlib
+import json
+import os
+import re
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.simple_web_app', 'deploy_cache')
+
+
+def content_hash(template_body, parameters):
+    """
+    Hash a template and its parameters. The template is canonicalised first, so formatting doesn't matter.
+
+    :param template_body: Template JSON string
+    :param parameters: CloudFormation Parameters list
+    :return: Hex digest
+    """
+    canonical = json.dumps({
+        'template': json.loads(template_body),
+        'parameters': sorted((p.get('ParameterKey'), p.get('ParameterValue'), p.get('UsePreviousValue'))
+                             for p in parameters),
+    }, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class DeployCache(object):
+    def __init__(self, cache_dir=None):
+        """
+        :param cache_dir: Directory to keep the cache in (default: $SIMPLE_WEB_APP_CACHE_DIR or
+                          ~/.simple_web_app/deploy_cache)
+        """
+        self.cache_dir = cache_dir or os.environ.get('SIMPLE_WEB_APP_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+    def path(self, stack_name, region):
+        safe = lambda value: re.sub(r'[^A-Za-z0-9_.-]', '_', value)
+        return os.path.join(self.cache_dir, safe(region), '{}.json'.format(safe(stack_name)))
+
+    def load(self, stack_name, region):
+        """
+        :return: The cached record for a stack ({'hash', 'template', 'parameters', 'deployed_at', 'confirmed'}), or
+                 None
+        """
+        try:
+            with open(self.path(stack_name, region)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, stack_name, region, template_body, parameters, confirmed=False):
+        """
+        Record a template and parameters as deployed
+
+        :param stack_name: Stack name
+        :param region: Region
+        :param template_body: Template JSON string
+        :param parameters: CloudFormation Parameters list
+        :param confirmed: Whether the deploy is known to have finished successfully, rather than just submitted
+        """
+        self.write(stack_name, region, {
+            'hash': content_hash(template_body, parameters),
+            'template': json.loads(template_body),
+            'parameters': parameters,
+            'deployed_at': datetime.datetime.utcnow().isoformat() + 'Z',
+            'confirmed': confirmed,
+        })
+
+    def confirm(self, stack_name, region):
+        """
+        Record a stack's last deploy as having finished successfully
+        """
+        record = self.load(stack_name, region)
+        if record and not record.get('confirmed'):
+            record['confirmed'] = True
+            self.write(stack_name, region, record)
+
+    def write(self, stack_name, region, record):
+        path = self.path(stack_name, region)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # Write then rename, so an interrupted run never leaves a truncated record behind
+        with open(path + '.tmp', 'w') as f:
+            json.dump(record, f, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def invalidate(self, stack_name, region):
+        """
+        Forget a stack, so its next deploy is never skipped
+        """
+        try:
+            os.remove(self.path(stack_name, region))
+        except OSError:
+            pass
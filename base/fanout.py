@@ -0,0 +1,71 @@
+"""
+Run several deployments concurrently and aggregate their outcomes.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+import traceback
+
+DEFAULT_PARALLELISM = 8
+
+
+class DeploymentResult(object):
+    def __init__(self, label, status, elapsed, error=None):
+        """
+        Outcome of one deployment
+
+        :param label: What was deployed, eg. 'simple-web-app (eu-west-1)'
+        :param status: Status returned by the deployment, or 'failed' if it raised
+        :param elapsed: Seconds taken
+        :param error: Error message, if the deployment raised
+        """
+        self.label = label
+        self.status = status
+        self.elapsed = elapsed
+        self.error = error
+
+    @property
+    def succeeded(self):
+        return self.error is None and self.status != 'failed'
+
+
+def run_timed(label, deploy):
+    started = time.time()
+    try:
+        return DeploymentResult(label, deploy(), time.time() - started)
+    except Exception as e:
+        traceback.print_exc()
+        return DeploymentResult(label, 'failed', time.time() - started, error='{}: {}'.format(type(e).__name__, e))
+
+
+def deploy_in_parallel(deployments, parallelism=DEFAULT_PARALLELISM):
+    """
+    Run deployments concurrently on a thread pool. A failing deployment doesn't stop the others.
+
+    :param deployments: List of (label, callable) pairs; each callable deploys one target and returns its status
+    :param parallelism: Maximum number of concurrent deployments
+    :return: List of DeploymentResult, in the order the deployments were given
+    """
+    with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(deployments)))) as pool:
+        futures = dict((pool.submit(run_timed, label, deploy), idx) for idx, (label, deploy) in enumerate(deployments))
+        results = [None] * len(deployments)
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+def format_report(results):
+    """
+    Render an aggregated report of deployment results
+
+    :param results: List of DeploymentResult
+    :return: Printable string
+    """
+    width = max([len(result.label) for result in results] + [6])
+    lines = ['{:<{width}}  {:<10} {:>8}'.format('Target', 'Result', 'Time', width=width)]
+    for result in results:
+        lines.append('{:<{width}}  {:<10} {:>7.1f}s'.format(result.label, result.status, result.elapsed, width=width))
+        if result.error:
+            lines.append('{:<{width}}    {}'.format('', result.error, width=width))
+    failed = len([result for result in results if not result.succeeded])
+    lines.append('{} target(s): {} succeeded, {} failed'.format(len(results), len(results) - failed, failed))
+    return '\n'.join(lines)
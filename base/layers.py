@@ -0,0 +1,222 @@
+"""
+Split a synthesised template into one template per layer (eg. network, security, edge, compute), deployable as
+separate stacks. A reference to a resource in another layer becomes an Fn::ImportValue of an export from that layer's
+stack - reusing the exports the mixins already create where there is one, and adding an output otherwise.
+"""
+import json
+import re
+
+TEMPLATE_SECTIONS = ('resources', 'outputs', 'conditions', 'parameters', 'mappings')
+STACK_NAME_EXPORT = re.compile(r'^\$\{AWS::StackName\}-(\w+)$')
+SUB_REFERENCE = re.compile(r'\$\{([A-Za-z0-9]+)(?:\.[A-Za-z0-9.]+)?\}')
+
+
+def layer_stack_name(stack_name, layer):
+    """
+    :return: Name of the stack a layer of stack_name is deployed as, eg. 'simple-web-app-network'
+    """
+    return '{}-{}'.format(stack_name, layer)
+
+
+def canonical(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def references(node, found=None):
+    """
+    Collect the names a template fragment refers to
+
+    :param node: Template fragment
+    :return: Dict of 'Ref', 'GetAtt', 'Condition' and 'FindInMap' -> set of names
+    """
+    found = found if found is not None else dict((kind, set()) for kind in ('Ref', 'GetAtt', 'Condition', 'FindInMap'))
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == 'Ref' and isinstance(value, str):
+                found['Ref'].add(value)
+            elif key == 'Fn::GetAtt':
+                found['GetAtt'].add(value[0] if isinstance(value, list) else value.split('.', 1)[0])
+            elif key in ('Condition', 'Fn::If') and isinstance(value, (str, list)):
+                found['Condition'].add(value if isinstance(value, str) else value[0])
+            elif key == 'Fn::FindInMap':
+                found['FindInMap'].add(value[0])
+            elif key == 'Fn::Sub':
+                template = value if isinstance(value, str) else value[0]
+                found['Ref'].update(SUB_REFERENCE.findall(template))
+            references(value, found)
+    elif isinstance(node, list):
+        for item in node:
+            references(item, found)
+    return found
+
+
+class LayerSplitter(object):
+    def __init__(self, template, layers, stack_name):
+        """
+        :param template: Synthesised template, as a dict
+        :param layers: Ordered dict of layer name -> {section: set of names} (see BaseLayer.layer)
+        :param stack_name: Base stack name - each layer is deployed as layer_stack_name(stack_name, layer)
+        """
+        self.template = template
+        self.layers = layers
+        self.stack_name = stack_name
+        self.owner = {}
+        for layer, members in layers.items():
+            for name in members['resources']:
+                self.owner[name] = layer
+        unassigned = sorted(set(template.get('Resources', {})) - set(self.owner))
+        if unassigned:
+            raise ValueError('Resources not assigned to a layer: {}'.format(', '.join(unassigned)))
+        self.templates = dict((layer, self.empty_template()) for layer in layers)
+        self.depends_on = dict((layer, set()) for layer in layers)
+        # Layer -> canonical output value -> export suffix
+        self.exports = dict((layer, {}) for layer in layers)
+
+    def empty_template(self):
+        template = {'Resources': {}, 'Outputs': {}}
+        for key in ('AWSTemplateFormatVersion', 'Description'):
+            if key in self.template:
+                template[key] = self.template[key]
+        return template
+
+    def index_exports(self, layer):
+        """
+        Note the outputs of a layer that are already exported under '${AWS::StackName}-<suffix>'
+        """
+        for output in self.templates[layer]['Outputs'].values():
+            name = output.get('Export', {}).get('Name', {})
+            match = STACK_NAME_EXPORT.match(name.get('Fn::Sub', '')) if isinstance(name, dict) else None
+            if match:
+                self.exports[layer].setdefault(canonical(output['Value']), match.group(1))
+
+    def import_value(self, layer, value, name, attribute=None):
+        """
+        Import a value from the layer that owns resource name, exporting it from there first if need be
+        """
+        owner = self.owner[name]
+        self.depends_on[layer].add(owner)
+        suffix = self.exports[owner].get(canonical(value))
+        if suffix is None:
+            outputs = self.templates[owner]['Outputs']
+            suffix = name + (attribute or '').replace('.', '')
+            while suffix in outputs:
+                suffix += 'Export'
+            outputs[suffix] = {
+                'Value': value,
+                'Export': {'Name': {'Fn::Sub': '${AWS::StackName}-' + suffix}}
+            }
+            self.exports[owner][canonical(value)] = suffix
+        return {'Fn::ImportValue': '{}-{}'.format(layer_stack_name(self.stack_name, owner), suffix)}
+
+    def rewrite(self, layer, node):
+        """
+        Replace references to other layers' resources in a template fragment with imports
+        """
+        if isinstance(node, dict):
+            if len(node) == 1:
+                key, value = list(node.items())[0]
+                if key == 'Ref' and self.owner.get(value, layer) != layer:
+                    return self.import_value(layer, node, value)
+                if key == 'Fn::GetAtt':
+                    name, attribute = value if isinstance(value, list) else value.split('.', 1)
+                    if self.owner.get(name, layer) != layer:
+                        return self.import_value(layer, {'Fn::GetAtt': [name, attribute]}, name, attribute)
+                if key == 'Fn::Sub':
+                    template = value if isinstance(value, str) else value[0]
+                    foreign = [name for name in SUB_REFERENCE.findall(template)
+                               if self.owner.get(name, layer) != layer]
+                    if foreign:
+                        raise ValueError('Fn::Sub in layer {} refers to {} in another layer - use Ref/GetAtt'.format(
+                            layer, ', '.join(foreign)))
+            return dict((key, self.rewrite(layer, value)) for key, value in node.items())
+        if isinstance(node, list):
+            return [self.rewrite(layer, item) for item in node]
+        return node
+
+    def split(self):
+        """
+        :return: Dict of layer -> {'stack_name', 'template', 'depends_on'}, in the layers' order
+        """
+        for layer, members in self.layers.items():
+            for section, name in (('resources', 'Resources'), ('outputs', 'Outputs')):
+                for member in members[section]:
+                    self.templates[layer][name][member] = self.template[name][member]
+            self.index_exports(layer)
+
+        for layer in self.layers:
+            template = self.templates[layer]
+            for name, resource in list(template['Resources'].items()):
+                resource = self.rewrite(layer, resource)
+                # Layers are deployed in dependency order, so cross-layer DependsOn is both implied and invalid
+                depends_on = resource.get('DependsOn')
+                if depends_on is not None:
+                    depends_on = [dep for dep in ([depends_on] if isinstance(depends_on, str) else depends_on)
+                                  if self.owner.get(dep) == layer]
+                    if depends_on:
+                        resource['DependsOn'] = depends_on
+                    else:
+                        del resource['DependsOn']
+                template['Resources'][name] = resource
+            for name, output in list(template['Outputs'].items()):
+                template['Outputs'][name] = self.rewrite(layer, output)
+
+        for layer in self.layers:
+            self.add_referenced(self.templates[layer])
+
+        return dict((layer, {
+            'stack_name': layer_stack_name(self.stack_name, layer),
+            'template': self.templates[layer],
+            'depends_on': sorted(self.depends_on[layer] - {layer}),
+        }) for layer in self.layers)
+
+    def add_referenced(self, template):
+        """
+        Copy the conditions, parameters and mappings a layer uses from the full template
+        """
+        found = references([template['Resources'], template['Outputs']])
+        conditions = self.template.get('Conditions', {})
+        pending = [name for name in found['Condition'] if name in conditions]
+        while pending:
+            name = pending.pop()
+            if name not in template.setdefault('Conditions', {}):
+                template['Conditions'][name] = conditions[name]
+                nested = references(conditions[name])
+                pending.extend(dep for dep in nested['Condition'] if dep in conditions)
+                found['Ref'].update(nested['Ref'])
+        for section, kind in (('Parameters', 'Ref'), ('Mappings', 'FindInMap')):
+            for name in sorted(found[kind]):
+                if name in self.template.get(section, {}):
+                    template.setdefault(section, {})[name] = self.template[section][name]
+        if not template['Outputs']:
+            del template['Outputs']
+
+
+def split_template(template, layers, stack_name):
+    """
+    Split a template into one template per layer
+
+    :param template: Synthesised template, as a dict
+    :param layers: Ordered dict of layer name -> {section: set of names}
+    :param stack_name: Base stack name
+    :return: Dict of layer -> {'stack_name', 'template', 'depends_on'}, in the layers' order
+    """
+    return LayerSplitter(template, layers, stack_name).split()
+
+
+def deploy_waves(depends_on):
+    """
+    Group layers into waves that can each be deployed in parallel once the waves before them have finished
+
+    :param depends_on: Dict of layer -> layers it depends on
+    :return: List of lists of layers
+    """
+    done = set()
+    waves = []
+    while len(done) < len(depends_on):
+        wave = sorted(layer for layer, deps in depends_on.items() if layer not in done and set(deps) <= done)
+        if not wave:
+            raise ValueError('Layers depend on each other in a cycle: {}'.format(
+                ', '.join(sorted(set(depends_on) - done))))
+        waves.append(wave)
+        done.update(wave)
+    return waves
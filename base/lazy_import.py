@@ -0,0 +1,39 @@
+"""
+Modules imported on first use, so that rendering a template doesn't pay for importing the AWS SDK or troposphere
+submodules it never touches.
+"""
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    def __init__(self, name):
+        """
+        Stand-in for a module that imports it the first time one of its attributes is read
+
+        :param name: Full module name, eg. 'troposphere.ec2'
+        """
+        super(LazyModule, self).__init__(name)
+
+    def __getattr__(self, attr):
+        # Only called for attributes not already copied across, ie. until the module has been imported
+        module = importlib.import_module(self.__name__)
+        try:
+            value = getattr(module, attr)
+        except AttributeError:
+            # A submodule its package doesn't import itself, eg. botocore.exceptions
+            try:
+                value = importlib.import_module('{}.{}'.format(self.__name__, attr))
+            except ImportError:
+                raise AttributeError("module '{}' has no attribute '{}'".format(self.__name__, attr))
+        setattr(self, attr, value)
+        return value
+
+
+def lazy_import(name):
+    """
+    :param name: Full module name, eg. 'troposphere.ec2'
+    :return: The module if it has already been imported, otherwise a LazyModule for it
+    """
+    module = importlib.sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
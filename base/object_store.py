@@ -0,0 +1,81 @@
+"""
+Content-addressed object stores for build artifacts that instances download at boot. Keys embed a content hash, so
+an object that already exists never needs uploading again.
+"""
+from base.lazy_import import lazy_import
+
+boto3 = lazy_import('boto3')
+botocore = lazy_import('botocore')
+
+
+class S3ObjectStore(object):
+    def __init__(self, bucket, prefix='simple-web-app', region='eu-west-1', session=None):
+        """
+        Objects in an S3 bucket. The bucket must be readable from the app servers, eg. with a bucket policy allowing
+        the VPC's NAT gateway address.
+
+        :param bucket: Bucket name
+        :param prefix: Key prefix
+        :param region: Region the bucket is in
+        :param session: boto3 Session to upload with (default: a new session for the region)
+        """
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.region = region
+        self.session = session or boto3.session.Session(region_name=region)
+        self.client = self.session.client('s3', region_name=region)
+
+    def key(self, name):
+        return '{}/{}'.format(self.prefix, name) if self.prefix else name
+
+    def url(self, name):
+        """
+        :param name: Object name
+        :return: URL instances fetch the object from
+        """
+        # The global endpoint works whichever region the deploying stack is in
+        return 'https://{}.s3.amazonaws.com/{}'.format(self.bucket, self.key(name))
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def put(self, name, path):
+        """
+        Upload a file, unless an object with that name already exists
+
+        :param name: Object name (should contain the content hash)
+        :param path: Local file to upload
+        :return: URL of the object
+        """
+        if not self.exists(name):
+            self.client.upload_file(path, self.bucket, self.key(name))
+        return self.url(name)
+
+
+def is_s3_url(url):
+    """
+    :param url: Location given on the command line
+    :return: Whether it is an s3://BUCKET[/PREFIX] URL
+    """
+    return url.startswith('s3://') and bool(url[len('s3://'):].partition('/')[0])
+
+
+def object_store_from_url(url, region='eu-west-1', session=None):
+    """
+    Create an object store from a location given on the command line
+
+    :param url: s3://BUCKET[/PREFIX]
+    :param region: Region of the bucket
+    :param session: boto3 Session for S3
+    :return: S3ObjectStore
+    """
+    if not is_s3_url(url):
+        raise ValueError('{} is not an s3://BUCKET[/PREFIX] URL'.format(url))
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    return S3ObjectStore(bucket, prefix=prefix or 'simple-web-app', region=region, session=session)
@@ -0,0 +1,147 @@
+"""
+Stream CloudFormation stack events to the CLI while a stack is being created or updated.
+"""
+import time
+
+STACK_RESOURCE_TYPE = 'AWS::CloudFormation::Stack'
+SUCCESS_STATUSES = ('CREATE_COMPLETE', 'UPDATE_COMPLETE', 'IMPORT_COMPLETE', 'DELETE_COMPLETE')
+FAILURE_STATUSES = ('CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED', 'UPDATE_ROLLBACK_COMPLETE',
+                    'UPDATE_ROLLBACK_FAILED', 'UPDATE_FAILED', 'DELETE_FAILED', 'IMPORT_ROLLBACK_COMPLETE',
+                    'IMPORT_ROLLBACK_FAILED')
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return '{}m{:02d}s'.format(minutes, seconds) if minutes else '{}s'.format(seconds)
+
+
+class StackProgress(object):
+    def __init__(self, client, stack_name, label=None, output_keys=(), min_interval=2.0, max_interval=20.0,
+                 backoff=1.5, clock=time.time, sleep=time.sleep, echo=print):
+        """
+        Tail a stack's events until it reaches a terminal state
+
+        :param client: CloudFormation client
+        :param stack_name: Stack to watch
+        :param label: Prefix for printed lines (default: the stack name)
+        :param output_keys: Stack outputs to print once the stack completes, eg. ['SimpleWebAppAlbDNS']
+        :param min_interval: Shortest polling interval, used while events are arriving
+        :param max_interval: Longest polling interval, backed off to while nothing is happening
+        :param backoff: Factor to grow the interval by after a quiet poll
+        :param clock: Time source
+        :param sleep: Sleep function
+        :param echo: Where to print progress lines
+        """
+        self.client = client
+        self.stack_name = stack_name
+        self.label = label or stack_name
+        self.output_keys = output_keys
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.echo = echo
+        self.last_event_id = None
+        self.resource_started = {}
+        self.interval = min_interval
+
+    def mark(self):
+        """
+        Move the cursor to the stack's most recent event, so that only events from now on are reported. Call this
+        before updating an existing stack.
+        """
+        try:
+            events = self.client.describe_stack_events(StackName=self.stack_name)['StackEvents']
+        except Exception:
+            # The stack doesn't exist yet, so there is nothing to skip
+            return
+        if events:
+            self.last_event_id = events[0]['EventId']
+
+    def poll(self):
+        """
+        Fetch events newer than the cursor. Events come back newest first, so paging stops as soon as the cursor is
+        reached - pages that were already seen are never fetched again.
+
+        :return: New events, oldest first
+        """
+        new_events = []
+        kwargs = {'StackName': self.stack_name}
+        while True:
+            page = self.client.describe_stack_events(**kwargs)
+            reached_cursor = False
+            for event in page['StackEvents']:
+                if event['EventId'] == self.last_event_id:
+                    reached_cursor = True
+                    break
+                new_events.append(event)
+            if reached_cursor or not page.get('NextToken'):
+                break
+            kwargs['NextToken'] = page['NextToken']
+        if new_events:
+            self.last_event_id = new_events[0]['EventId']
+        new_events.reverse()
+        return new_events
+
+    def report(self, event, started):
+        """
+        Print one event, with the time a resource took once it finishes
+
+        :param event: Stack event
+        :param started: When watching started
+        :return: The stack's status if this event is a terminal stack-level event, otherwise None
+        """
+        logical_id = event['LogicalResourceId']
+        status = event['ResourceStatus']
+        line = '{} [{:>6}] {} ({}) {}'.format(self.label, format_duration(self.clock() - started), logical_id,
+                                               event['ResourceType'], status)
+        if status.endswith('_IN_PROGRESS'):
+            self.resource_started.setdefault(logical_id, event['Timestamp'])
+        elif logical_id in self.resource_started:
+            took = event['Timestamp'] - self.resource_started.pop(logical_id)
+            line += ' after {}'.format(format_duration(took.total_seconds()))
+        if event.get('ResourceStatusReason') and (status.endswith('_FAILED') or 'ROLLBACK' in status):
+            line += ' - {}'.format(event['ResourceStatusReason'])
+        self.echo(line)
+
+        if event['ResourceType'] == STACK_RESOURCE_TYPE and logical_id == self.stack_name and \
+                status in SUCCESS_STATUSES + FAILURE_STATUSES:
+            return status
+        return None
+
+    def watch(self, timeout=None):
+        """
+        Print events as they arrive until the stack finishes, then print the requested outputs
+
+        :param timeout: Give up after this many seconds (default: wait indefinitely)
+        :return: Final stack status, or None on timeout
+        """
+        started = self.clock()
+        while timeout is None or self.clock() - started < timeout:
+            events = self.poll()
+            for event in events:
+                status = self.report(event, started)
+                if status:
+                    self.echo('{} finished with {} in {}'.format(self.label, status,
+                                                                format_duration(self.clock() - started)))
+                    if status in SUCCESS_STATUSES:
+                        self.print_outputs()
+                    return status
+            # Speed up while a burst of events is arriving, back off while it's quiet
+            if events:
+                self.interval = max(self.min_interval, self.interval / self.backoff ** 2)
+            else:
+                self.interval = min(self.max_interval, self.interval * self.backoff)
+            self.sleep(self.interval)
+        self.echo('{} still in progress after {} - stopped watching'.format(self.label, format_duration(timeout)))
+        return None
+
+    def print_outputs(self):
+        if not self.output_keys:
+            return
+        stack = self.client.describe_stacks(StackName=self.stack_name)['Stacks'][0]
+        outputs = dict((output['OutputKey'], output['OutputValue']) for output in stack.get('Outputs', []))
+        for key in self.output_keys:
+            if key in outputs:
+                self.echo('{} {}: {}'.format(self.label, key, outputs[key]))
@@ -0,0 +1,92 @@
+"""
+Local, resource-level structural diff between two CloudFormation templates.
+"""
+
+# Resource attributes that are compared alongside Properties
+RESOURCE_ATTRIBUTES = ('Type', 'Properties', 'Metadata', 'DependsOn', 'Condition', 'CreationPolicy', 'UpdatePolicy',
+                       'DeletionPolicy', 'UpdateReplacePolicy')
+
+
+def changed_paths(old, new, path=''):
+    """
+    List the paths at which two JSON-like values differ
+
+    :param old: Old value
+    :param new: New value
+    :param path: Path of the values so far
+    :return: List of paths, eg. ['Properties.SecurityGroupIngress[0].CidrIp']
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        paths = []
+        for key in sorted(set(old) | set(new)):
+            child = '{}.{}'.format(path, key) if path else key
+            if key not in old or key not in new:
+                paths.append(child)
+            else:
+                paths += changed_paths(old[key], new[key], child)
+        return paths
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        paths = []
+        for idx, (old_item, new_item) in enumerate(zip(old, new)):
+            paths += changed_paths(old_item, new_item, '{}[{}]'.format(path, idx))
+        return paths
+    return [] if old == new else [path]
+
+
+def diff_templates(old, new):
+    """
+    Diff two templates at the resource level
+
+    :param old: Old template, as a dict
+    :param new: New template, as a dict
+    :return: Dict with 'added', 'removed' and 'modified' resources, plus the other top-level sections that changed
+    """
+    old_resources = old.get('Resources', {})
+    new_resources = new.get('Resources', {})
+    diff = {
+        'added': dict((name, new_resources[name].get('Type')) for name in new_resources if name not in old_resources),
+        'removed': dict((name, old_resources[name].get('Type')) for name in old_resources
+                        if name not in new_resources),
+        'modified': {},
+        'sections': [],
+    }
+    for name in sorted(set(old_resources) & set(new_resources)):
+        paths = []
+        for attribute in RESOURCE_ATTRIBUTES:
+            paths += changed_paths(old_resources[name].get(attribute), new_resources[name].get(attribute), attribute)
+        if paths:
+            diff['modified'][name] = {'type': new_resources[name].get('Type'), 'paths': paths}
+    for section in sorted((set(old) | set(new)) - {'Resources'}):
+        if old.get(section) != new.get(section):
+            diff['sections'].append(section)
+    return diff
+
+
+def has_changes(diff):
+    return bool(diff['added'] or diff['removed'] or diff['modified'] or diff['sections'])
+
+
+def format_diff(diff, max_paths=5):
+    """
+    Render a diff for the CLI
+
+    :param diff: Diff from diff_templates()
+    :param max_paths: Maximum number of changed paths to list per resource
+    :return: Printable string
+    """
+    lines = []
+    for name in sorted(diff['added']):
+        lines.append('  + {} ({})'.format(name, diff['added'][name]))
+    for name in sorted(diff['removed']):
+        lines.append('  - {} ({})'.format(name, diff['removed'][name]))
+    for name in sorted(diff['modified']):
+        paths = diff['modified'][name]['paths']
+        listed = ', '.join(paths[:max_paths]) + (', ...' if len(paths) > max_paths else '')
+        lines.append('  ~ {} ({}): {}'.format(name, diff['modified'][name]['type'], listed))
+        if 'Type' in paths:
+            lines.append('      resource type changed - this will replace the resource')
+    if diff['sections']:
+        lines.append('  sections changed: {}'.format(', '.join(diff['sections'])))
+    if not lines:
+        lines.append('  no template changes (parameters differ)')
+    return '\n'.join(lines)
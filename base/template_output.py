@@ -0,0 +1,208 @@
+"""
+Serialise templates for CloudFormation: indented JSON as before, or a compact form (minified JSON or YAML, with
+repeated string values factored into a mapping). A template over the TemplateBody size limit is uploaded to an object
+store and passed to CloudFormation by URL instead.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+TEMPLATE_FORMATS = ('json', 'yaml')
+# Largest template CloudFormation accepts inline (TemplateBody), and from S3 (TemplateURL), in bytes
+TEMPLATE_BODY_LIMIT = 51200
+TEMPLATE_URL_LIMIT = 1024 * 1024
+SHARED_MAPPING = 'Shared'
+SHARED_KEY = 'Values'
+# CloudFormation allows at most 200 attributes per mapping
+MAX_SHARED_VALUES = 200
+# Intrinsic functions whose arguments may themselves be an Fn::FindInMap -> the (container, key) slots holding them
+FACTORABLE_ARGUMENTS = {
+    'Fn::Base64': lambda node, value: [(node, 'Fn::Base64')],
+    'Fn::Join': lambda node, value: [(value[1], index) for index in range(len(value[1]))]
+    if isinstance(value[1], list) else [],
+    'Fn::If': lambda node, value: [(value, 1), (value, 2)],
+}
+
+
+def find_in_map(key):
+    return {'Fn::FindInMap': [SHARED_MAPPING, SHARED_KEY, key]}
+
+
+def shared_key(value):
+    """
+    :return: Mapping key for a shared value - derived from the value, so keys stay the same from build to build
+    """
+    return 'V' + hashlib.sha256(value.encode('utf-8')).hexdigest()[:10]
+
+
+def slots(node):
+    """
+    :return: (container, key) of each value inside a template fragment that may be replaced by an Fn::FindInMap
+    """
+    if isinstance(node, list):
+        return [(node, index) for index in range(len(node))]
+    if not isinstance(node, dict):
+        return []
+    if len(node) == 1 and ('Ref' in node or list(node)[0].startswith('Fn::')):
+        name, value = list(node.items())[0]
+        return FACTORABLE_ARGUMENTS.get(name, lambda node, value: [])(node, value)
+    return [(node, key) for key in node]
+
+
+def factorable(template):
+    """
+    Yield (container, key) for every string value in the template that may be replaced by an Fn::FindInMap -
+    property values, cfn-init metadata and output values, but not resource types, names, references or other
+    intrinsic function arguments
+    """
+    pending = []
+    for resource in template.get('Resources', {}).values():
+        pending.extend(slots(resource.get('Properties')))
+        pending.extend(slots(resource.get('Metadata', {}).get('AWS::CloudFormation::Init')))
+    pending.extend((output, 'Value') for output in template.get('Outputs', {}).values())
+    while pending:
+        container, key = pending.pop()
+        if isinstance(container[key], str):
+            yield container, key
+        else:
+            pending.extend(slots(container[key]))
+
+
+def factor_repeated_values(template):
+    """
+    Move string values that appear more than once into a mapping, referring to them with Fn::FindInMap - eg. the
+    app server files inlined into both the blue and the green launch configuration. Only values for which this
+    saves space are moved.
+
+    :param template: Template, as a dict - left unchanged
+    :return: New template dict
+    """
+    template = json.loads(json.dumps(template))
+    if SHARED_MAPPING in template.get('Mappings', {}):
+        return template
+    locations = {}
+    for container, key in factorable(template):
+        locations.setdefault(container[key], []).append((container, key))
+
+    reference_size = len(json.dumps(find_in_map(shared_key('')), separators=(',', ':')))
+    savings = []
+    for value, found in locations.items():
+        size = len(json.dumps(value))
+        # Each use shrinks to a reference, and the value is written once more in the mapping
+        saving = len(found) * (size - reference_size) - (size + len(shared_key(value)) + 4)
+        if len(found) > 1 and saving > 0:
+            savings.append((saving, value))
+
+    shared = {}
+    for _, value in sorted(savings, reverse=True)[:MAX_SHARED_VALUES]:
+        key = shared_key(value)
+        shared[key] = value
+        for container, index in locations[value]:
+            container[index] = find_in_map(key)
+    if shared:
+        template.setdefault('Mappings', {})[SHARED_MAPPING] = {SHARED_KEY: shared}
+    return template
+
+
+def expand_shared_values(template):
+    """
+    Undo factor_repeated_values, putting each shared value back where it is referred to
+
+    :param template: Template, as a dict - left unchanged
+    :return: New template dict
+    """
+    template = json.loads(json.dumps(template))
+    shared = template.get('Mappings', {}).pop(SHARED_MAPPING, {}).get(SHARED_KEY)
+    if not template.get('Mappings'):
+        template.pop('Mappings', None)
+    if not shared:
+        return template
+    pending = [template]
+    while pending:
+        node = pending.pop()
+        for key, value in (node.items() if isinstance(node, dict) else enumerate(node)):
+            if isinstance(value, dict) and list(value) == ['Fn::FindInMap'] and \
+                    value['Fn::FindInMap'][:2] == [SHARED_MAPPING, SHARED_KEY]:
+                node[key] = shared[value['Fn::FindInMap'][2]]
+            elif isinstance(value, (dict, list)):
+                pending.append(value)
+    return template
+
+
+def serialise_template(template, template_format='json', compact=False):
+    """
+    :param template: Template, as a dict
+    :param template_format: 'json' or 'yaml'
+    :param compact: Minify, and factor repeated values into a mapping (see factor_repeated_values)
+    :return: Template body string
+    """
+    if template_format not in TEMPLATE_FORMATS:
+        raise ValueError('Unknown template format {} - expected one of {}'.format(
+            template_format, ', '.join(TEMPLATE_FORMATS)))
+    if compact:
+        template = factor_repeated_values(template)
+    if template_format == 'yaml':
+        # cfn_flip comes with troposphere
+        import cfn_flip
+        return cfn_flip.to_yaml(json.dumps(template, sort_keys=True), clean_up=False, long_form=False)
+    if compact:
+        return json.dumps(template, sort_keys=True, separators=(',', ':'))
+    return json.dumps(template, sort_keys=True, indent=4, separators=(',', ': '))
+
+
+def load_template(body):
+    """
+    :param body: Template body string, JSON or YAML
+    :return: Template, as a dict
+    """
+    try:
+        return json.loads(body)
+    except ValueError:
+        import cfn_flip
+        return json.loads(json.dumps(cfn_flip.load(body)[0]))
+
+
+def upload_template(store, body, template_format='json'):
+    """
+    Upload a template body to an object store, named by its content hash
+
+    :param store: Object store (see base.object_store)
+    :param body: Template body string
+    :param template_format: 'json' or 'yaml', for the object's extension
+    :return: URL of the template
+    """
+    data = body.encode('utf-8')
+    name = 'template-{}.{}'.format(hashlib.sha256(data).hexdigest(), template_format)
+    if store.exists(name):
+        return store.url(name)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return store.put(name, path)
+    finally:
+        shutil.rmtree(directory)
+
+
+def template_source(body, store=None, template_format='json'):
+    """
+    Pass a template inline if it fits, otherwise by URL from an object store
+
+    :param body: Template body string
+    :param store: Object store to upload templates over TEMPLATE_BODY_LIMIT to
+    :param template_format: 'json' or 'yaml'
+    :return: {'TemplateBody': body} or {'TemplateURL': url}, to pass to create_stack/create_change_set
+    """
+    size = len(body.encode('utf-8'))
+    if size <= TEMPLATE_BODY_LIMIT:
+        return {'TemplateBody': body}
+    if size > TEMPLATE_URL_LIMIT:
+        raise ValueError('Template is {:,} bytes - CloudFormation accepts at most {:,}'.format(
+            size, TEMPLATE_URL_LIMIT))
+    if store is None:
+        raise ValueError('Template is {:,} bytes, over the {:,} byte TemplateBody limit - it needs an object store to '
+                         'be uploaded to'.format(size, TEMPLATE_BODY_LIMIT))
+    return {'TemplateURL': upload_template(store, body, template_format)}
@@ -0,0 +1,142 @@
+"""
+Shift ALB traffic between blue and green target groups in stages, checking the new group's health at each stage and
+moving everything back at the first sign of trouble.
+"""
+from base.stack_progress import format_duration
+import time
+
+DEFAULT_STAGES = (10, 50, 100)
+
+
+class TrafficShifter(object):
+    def __init__(self, client, listener_arn, target_groups, stages=DEFAULT_STAGES, bake_seconds=60, poll_interval=10,
+                 check=None, clock=time.time, sleep=time.sleep, echo=print):
+        """
+        :param client: ELBv2 client
+        :param listener_arn: Listener whose default action forwards to both target groups
+        :param target_groups: Dict of colour -> target group ARN
+        :param stages: Percentages of traffic to send to the new colour, in order
+        :param bake_seconds: How long each stage must stay healthy before moving on
+        :param poll_interval: Seconds between health checks while baking
+        :param check: Optional extra health check, called with (colour, percentage) - return False to roll back
+        :param clock: Time source
+        :param sleep: Sleep function
+        :param echo: Where to print progress lines
+        """
+        self.client = client
+        self.listener_arn = listener_arn
+        self.target_groups = target_groups
+        self.stages = stages
+        self.bake_seconds = bake_seconds
+        self.poll_interval = poll_interval
+        self.check = check
+        self.clock = clock
+        self.sleep = sleep
+        self.echo = echo
+
+    @classmethod
+    def from_stack(cls, cloudformation, elbv2, stack_name, listener, target_groups, **kwargs):
+        """
+        Create a shifter for the listener and target groups of a deployed stack
+
+        :param cloudformation: CloudFormation client
+        :param elbv2: ELBv2 client
+        :param stack_name: Stack name
+        :param listener: Logical name of the listener
+        :param target_groups: Dict of colour -> logical name of its target group
+        :return: TrafficShifter
+        """
+        def physical_id(logical_id):
+            return cloudformation.describe_stack_resource(
+                StackName=stack_name, LogicalResourceId=logical_id)['StackResourceDetail']['PhysicalResourceId']
+        return cls(elbv2, physical_id(listener),
+                   dict((colour, physical_id(name)) for colour, name in target_groups.items()), **kwargs)
+
+    def set_weights(self, colour, percentage):
+        """
+        Send a percentage of traffic to one colour and the rest to the other(s)
+        """
+        others = [other for other in sorted(self.target_groups) if other != colour]
+        weights = [(self.target_groups[colour], percentage)] + \
+                  [(self.target_groups[other], 100 - percentage if idx == 0 else 0) for idx, other in enumerate(others)]
+        self.client.modify_listener(
+            ListenerArn=self.listener_arn,
+            DefaultActions=[{
+                'Type': 'forward',
+                'ForwardConfig': {
+                    'TargetGroups': [{'TargetGroupArn': arn, 'Weight': weight} for arn, weight in weights]
+                }
+            }]
+        )
+
+    def weights(self):
+        """
+        :return: Dict of colour -> weight the listener currently forwards to it with (0 for a colour it doesn't
+                 forward to)
+        """
+        listener = self.client.describe_listeners(ListenerArns=[self.listener_arn])['Listeners'][0]
+        colours = dict((arn, colour) for colour, arn in self.target_groups.items())
+        weights = dict((colour, 0) for colour in self.target_groups)
+        for action in listener['DefaultActions']:
+            if action['Type'] != 'forward':
+                continue
+            # A forward to a single target group may come without a ForwardConfig
+            target_groups = action.get('ForwardConfig', {}).get('TargetGroups') or \
+                [{'TargetGroupArn': action['TargetGroupArn'], 'Weight': 1}]
+            for target_group in target_groups:
+                if target_group['TargetGroupArn'] in colours:
+                    weights[colours[target_group['TargetGroupArn']]] += target_group.get('Weight', 1)
+        return weights
+
+    def healthy(self, colour):
+        """
+        :return: True if the colour's target group has targets and all of them are healthy
+        """
+        descriptions = self.client.describe_target_health(
+            TargetGroupArn=self.target_groups[colour])['TargetHealthDescriptions']
+        return bool(descriptions) and all(d['TargetHealth']['State'] == 'healthy' for d in descriptions)
+
+    def bake(self, colour, percentage):
+        """
+        Watch a stage for bake_seconds
+
+        :return: True if it stayed healthy throughout
+        """
+        deadline = self.clock() + self.bake_seconds
+        while True:
+            if not self.healthy(colour):
+                self.echo('{}: unhealthy targets at {}%'.format(colour, percentage))
+                return False
+            if self.check is not None and not self.check(colour, percentage):
+                self.echo('{}: health check failed at {}%'.format(colour, percentage))
+                return False
+            if self.clock() >= deadline:
+                return True
+            self.sleep(min(self.poll_interval, max(0, deadline - self.clock())))
+
+    def shift(self, colour, previous):
+        """
+        Move traffic to a colour stage by stage, rolling back to the previous colour if any stage fails
+
+        :param colour: Colour to shift traffic to
+        :param previous: Colour currently serving traffic
+        :return: True if all traffic ended up on the new colour
+        """
+        started = self.clock()
+        if not self.healthy(colour):
+            self.echo('{}: not all targets healthy - not shifting traffic'.format(colour))
+            return False
+        for percentage in self.stages:
+            self.set_weights(colour, percentage)
+            self.echo('{}: {}% of traffic after {}'.format(colour, percentage, format_duration(self.clock() - started)))
+            if not self.bake(colour, percentage):
+                self.rollback(previous)
+                return False
+        return True
+
+    def rollback(self, colour):
+        """
+        Send all traffic straight back to a colour
+        """
+        self.set_weights(colour, 100)
+        self.echo('{}: rolled back - 100% of traffic'.format(colour))
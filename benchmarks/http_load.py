@@ -0,0 +1,316 @@
+"""
+Local HTTP load test for the app server engines.
+
+Starts an engine from files/ on localhost, drives it with a fixed number of concurrent connections for a fixed
+duration, and reports requests/sec and latency percentiles. Results are written as JSON and can be compared against a
+stored baseline, failing (exit code 1) when throughput or tail latency regresses by more than a threshold.
+
+    python -m benchmarks.http_load --engine asyncio --connections 64 --duration 20 --baseline baseline.json
+"""
+from __future__ import print_function
+from multiprocessing import Pool
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+FILES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'files')
+
+# Command line for each engine; '{port}' and '{workers}' are filled in when the server is started
+ENGINES = {
+    'flask': [sys.executable, 'simple_web_app.py', '--host', '127.0.0.1', '--port', '{port}',
+              '--workers', '{workers}'],
+    'flask-dev': [sys.executable, 'simple_web_app.py', '--dev', '--host', '127.0.0.1', '--port', '{port}'],
+    'asyncio': [sys.executable, 'simple_web_app_async.py', '--host', '127.0.0.1', '--port', '{port}',
+                '--workers', '{workers}'],
+}
+STARTUP_TIMEOUT = 15
+PERCENTILES = (50, 90, 99)
+# Metrics compared against the baseline, and whether a higher value is better
+COMPARED_METRICS = (('rps', True), ('p50_ms', False), ('p99_ms', False))
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, process, timeout=STARTUP_TIMEOUT):
+    """
+    Wait for a server to start accepting connections
+
+    :param port: Port the server listens on
+    :param process: Server process, to bail out early if it dies
+    :param timeout: Seconds to wait
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError('Server exited during startup with code {}'.format(process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('Server did not start listening on port {} within {}s'.format(port, timeout))
+
+
+def start_server(command, port, workers, static_dir):
+    """
+    Start an app server engine in the background
+
+    :param command: Command line, with '{port}' and '{workers}' placeholders
+    :param port: Port to listen on
+    :param workers: Worker processes (0 = one per core)
+    :param static_dir: Static root to serve
+    :return: Popen of the server
+    """
+    env = dict(os.environ, SIMPLE_WEB_APP_STATIC=static_dir)
+    args = [arg.format(port=port, workers=workers) for arg in command]
+    process = subprocess.Popen(args, cwd=FILES_DIR, env=env, stdout=subprocess.DEVNULL)
+    wait_for_port(port, process)
+    return process
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=STARTUP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_connection(host, port, path, headers, keep_alive, deadline, result):
+    """
+    Issue requests back to back on one connection (or a fresh connection per request) until the deadline
+
+    :param result: Dict to accumulate latencies, status counts, bytes and errors into
+    """
+    conn = None
+    headers = dict(headers)
+    if not keep_alive:
+        headers['Connection'] = 'close'
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection(host, port, timeout=10)
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, socket.error):
+            result['errors'] += 1
+            if conn is not None:
+                conn.close()
+            conn = None
+            continue
+        result['latencies'].append(time.perf_counter() - start)
+        result['statuses'][response.status] = result['statuses'].get(response.status, 0) + 1
+        result['bytes'] += len(body)
+        if not keep_alive or response.will_close:
+            conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+
+
+def run_client(args):
+    """
+    One load generating process, driving several connections from threads
+    """
+    host, port, path, headers, keep_alive, connections, duration = args
+    deadline = time.time() + duration
+    results = [{'latencies': [], 'statuses': {}, 'bytes': 0, 'errors': 0} for _ in range(connections)]
+    threads = [threading.Thread(target=run_connection, args=(host, port, path, headers, keep_alive, deadline, result))
+               for result in results]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def generate_load(host, port, path='/', headers=None, keep_alive=True, connections=16, duration=10, processes=0):
+    """
+    Drive a server with concurrent connections and summarise the results
+
+    :param host: Server host
+    :param port: Server port
+    :param path: Path to request
+    :param headers: Extra request headers
+    :param keep_alive: Reuse connections between requests
+    :param connections: Total concurrent connections
+    :param duration: Seconds to run for
+    :param processes: Load generating processes (0 = one per core, capped at the connection count)
+    :return: Summary dict
+    """
+    processes = min(processes or os.cpu_count() or 1, connections)
+    shares = [connections // processes + (1 if i < connections % processes else 0) for i in range(processes)]
+    jobs = [(host, port, path, headers or {}, keep_alive, share, duration) for share in shares]
+
+    started = time.perf_counter()
+    with Pool(processes) as pool:
+        results = [result for client in pool.map(run_client, jobs) for result in client]
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for result in results for latency in result['latencies'])
+    statuses = {}
+    for result in results:
+        for status, count in result['statuses'].items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    summary = {
+        'requests': len(latencies),
+        'errors': sum(result['errors'] for result in results),
+        'statuses': statuses,
+        'bytes': sum(result['bytes'] for result in results),
+        'elapsed_s': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'max_ms': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+    for pct in PERCENTILES:
+        summary['p{}_ms'.format(pct)] = round(percentile(latencies, pct) * 1000, 3)
+    return summary
+
+
+def compare_to_baseline(result, baseline, threshold):
+    """
+    Compare a result against a baseline
+
+    :param result: Result dict from this run
+    :param baseline: Result dict from the baseline run
+    :param threshold: Allowed regression, in percent
+    :return: List of regression descriptions (empty if none)
+    """
+    regressions = []
+    for metric, higher_is_better in COMPARED_METRICS:
+        old, new = baseline['summary'].get(metric), result['summary'].get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / float(old) * 100
+        if (-change if higher_is_better else change) > threshold:
+            regressions.append('{}: {} -> {} ({:+.1f}%, threshold {}%)'.format(metric, old, new, change, threshold))
+    return regressions
+
+
+def print_summary(result):
+    config, summary = result['config'], result['summary']
+    print('{} - {} connections, {}s, keep-alive {}'.format(
+        config['engine'], config['connections'], config['duration'], 'on' if config['keep_alive'] else 'off'))
+    print('  requests: {}  errors: {}  statuses: {}'.format(summary['requests'], summary['errors'],
+                                                         summary['statuses']))
+    print('  rps: {}'.format(summary['rps']))
+    print('  latency ms: p50 {p50_ms}  p90 {p90_ms}  p99 {p99_ms}  max {max_ms}'.format(**summary))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test an app server engine on localhost')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='flask', help='Engine to start (default: flask)')
+    parser.add_argument('--command', help='Custom server command instead of --engine, run from files/, eg. '
+                                          '"python my_engine.py --port {port}"')
+    parser.add_argument('--url', help='Benchmark an already running server instead of starting one, '
+                                      'eg. http://127.0.0.1:8080/')
+    parser.add_argument('--workers', type=int, default=0, help='Server worker processes (default: one per core)')
+    parser.add_argument('--static', help='Static root to serve (default: a copy of files/index.html)')
+    parser.add_argument('--path', help="Path to request (default: --url's path, or /)")
+    parser.add_argument('--header', action='append', default=[], help='Extra request header, eg. '
+                                                                      '"Accept-Encoding: gzip"')
+    parser.add_argument('--connections', type=int, default=16, help='Concurrent connections (default: 16)')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run for (default: 10)')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Load generating processes (default: one per core)')
+    parser.add_argument('--no-keepalive', dest='keep_alive', action='store_false',
+                        help='Open a new connection for every request')
+    parser.add_argument('--output', default=os.path.join('benchmarks', 'results', 'http_load.json'),
+                        help='Where to write the JSON results')
+    parser.add_argument('--baseline', help='Baseline results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Allowed regression against the baseline, in percent (default: 10)')
+    args = parser.parse_args()
+
+    headers = dict((name.strip(), value.strip()) for name, _, value in
+                   (header.partition(':') for header in args.header))
+    engine = 'url' if args.url else ('custom' if args.command else args.engine)
+
+    process = None
+    static_dir = None
+    if args.url:
+        parsed = urllib.parse.urlsplit(args.url)
+        host, port, path = parsed.hostname, parsed.port or 80, args.path or parsed.path or '/'
+    else:
+        host, port, path = '127.0.0.1', free_port(), args.path or '/'
+        static_dir = args.static
+        if static_dir is None:
+            static_dir = tempfile.mkdtemp(prefix='http_load_static_')
+            shutil.copy(os.path.join(FILES_DIR, 'index.html'), static_dir)
+        command = args.command.split() if args.command else ENGINES[args.engine]
+        process = start_server(command, port, args.workers, os.path.abspath(static_dir))
+
+    try:
+        summary = generate_load(host, port, path, headers=headers, keep_alive=args.keep_alive,
+                                connections=args.connections, duration=args.duration, processes=args.processes)
+    finally:
+        if process is not None:
+            stop_server(process)
+        if static_dir and not args.static:
+            shutil.rmtree(static_dir, ignore_errors=True)
+
+    result = {
+        'config': {
+            'engine': engine,
+            'workers': args.workers,
+            'path': path,
+            'headers': headers,
+            'connections': args.connections,
+            'duration': args.duration,
+            'keep_alive': args.keep_alive,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'summary': summary,
+    }
+    print_summary(result)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != result['config']:
+            print('Warning: baseline was recorded with a different configuration')
+        regressions = compare_to_baseline(result, baseline, args.threshold)
+        if regressions:
+            print('Regressions against {}:'.format(args.baseline))
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+        print('No regressions against {} (threshold {}%)'.format(args.baseline, args.threshold))
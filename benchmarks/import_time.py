@@ -0,0 +1,157 @@
+"""
+Import time benchmark.
+
+Starts fresh interpreters that import driver, or render a template with driver.py --synth-only, and reports the wall
+time and the import time Python measures for them (-X importtime). Rendering a template must not import the AWS SDK,
+and a case that does fails the run. Results are written as JSON and can be compared against a stored baseline,
+failing (exit code 1) when a case slows down by more than a threshold.
+
+    python -m benchmarks.import_time --repeat 15 --baseline baseline.json
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Case name -> interpreter arguments
+CASES = (
+    ('startup', ['-c', 'pass']),
+    ('import-driver', ['-c', 'import driver']),
+    ('synth-only', ['driver.py', '--synth-only', os.devnull]),
+)
+# Modules only needed to deploy, which rendering a template must not import
+DEPLOY_ONLY_MODULES = ('boto3', 'botocore', 's3transfer')
+
+
+def run_once(arguments):
+    """
+    Run one fresh interpreter
+
+    :param arguments: Interpreter arguments
+    :return: Dict of 'wall_s', 'import_s' (total of the top-level imports' cumulative times) and 'modules' imported
+    """
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + arguments, cwd=ROOT_DIR,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.perf_counter() - started
+    if process.returncode:
+        raise RuntimeError('{} failed:\n{}'.format(' '.join(arguments), process.stderr))
+
+    import_us = 0
+    modules = set()
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name[1:].startswith(' '):
+            import_us += int(cumulative)
+        modules.add(name.strip())
+    return {'wall_s': wall, 'import_s': import_us / 1e6, 'modules': modules}
+
+
+def run_case(arguments, repeat):
+    """
+    Run a case several times and summarise it, comparing the fastest runs as the least affected by other load
+
+    :param arguments: Interpreter arguments
+    :param repeat: Number of runs
+    :return: Summary dict
+    """
+    runs = [run_once(arguments) for _ in range(repeat)]
+    summary = {
+        'modules': len(runs[0]['modules']),
+        'deploy_only_modules': sorted(module for module in runs[0]['modules']
+                                      if module.split('.')[0] in DEPLOY_ONLY_MODULES),
+    }
+    for metric in ('wall_s', 'import_s'):
+        values = [run[metric] for run in runs]
+        summary[metric.replace('_s', '_min_s')] = min(values)
+        summary[metric.replace('_s', '_median_s')] = statistics.median(values)
+    return summary
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    :param results: Case results from this run
+    :param baseline: Results JSON from the baseline run
+    :param threshold: Allowed regression, in percent
+    :return: List of regression descriptions (empty if none)
+    """
+    previous = dict((result['case'], result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        old = previous.get(result['case'])
+        if old is None:
+            continue
+        for metric in ('wall_min_s', 'import_min_s'):
+            if old.get(metric):
+                change = (result[metric] - old[metric]) / float(old[metric]) * 100
+                if change > threshold:
+                    regressions.append('{} {}: {:.4g} -> {:.4g} ({:+.1f}%)'.format(
+                        result['case'], metric, old[metric], result[metric], change))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark import time and synth-only startup')
+    parser.add_argument('--repeat', type=int, default=15, help='Runs per case (default: 15)')
+    parser.add_argument('--output', default=os.path.join('benchmarks', 'results', 'import_time.json'),
+                        help='Where to write the JSON results')
+    parser.add_argument('--baseline', help='Baseline results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help='Allowed regression against the baseline, in percent (default: 20)')
+    args = parser.parse_args()
+
+    results = []
+    for case, arguments in CASES:
+        summary = run_case(arguments, args.repeat)
+        summary['case'] = case
+        results.append(summary)
+        print('{:<14} wall {:7.1f}ms (median {:7.1f}ms)  imports {:7.1f}ms  {:>4} modules'.format(
+            case, summary['wall_min_s'] * 1000, summary['wall_median_s'] * 1000, summary['import_min_s'] * 1000,
+            summary['modules']))
+
+    output = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'repeat': args.repeat,
+        'results': results,
+    }
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.output))
+
+    failed = False
+    for result in results:
+        if result['case'] != 'startup' and result['deploy_only_modules']:
+            failed = True
+            print('{} imported deploy-only modules: {}'.format(result['case'], ', '.join(result['deploy_only_modules'])))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('environment') != output['environment']:
+            print('Warning: baseline was recorded in a different environment')
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        if regressions:
+            failed = True
+            print('Regressions against {}:'.format(args.baseline))
+            for regression in regressions:
+                print('  ' + regression)
+
+    sys.exit(1 if failed else 0)
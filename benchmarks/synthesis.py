@@ -0,0 +1,339 @@
+"""
+Template synthesis benchmark.
+
+Times and memory-profiles building a stack through the Ec2/Vpc/Rds mixins and serialising it with
+BaseLayer.template.to_json(), for the SimpleWebApp stack as it is today and for synthetic stacks scaled up through
+the same mixin methods, one resource per call and through the bulk builders. For each phase a growth exponent is fitted across the synthetic scales (1.0 = linear); a phase
+whose time or peak memory grows faster than linear beyond a tolerance is flagged, and the run fails.
+
+    python -m benchmarks.synthesis --scales 0.25 0.5 1 2 --repeat 7 --baseline baseline.json
+"""
+from __future__ import print_function
+from base.base_layer import BaseLayer
+from driver import SimpleWebApp
+from collections import OrderedDict
+from contextlib import contextmanager
+from troposphere import Ref
+import argparse
+import datetime
+import gc
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+import troposphere
+
+# Synthetic stack size at scale 1.0
+BASE_SIZES = {
+    'subnets': 50,
+    'security_groups': 200,
+    'target_groups': 100,
+}
+PHASES = ('build', 'to_json')
+# Synthetic case name -> whether it builds through the bulk builders
+SYNTHETIC_CASES = (('synthetic', False), ('synthetic-bulk', True))
+
+
+@contextmanager
+def unlimited_template():
+    """
+    Lift troposphere's resource/output limits for the duration of the benchmark. They mirror CloudFormation's
+    deploy-time quotas, which have no bearing on synthesis cost, and the larger scales exceed them.
+    """
+    limits = dict((name, getattr(troposphere, name)) for name in
+                  ('MAX_RESOURCES', 'MAX_OUTPUTS', 'MAX_PARAMETERS', 'MAX_MAPPINGS'))
+    for name in limits:
+        setattr(troposphere, name, sys.maxsize)
+    try:
+        yield
+    finally:
+        for name, value in limits.items():
+            setattr(troposphere, name, value)
+
+
+def synthetic_rules(idx):
+    """
+    :return: Rules for the idx'th synthetic SG, which also allows SSH from the SG before it
+    """
+    rules = {'ingress': {'tcp': {'80': ['10.0.0.0/8'], '443': ['10.0.0.0/8']}}, 'egress': {}}
+    if idx:
+        rules['ingress']['tcp']['22'] = [Ref('SG{}'.format(idx - 1))]
+    return rules
+
+
+class SyntheticStack(BaseLayer):
+    def __init__(self, subnets, security_groups, target_groups, bulk=False):
+        """
+        :param bulk: Build through the bulk builders (add_subnets, add_security_groups_from_dicts and
+                     add_target_groups) rather than one resource per call
+        """
+        super(SyntheticStack, self).__init__()
+        self.subnets = subnets
+        self.security_groups = security_groups
+        self.target_groups = target_groups
+        self.bulk = bulk
+
+    def build_stack(self):
+        self.add_vpc(name='SyntheticVPC')
+        self.routing_table(name='SyntheticRouting', vpc_name='SyntheticVPC')
+        if self.bulk:
+            self.build_in_bulk()
+            return
+
+        for idx in range(self.subnets):
+            self.add_subnet(
+                name='Subnet{}'.format(idx),
+                availability_zone='eu-west-1{}'.format('abc'[idx % 3]),
+                cidr_block='10.14.{}.0/24'.format(idx % 256),
+                routing_table_name='SyntheticRouting',
+                vpc_name='SyntheticVPC'
+            )
+
+        for idx in range(self.security_groups):
+            self.add_security_group_from_dict(
+                name='SG{}'.format(idx),
+                rules=synthetic_rules(idx),
+                vpc=Ref('SyntheticVPC')
+            )
+
+        for idx in range(self.target_groups):
+            self.elbv2_target_group(
+                name='TargetGroup{}'.format(idx),
+                protocol='HTTP',
+                port=80,
+                vpc_id=Ref('SyntheticVPC'),
+                health_check_details=self.elbv2_health_check_info(path='/healthz'),
+                matcher='200',
+                targets=[]
+            )
+
+    def build_in_bulk(self):
+        self.add_subnets(
+            [('Subnet{}'.format(idx), 'eu-west-1{}'.format('abc'[idx % 3]), '10.14.{}.0/24'.format(idx % 256))
+             for idx in range(self.subnets)],
+            routing_table_name='SyntheticRouting',
+            vpc_name='SyntheticVPC'
+        )
+
+        self.add_security_groups_from_dicts(
+            groups=OrderedDict(('SG{}'.format(idx), synthetic_rules(idx)) for idx in range(self.security_groups)),
+            vpc=Ref('SyntheticVPC')
+        )
+
+        self.add_target_groups(
+            [('TargetGroup{}'.format(idx),) for idx in range(self.target_groups)],
+            protocol='HTTP',
+            port=80,
+            vpc_id=Ref('SyntheticVPC'),
+            health_check_details=self.elbv2_health_check_info(path='/healthz'),
+            matcher='200',
+            targets=[]
+        )
+
+
+def make_cases(scales):
+    """
+    :param scales: Scale factors for the synthetic stack
+    :return: List of (case name, scale, factory) tuples
+    """
+    cases = [('simple-web-app', 1.0, SimpleWebApp)]
+    for case, bulk in SYNTHETIC_CASES:
+        for scale in scales:
+            sizes = dict((key, max(1, int(round(value * scale)))) for key, value in BASE_SIZES.items())
+            cases.append((case, scale, lambda sizes=sizes, bulk=bulk: SyntheticStack(bulk=bulk, **sizes)))
+    return cases
+
+
+def run_once(factory, trace_memory=False):
+    """
+    Build and serialise one stack
+
+    :param factory: Callable returning an unbuilt stack
+    :param trace_memory: Measure peak memory (slows the run down, so timings from it aren't used)
+    :return: Dict of measurements
+    """
+    # As with timeit, keep the collector out of the timed region so runs are comparable
+    gc.collect()
+    gc.disable()
+    if trace_memory:
+        tracemalloc.start()
+
+    try:
+        started = time.perf_counter()
+        stack = factory()
+        stack.build_stack()
+        built = time.perf_counter()
+        if trace_memory:
+            build_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+        body = stack.template.to_json()
+        finished = time.perf_counter()
+    finally:
+        gc.enable()
+
+    result = {
+        'resources': len(stack.template.resources),
+        'template_bytes': len(body),
+        'build_s': built - started,
+        'to_json_s': finished - built,
+    }
+    if trace_memory:
+        result['build_peak_bytes'] = build_peak
+        result['to_json_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def run_case(factory, repeat):
+    """
+    Run a case several times and summarise it. Growth and baseline comparisons use the fastest run, which (as with
+    timeit) is the least affected by other load on the machine and so the most comparable across runs.
+
+    :param factory: Callable returning an unbuilt stack
+    :param repeat: Number of timed runs
+    :return: Summary dict
+    """
+    runs = [run_once(factory) for _ in range(repeat)]
+    memory = run_once(factory, trace_memory=True)
+    summary = {
+        'resources': runs[0]['resources'],
+        'template_bytes': runs[0]['template_bytes'],
+    }
+    for phase in PHASES:
+        timings = [run['{}_s'.format(phase)] for run in runs]
+        summary['{}_median_s'.format(phase)] = statistics.median(timings)
+        summary['{}_min_s'.format(phase)] = min(timings)
+        summary['{}_stdev_s'.format(phase)] = statistics.stdev(timings) if len(timings) > 1 else 0.0
+        summary['{}_us_per_resource'.format(phase)] = summary['{}_min_s'.format(phase)] * 1e6 / summary['resources']
+        summary['{}_peak_bytes'.format(phase)] = memory['{}_peak_bytes'.format(phase)]
+    return summary
+
+
+def growth_exponents(results):
+    """
+    Growth exponent of each metric across the synthetic scales: the least-squares slope of log(metric) against
+    log(resources). Fitting across every scale is much less sensitive to a single noisy case than comparing pairs.
+
+    :param results: Case results
+    :return: Dict of metric (prefixed with the case, for cases other than 'synthetic') -> exponent (1.0 = linear)
+    """
+    exponents = {}
+    for case, _ in SYNTHETIC_CASES:
+        synthetic = [result for result in results if result['case'] == case]
+        if len(set(result['resources'] for result in synthetic)) < 2:
+            continue
+        for phase in PHASES:
+            for metric in ('{}_min_s'.format(phase), '{}_peak_bytes'.format(phase)):
+                points = [(math.log(result['resources']), math.log(result[metric]))
+                          for result in synthetic if result[metric] > 0]
+                mean_x = sum(x for x, _ in points) / len(points)
+                mean_y = sum(y for _, y in points) / len(points)
+                key = metric if case == 'synthetic' else '{} {}'.format(case, metric)
+                exponents[key] = (sum((x - mean_x) * (y - mean_y) for x, y in points) /
+                                  sum((x - mean_x) ** 2 for x, _ in points))
+    return exponents
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Compare best-of-N timings and peak memory per case against a baseline run
+
+    :param results: Case results from this run
+    :param baseline: Results JSON from the baseline run
+    :param threshold: Allowed regression, in percent
+    :return: List of regression descriptions (empty if none)
+    """
+    previous = dict(((result['case'], result['scale']), result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        old = previous.get((result['case'], result['scale']))
+        if old is None:
+            continue
+        for phase in PHASES:
+            for metric in ('{}_min_s'.format(phase), '{}_peak_bytes'.format(phase)):
+                if old.get(metric):
+                    change = (result[metric] - old[metric]) / float(old[metric]) * 100
+                    if change > threshold:
+                        regressions.append('{} x{} {}: {:.4g} -> {:.4g} ({:+.1f}%)'.format(
+                            result['case'], result['scale'], metric, old[metric], result[metric], change))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark template synthesis time and memory')
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.25, 0.5, 1, 2],
+                        help='Synthetic stack scale factors, relative to {} (default: 0.25 0.5 1 2)'.format(
+                            ', '.join('{} {}'.format(value, key) for key, value in sorted(BASE_SIZES.items()))))
+    parser.add_argument('--repeat', type=int, default=7, help='Timed runs per case (default: 7)')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Flag growth exponents above 1 + tolerance as superlinear (default: 0.2)')
+    parser.add_argument('--output', default=os.path.join('benchmarks', 'results', 'synthesis.json'),
+                        help='Where to write the JSON results')
+    parser.add_argument('--baseline', help='Baseline results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help='Allowed regression against the baseline, in percent (default: 20)')
+    args = parser.parse_args()
+
+    results = []
+    with unlimited_template():
+        for case, scale, factory in make_cases(sorted(args.scales)):
+            summary = run_case(factory, args.repeat)
+            summary.update({'case': case, 'scale': scale})
+            results.append(summary)
+            print('{:<15} x{:<5} {:>6} resources  build {:8.1f}ms ({:6.1f}us/res, peak {:6.1f}MiB)  '
+                  'to_json {:8.1f}ms ({:6.1f}us/res, peak {:6.1f}MiB)'.format(
+                      case, scale, summary['resources'],
+                      summary['build_min_s'] * 1000, summary['build_us_per_resource'],
+                      summary['build_peak_bytes'] / 1048576.0,
+                      summary['to_json_min_s'] * 1000, summary['to_json_us_per_resource'],
+                      summary['to_json_peak_bytes'] / 1048576.0))
+
+    exponents = growth_exponents(results)
+    for metric, exponent in sorted(exponents.items()):
+        print('{:<40} growth exponent {:.2f}'.format(metric, exponent))
+    superlinear = ['{}: growth exponent {:.2f}'.format(metric, exponent)
+                   for metric, exponent in sorted(exponents.items()) if exponent > 1 + args.tolerance]
+
+    output = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'troposphere': troposphere.__version__,
+        },
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'repeat': args.repeat,
+        'base_sizes': BASE_SIZES,
+        'results': results,
+        'growth_exponents': exponents,
+    }
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.output))
+
+    failed = False
+    if superlinear:
+        failed = True
+        print('Superlinear growth (tolerance {}):'.format(args.tolerance))
+        for line in superlinear:
+            print('  ' + line)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('environment') != output['environment']:
+            print('Warning: baseline was recorded in a different environment')
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        if regressions:
+            failed = True
+            print('Regressions against {}:'.format(args.baseline))
+            for regression in regressions:
+                print('  ' + regression)
+
+    sys.exit(1 if failed else 0)
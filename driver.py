@@ -1,7 +1,26 @@
-from troposphere import Ref, cloudformation, Base64, Join
-from base.base_layer import BaseLayer
-from metadata.instance_metadata import generate_app_server_metadata, generate_app_server_userdata
+from troposphere import Ref, GetAtt, Base64, Join
+from base.base_layer import BaseLayer, cloudformation_client, deployed_template, STACK_CREATED, STACK_UPDATED, \
+    STACK_UNCHANGED, STACK_FAILED, STACK_SKIPPED
+from base.dependency_graph import analyze, format_analysis
+from base.layers import layer_stack_name
+from base.fanout import deploy_in_parallel, format_report, DEFAULT_PARALLELISM
+from base.object_store import is_s3_url, object_store_from_url
+from base.template_output import TEMPLATE_BODY_LIMIT, TEMPLATE_FORMATS, serialise_template
+from base.traffic_shift import TrafficShifter, DEFAULT_STAGES
+from metadata.instance_metadata import generate_app_server_metadata, generate_app_server_userdata, APP_ENGINES, \
+    APP_RUNTIMES, app_server_files
+from metadata.asset_bundle import AssetBundle
+from metadata.runtime_bundle import RuntimeBundle
+from modules.EC2 import ELBV2_PROFILES
+from modules.CDN import ORIGIN_SHIELD_REGIONS
+from base.lazy_import import lazy_import
 import argparse
+import json
+import sys
+
+boto3 = lazy_import('boto3')
+botocore = lazy_import('botocore')
+cloudformation = lazy_import('troposphere.cloudformation')
 
 
 # Ingress can be tied down to a certain address if needed
@@ -9,17 +28,47 @@ default_allowed_ingress = ['0.0.0.0/0']
 default_keypair_name = 'simple-webapp-key-pair'
 default_stack_name = 'simple-web-app'
 default_region = 'eu-west-1'
+# AMIs are regional - deploying elsewhere needs an AMI from that region (see --target)
+default_image_ids = {'eu-west-1': 'ami-3548444c'}
+default_app_engine = 'flask'
+default_app_workers = 0
+default_app_backlog = 128
+default_app_max_requests = 10000
+default_app_runtime = 'install'
+default_asg_min_size = 1
+default_asg_max_size = 3
+default_asg_desired_size = 2
+default_app_instance_type = 't2.nano'
+default_deployment_strategy = 'rolling'
+DEPLOYMENT_STRATEGIES = ('rolling', 'replacing', 'blue-green')
+DEPLOYMENT_COLOURS = ('Blue', 'Green')
+# Rendered in place of bundle URLs when the bundles aren't built or published, eg. for --synth-only
+BUNDLE_PLACEHOLDER_URL = 'https://asset-store.invalid/{}.tar.gz'
+# App server endpoints that must never be served from a cache
+PROBE_PATHS = ('/healthz', '/readyz', '/metrics')
 
 
 class SimpleWebApp(BaseLayer):
+    watch_outputs = ('SimpleWebAppAlbDNS',)
+
     def __init__(self, stack_name='joe_testing', region='eu-west-1', allowed_ingress='0.0.0.0/0',
-                 keypair_name='simple-webapp-key-pair'):
-        super(SimpleWebApp, self).__init__()
+                 keypair_name='simple-webapp-key-pair', image_id=None, app_engine='flask', app_workers=0,
+                 app_backlog=128, app_max_requests=10000, app_dev_server=False, asset_store=None,
+                 app_runtime='install', asg_min_size=1, asg_max_size=3, asg_desired_size=2, scaling_cpu_target=None,
+                 scaling_request_target=None, scaling_cpu_steps=None, scaling_schedules=(), app_launch_template=False,
+                 app_instance_types=None, on_demand_base=0, on_demand_percentage=100, unlimited_credits=False,
+                 placement_strategy=None, az_count=None, deployment_strategy='rolling', batch_percent=None,
+                 deploy_colour='Green', lb_profile=None, cdn=False, cdn_price_class='PriceClass_100',
+                 cache_node_type=None, cache_replicas=0, layered=False, template_format='json', compact_template=False,
+                 template_store=None, live_template=None, live_weights=None, bundle_placeholders=False):
+        super(SimpleWebApp, self).__init__(template_format=template_format, compact_template=compact_template,
+                                           template_store=template_store)
         self.vpc_name = 'SystemVPC'
         self.region = region
-        self.region_public1 = 'eu-west-1a'
-        self.region_public2 = 'eu-west-1b'
-        self.region_private = 'eu-west-1b'
+        self.region_public1 = '{}a'.format(region)
+        self.region_public2 = '{}b'.format(region)
+        self.region_private = '{}b'.format(region)
+        self.image_id = image_id or default_image_ids[region]
         self.private_subnet_nat_gateway = 'NatGateway'
         self.stack_name = stack_name
         self.public_routing_table = 'PublicRouting'
@@ -27,7 +76,82 @@ class SimpleWebApp(BaseLayer):
         self.public_subnet2 = 'PublicSubnet2'
         self.private_routing_table = 'PrivateRouting'
         self.private_subnet = 'PrivateSubnet'
+        # Spread the network over this many AZs, with a private subnet and NAT gateway in each (None = the fixed
+        # two public subnets and one private subnet)
+        self.az_count = az_count
+        self.public_subnets = [self.public_subnet1, self.public_subnet2]
+        self.private_subnets = [self.private_subnet]
         self.keypair = keypair_name
+        if app_engine not in APP_ENGINES:
+            raise ValueError('Unknown app engine: {} (expected one of {})'.format(app_engine, ', '.join(APP_ENGINES)))
+        self.app_engine = app_engine
+        self.app_workers = app_workers
+        self.app_backlog = app_backlog
+        self.app_max_requests = app_max_requests
+        self.app_dev_server = app_dev_server
+        # Object store to ship app server files through as a bundle, rather than inlining them into the template
+        self.asset_store = asset_store
+        # Render placeholder URLs for the bundles an asset store would have had, without building or uploading them
+        self.bundle_placeholders = bundle_placeholders
+        if app_runtime not in APP_RUNTIMES:
+            raise ValueError('Unknown app runtime: {} (expected one of {})'.format(app_runtime, ', '.join(APP_RUNTIMES)))
+        if app_runtime == 'prebaked' and not (asset_store or bundle_placeholders):
+            raise ValueError('A prebaked app runtime needs an asset store to publish it to')
+        self.app_runtime = app_runtime
+        self.asg_min_size = asg_min_size
+        self.asg_max_size = asg_max_size
+        self.asg_desired_size = asg_desired_size
+        # Scaling policies - CPU % and requests per target per minute to track, (high, low) CPU % thresholds for step
+        # scaling, and (cron, min, max, desired) scheduled actions
+        self.scaling_cpu_target = scaling_cpu_target
+        self.scaling_request_target = scaling_request_target
+        self.scaling_cpu_steps = scaling_cpu_steps
+        self.scaling_schedules = scaling_schedules
+        # Instance types as (type, weight) tuples - several types, spot, unlimited credits or a placement strategy all
+        # need a launch template rather than a launch configuration
+        self.app_instance_types = app_instance_types or [(default_app_instance_type, 1)]
+        self.on_demand_base = on_demand_base
+        self.on_demand_percentage = on_demand_percentage
+        self.unlimited_credits = unlimited_credits
+        self.placement_strategy = placement_strategy
+        self.app_launch_template = app_launch_template or len(self.app_instance_types) > 1 or \
+            on_demand_percentage < 100 or unlimited_credits or bool(placement_strategy)
+        if unlimited_credits and not all(instance_type.startswith('t') for instance_type, _ in self.app_instance_types):
+            raise ValueError('Unlimited CPU credits only apply to T-family instance types')
+        if deployment_strategy not in DEPLOYMENT_STRATEGIES:
+            raise ValueError('Unknown deployment strategy: {} (expected one of {})'.format(
+                deployment_strategy, ', '.join(DEPLOYMENT_STRATEGIES)))
+        if deploy_colour not in DEPLOYMENT_COLOURS:
+            raise ValueError('Unknown colour: {} (expected one of {})'.format(deploy_colour,
+                                                                              ', '.join(DEPLOYMENT_COLOURS)))
+        # rolling - replace instances in place, batch_percent of the group at a time (default: one at a time)
+        # replacing - build a new group alongside the old one and swap once it has signalled
+        # blue-green - update deploy_colour's group, which takes no traffic until shifted to (see TrafficShifter)
+        self.deployment_strategy = deployment_strategy
+        self.batch_percent = batch_percent
+        self.deploy_colour = deploy_colour
+        # Template the stack (the compute layer, if layered) is deployed with, to keep the live colour as it is
+        self.live_template = live_template
+        # Dict of colour -> weight the deployed listener forwards with, so a deploy never moves traffic (None = no
+        # listener yet: deploy_colour starts with none of it)
+        self.live_weights = live_weights
+        if lb_profile and lb_profile not in ELBV2_PROFILES:
+            raise ValueError('Unknown load balancer profile: {} (expected one of {})'.format(
+                lb_profile, ', '.join(sorted(ELBV2_PROFILES))))
+        # Performance profile for the ALB and its target groups (None = AWS defaults)
+        self.lb_profile = ELBV2_PROFILES[lb_profile] if lb_profile else None
+        # Serve through a CloudFront distribution in front of the ALB
+        self.cdn = cdn
+        self.cdn_price_class = cdn_price_class
+        if cdn:
+            self.watch_outputs = self.watch_outputs + ('SimpleWebAppCdnDNS',)
+        # Redis cache tier for the app servers' cache-aside helper (None = no cache tier)
+        if cache_node_type and app_engine != 'flask':
+            raise ValueError('Only the flask engine uses the cache')
+        self.cache_node_type = cache_node_type
+        self.cache_replicas = cache_replicas
+        # Deploy as one stack per layer (see build_stack and BaseLayer.generate_layers) rather than a single stack
+        self.layered = layered
         # Cast ingress IP to list if not otherwise
         if isinstance(allowed_ingress, list):
             self.allowed_ingress = allowed_ingress
@@ -63,38 +187,40 @@ class SimpleWebApp(BaseLayer):
                 'egress': {}
             }
         }
+        if cache_node_type:
+            self.sgs['CacheSG'] = {
+                'ingress': {
+                    'tcp': {
+                        '6379': [Ref('AppSG')]
+                    }
+                },
+                'egress': {}
+            }
 
     def create_network(self):
         """
-        Creates a VPC, subnets (2 public, 1 private), route tables and gateways
+        Creates a VPC, subnets (2 public, 1 private - or a public and private subnet in each of az_count AZs), route
+        tables and gateways
         """
+        if self.az_count:
+            subnets = self.add_topology(
+                vpc_name=self.vpc_name,
+                az_count=self.az_count,
+                region=self.region
+            )
+            self.public_subnets = subnets['Public']
+            self.private_subnets = subnets['Private']
+            return
+
         self.add_vpc(
             name=self.vpc_name
         )
 
-        self.add_subnet(
-            name=self.public_subnet1,
-            availability_zone=self.region_public1,
-            cidr_block='10.14.1.0/24',
-            routing_table_name=self.public_routing_table,
-            vpc_name=self.vpc_name
-        )
-
-        self.add_subnet(
-            name=self.public_subnet2,
-            availability_zone=self.region_public2,
-            cidr_block='10.14.2.0/24',
-            routing_table_name=self.public_routing_table,
-            vpc_name=self.vpc_name
-        )
-
-        self.add_subnet(
-            name=self.private_subnet,
-            availability_zone=self.region_private,
-            cidr_block='10.14.3.0/24',
-            routing_table_name=self.private_routing_table,
-            vpc_name=self.vpc_name
-        )
+        self.add_subnets([
+            (self.public_subnet1, self.region_public1, '10.14.1.0/24', self.public_routing_table),
+            (self.public_subnet2, self.region_public2, '10.14.2.0/24', self.public_routing_table),
+            (self.private_subnet, self.region_private, '10.14.3.0/24', self.private_routing_table),
+        ], vpc_name=self.vpc_name)
 
         self.add_nat_gateway(
             name='NatGateway',
@@ -127,11 +253,9 @@ class SimpleWebApp(BaseLayer):
         """
         Create all necessary Security Groups
         """
-        for sg in self.sgs:
-            self.add_security_group_from_dict(
-                name=sg,
-                rules=self.sgs[sg],
-                vpc=Ref(self.vpc_name))
+        self.add_security_groups_from_dicts(
+            groups=self.sgs,
+            vpc=Ref(self.vpc_name))
 
     def add_bastion(self):
         """
@@ -139,7 +263,7 @@ class SimpleWebApp(BaseLayer):
         """
         network_interface = self.create_network_interface(
             assign_public_ip=True,
-            subnet=Ref(self.public_subnet1),
+            subnet=Ref(self.public_subnets[0]),
             security_groups=[Ref('BastionSG')],
             private_ip=False
         )
@@ -156,10 +280,10 @@ class SimpleWebApp(BaseLayer):
 
         self.add_ec2(
             name='BastionServer',
-            subnet=Ref(self.public_subnet1),
+            subnet=Ref(self.public_subnets[0]),
             security_groups=[Ref('BastionSG')],
             keypair=self.keypair,
-            image_id='ami-3548444c',
+            image_id=self.image_id,
             instance_type='t2.nano',
             userdata=Base64(Join('', ['#!/bin/bash\nshutdown'])),
             network_interfaces=[network_interface]
@@ -178,30 +302,46 @@ class SimpleWebApp(BaseLayer):
             })
         )
 
+    def app_colours(self):
+        """
+        :return: Suffixes of the app server groups - one per colour for blue/green deployments, otherwise just ''
+        """
+        return list(DEPLOYMENT_COLOURS) if self.deployment_strategy == 'blue-green' else ['']
+
     def add_load_balancer(self):
         """
-        Add an ALB, target group and listener
+        Add an ALB, target group (one per colour for blue/green) and listener
         """
         self.create_elbv2(
             name='SimpleWebAppAlb',
-            subnets=[Ref(self.public_subnet1), Ref(self.public_subnet2)],
+            subnets=[Ref(subnet) for subnet in self.public_subnets],
             security_groups=[Ref('LBSG')],
             lb_type="application",
             scheme="internet-facing",
             tags=[{'Key': 'Name', 'Value': 'SimpleWebAppAlb'}],
-            lb_attributes=None
+            lb_attributes=None,
+            profile=self.lb_profile
         )
 
-        self.elbv2_target_group(
-            name='SimpleWebAppTargetGroup',
+        self.add_target_groups(
+            [{'name': 'SimpleWebAppTargetGroup' + colour} for colour in self.app_colours()],
             protocol="HTTP",
             port=80,
             vpc_id=Ref(self.vpc_name),
-            health_check_details=self.elbv2_health_check_info(),
+            health_check_details=self.elbv2_health_check_info(path='/healthz'),
             matcher="200",
-            targets=[])
+            targets=[],
+            profile=self.lb_profile)
 
-        actions = [self.elbv2_listener_action(target_group_arn=Ref('SimpleWebAppTargetGroup'))]
+        if self.deployment_strategy == 'blue-green':
+            # The colour being deployed takes no traffic until it is shifted over (see TrafficShifter), and a deployed
+            # listener keeps whatever weights it was last shifted to
+            weights = self.live_weights or dict((colour, 0 if colour == self.deploy_colour else 100)
+                                                for colour in self.app_colours())
+            actions = [self.elbv2_weighted_forward_action(
+                [(Ref('SimpleWebAppTargetGroup' + colour), weights.get(colour, 0)) for colour in self.app_colours()])]
+        else:
+            actions = [self.elbv2_listener_action(target_group_arn=Ref('SimpleWebAppTargetGroup'))]
         self.elbv2_listener(
             name="SimpleWebAppListener",
             lb_arn=Ref('SimpleWebAppAlb'),
@@ -212,37 +352,385 @@ class SimpleWebApp(BaseLayer):
 
     def add_app_asg(self):
         """
-        Create an autoscaling group of app servers with associated launch configuration
+        Create an autoscaling group of app servers (one per colour for blue/green) with associated launch
+        configuration or template
         """
-        self.add_ec2_launch_configuration(
-            'AppServerLaunchConfig',
-            security_groups=[Ref('AppSG')],
-            keypair=self.keypair,
-            image_id='ami-3548444c',
-            instance_type='t2.nano',
-            userdata=generate_app_server_userdata(stack_name=self.stack_name,
-                                                  region=self.region),
-            metadata=self.create_server_metadata(generate_app_server_metadata())
+        files = app_server_files(self.app_engine, cache=bool(self.cache_node_type))
+        bundle_url = runtime = None
+        if self.bundle_placeholders:
+            bundle_url = BUNDLE_PLACEHOLDER_URL.format('app-assets')
+            if self.app_runtime == 'prebaked':
+                runtime = {'url': BUNDLE_PLACEHOLDER_URL.format('runtime'), 'sha256': '0' * 64, 'id': 'placeholder'}
+        elif self.asset_store:
+            bundle_url = AssetBundle(files=files).publish(self.asset_store)
+            if self.app_runtime == 'prebaked':
+                runtime = RuntimeBundle(self.app_engine).publish(self.asset_store)
+        metadata = self.create_server_metadata(generate_app_server_metadata(
+            engine=self.app_engine,
+            dev_server=self.app_dev_server,
+            workers=self.app_workers,
+            backlog=self.app_backlog,
+            max_requests=self.app_max_requests,
+            bundle_url=bundle_url,
+            # Outlast the ALB's idle timeout, so the ALB closes idle connections rather than the app server
+            keep_alive=self.lb_profile.idle_timeout + 5 if self.lb_profile else None,
+            cache_endpoint=(GetAtt('AppCache', 'PrimaryEndPoint.Address'),
+                            GetAtt('AppCache', 'PrimaryEndPoint.Port')) if self.cache_node_type else None))
+        if self.placement_strategy:
+            self.add_placement_group(
+                name='AppServerPlacementGroup',
+                strategy=self.placement_strategy
+            )
+        for colour in self.app_colours():
+            self.add_app_server_group(colour, metadata, runtime)
+        if self.deployment_strategy == 'blue-green':
+            self.pin_live_colour()
 
-        )
+    def add_app_server_group(self, colour, metadata, runtime):
+        """
+        Create one app server group with its launch configuration/template and scaling policies
 
+        :param colour: Suffix for the group's resource names ('' unless deploying blue/green)
+        :param metadata: cfn-init metadata for the instances
+        :param runtime: Prebaked runtime to install, if any
+        """
+        launch_resource = ('AppServerLaunchTemplate' if self.app_launch_template else 'AppServerLaunchConfig') + colour
+        userdata = generate_app_server_userdata(stack_name=self.ref_stack_name,
+                                                region=self.region,
+                                                engine=self.app_engine,
+                                                runtime=runtime,
+                                                resource=launch_resource,
+                                                signal_resource='AppServerASG' + colour)
+        if self.app_launch_template:
+            self.add_ec2_launch_template(
+                launch_resource,
+                security_groups=[Ref('AppSG')],
+                keypair=self.keypair,
+                image_id=self.image_id,
+                instance_type=self.app_instance_types[0][0],
+                userdata=userdata,
+                metadata=metadata,
+                cpu_credits='unlimited' if self.unlimited_credits else None,
+                placement_group='AppServerPlacementGroup' if self.placement_strategy else None,
+                detailed_monitoring=True
+            )
+        else:
+            self.add_ec2_launch_configuration(
+                launch_resource,
+                security_groups=[Ref('AppSG')],
+                keypair=self.keypair,
+                image_id=self.image_id,
+                instance_type=self.app_instance_types[0][0],
+                userdata=userdata,
+                metadata=metadata
+            )
+
+        dynamic_scaling = self.scaling_cpu_target or self.scaling_request_target or self.scaling_cpu_steps
         self.add_autoscaling_group(
-            name='AppServerASG',
-            launch_configuration_name='AppServerLaunchConfig',
-            subnets=[Ref(self.private_subnet)],
-            desired_size=2,
-            min_size=1,
-            max_size=3,
+            name='AppServerASG' + colour,
+            launch_configuration_name=None if self.app_launch_template else launch_resource,
+            subnets=[Ref(subnet) for subnet in self.private_subnets],
+            desired_size=None if dynamic_scaling else self.asg_desired_size,
+            min_size=self.asg_min_size,
+            max_size=self.asg_max_size,
             health_check_type='EC2',
-            target_group_arns=[Ref('SimpleWebAppTargetGroup')],
+            target_group_arns=[Ref('SimpleWebAppTargetGroup' + colour)],
+            launch_template_name=launch_resource if self.app_launch_template else None,
+            mixed_instances_policy=self.app_mixed_instances_policy(launch_resource),
+            capacity_rebalance=self.on_demand_percentage < 100,
+            update_policy=self.app_update_policy(colour),
+            creation_policy=self.signal_creation_policy(
+                count=self.asg_min_size) if self.deployment_strategy == 'replacing' else None
+        )
+        self.add_app_scaling_policies(colour)
+
+    def app_update_policy(self, colour=''):
+        """
+        :param colour: Suffix of the group's resource names
+        :return: Update policy for an app server group, for the deployment strategy
+        """
+        if self.deployment_strategy == 'replacing':
+            return self.replacing_update_policy()
+        if self.deployment_strategy == 'blue-green':
+            if colour == self.deploy_colour:
+                # The colour being updated takes no traffic, so all of it can be replaced at once
+                return self.rolling_update_policy(min_in_service=0, batch_size=self.asg_max_size, pause_time='PT15M')
+            # The live colour is pinned (see pin_live_colour), but should it ever change, replace it one instance at a
+            # time while it keeps serving
+            return self.rolling_update_policy(min_in_service=min(self.asg_min_size, self.asg_max_size - 1),
+                                              pause_time='PT15M')
+        if self.batch_percent:
+            return self.percent_rolling_update_policy(self.asg_min_size, self.asg_max_size, self.batch_percent)
+        return None
+
+    def pin_live_colour(self):
+        """
+        Keep the live colour's launch configuration/template exactly as deployed (live_template), so that only the
+        colour being deployed picks up changes. Nothing is pinned before the live colour's group exists.
+        """
+        previous = (self.live_template or {}).get('Resources', {})
+        live_colour = [colour for colour in self.app_colours() if colour != self.deploy_colour][0]
+        if 'AppServerASG' + live_colour not in previous:
+            return
+        pinned = False
+        for name in ('AppServerLaunchConfig' + live_colour, 'AppServerLaunchTemplate' + live_colour):
+            if name in self.template.resources and name in previous:
+                self.template.resources[name] = previous[name]
+                pinned = True
+        if not pinned:
+            raise ValueError("Can't keep the live {} group as deployed - its launch configuration/template isn't in "
+                             "this template (was --launchtemplate changed?)".format(live_colour.lower()))
+
+    def app_mixed_instances_policy(self, launch_template_name):
+        """
+        :return: Mixed instances policy for several instance types and/or spot, otherwise None
+        """
+        if len(self.app_instance_types) == 1 and self.on_demand_percentage == 100:
+            return None
+        return self.create_mixed_instances_policy(
+            launch_template_name=launch_template_name,
+            instance_types=self.app_instance_types,
+            on_demand_base=self.on_demand_base,
+            on_demand_percentage=self.on_demand_percentage
+        )
+
+    def add_app_scaling_policies(self, colour=''):
+        """
+        Add the configured scaling policies to an app server ASG
+
+        :param colour: Suffix of the group's resource names
+        """
+        asg_name = 'AppServerASG' + colour
+        if self.scaling_cpu_target:
+            self.add_target_tracking_policy(
+                name='AppServerCpuTracking' + colour,
+                asg_name=asg_name,
+                target_value=self.scaling_cpu_target
+            )
+
+        if self.scaling_request_target:
+            self.add_target_tracking_policy(
+                name='AppServerRequestTracking' + colour,
+                asg_name=asg_name,
+                target_value=self.scaling_request_target,
+                metric_type='ALBRequestCountPerTarget',
+                resource_label=self.alb_request_count_resource_label('SimpleWebAppAlb',
+                                                                     'SimpleWebAppTargetGroup' + colour)
+            )
+
+        if self.scaling_cpu_steps:
+            high, low = self.scaling_cpu_steps
+            # One more instance just over the high threshold, two once well over it; one fewer under the low one
+            self.add_step_scaling_policy(
+                name='AppServerCpuScaleOut' + colour,
+                asg_name=asg_name,
+                metric_name='CPUUtilization',
+                threshold=high,
+                comparison='GreaterThanOrEqualToThreshold',
+                steps=[(0, 15, 1), (15, None, 2)]
+            )
+            self.add_step_scaling_policy(
+                name='AppServerCpuScaleIn' + colour,
+                asg_name=asg_name,
+                metric_name='CPUUtilization',
+                threshold=low,
+                comparison='LessThanOrEqualToThreshold',
+                steps=[(None, 0, -1)],
+                evaluation_periods=5
+            )
+
+        for idx, (recurrence, min_size, max_size, desired_size) in enumerate(self.scaling_schedules):
+            self.add_scheduled_action(
+                name='AppServerSchedule{}{}'.format(idx + 1, colour),
+                asg_name=asg_name,
+                recurrence=recurrence,
+                min_size=min_size,
+                max_size=max_size,
+                desired_size=desired_size
+            )
+
+    def add_cdn(self):
+        """
+        Put a CloudFront distribution in front of the ALB. Static content is cached at the edge for as long as the
+        app servers' Cache-Control allows, and filled through Origin Shield in (or near) the stack's region. Probes
+        and metrics always go through to the ALB.
+        """
+        self.add_cache_policy(name='SimpleWebAppStaticCachePolicy')
+        self.add_cache_policy(name='SimpleWebAppNoCachePolicy', default_ttl=0, max_ttl=0)
+        # Static content doesn't vary by cookie, query string or header, so forward none of them
+        self.add_origin_request_policy(name='SimpleWebAppOriginRequestPolicy')
+        self.add_cloudfront_distribution(
+            name='SimpleWebAppCdn',
+            origin_domain=GetAtt('SimpleWebAppAlb', 'DNSName'),
+            origin_id='SimpleWebAppAlb',
+            cache_policy='SimpleWebAppStaticCachePolicy',
+            origin_request_policy='SimpleWebAppOriginRequestPolicy',
+            origin_shield_region=ORIGIN_SHIELD_REGIONS.get(self.region),
+            behaviors=[self.cdn_cache_behavior(
+                path_pattern=path,
+                origin_id='SimpleWebAppAlb',
+                cache_policy='SimpleWebAppNoCachePolicy',
+                origin_request_policy='SimpleWebAppOriginRequestPolicy'
+            ) for path in PROBE_PATHS],
+            price_class=self.cdn_price_class,
+            comment='Simple web app'
+        )
+
+    def add_cache(self):
+        """
+        Add a Redis replication group in the private subnets, reachable from the app servers only
+        """
+        self.add_cache_subnet_group(
+            name='AppCacheSubnets',
+            subnets=[Ref(subnet) for subnet in self.private_subnets]
+        )
+        self.add_redis_parameter_group(
+            name='AppCacheParameters'
+        )
+        self.add_redis_replication_group(
+            name='AppCache',
+            subnet_group='AppCacheSubnets',
+            security_groups=[Ref('CacheSG')],
+            node_type=self.cache_node_type,
+            replicas=self.cache_replicas,
+            parameter_group='AppCacheParameters',
+            multi_az=self.cache_replicas > 0 and len(self.private_subnets) > 1
         )
 
     def build_stack(self):
-        self.create_network()
-        self.add_security_groups()
-        self.add_bastion()
-        self.add_load_balancer()
-        self.add_app_asg()
+        """
+        Build the template in layers: network, security (groups), data (the optional cache), edge (ALB and CDN) and
+        compute (bastion and app servers). Each layer can be deployed as its own stack with generate_layers.
+        """
+        with self.layer('network'):
+            self.create_network()
+        with self.layer('security'):
+            self.add_security_groups()
+        if self.cache_node_type:
+            with self.layer('data'):
+                self.add_cache()
+        with self.layer('edge'):
+            self.add_load_balancer()
+            if self.cdn:
+                self.add_cdn()
+        with self.layer('compute'):
+            self.add_bastion()
+            self.add_app_asg()
+
+    def generate(self, stack_name, region, force=False, watch=False):
+        """
+        Deploy the stack, or each of its layers if layered
+
+        :return: One of STACK_CREATED, STACK_UPDATED, STACK_UNCHANGED or STACK_FAILED - for layers, failed if any layer
+                 failed or was skipped, otherwise updated if any layer was created or updated
+        """
+        if not self.layered:
+            return self.generate_stack(stack_name=stack_name, region=region, force=force, watch=watch)
+        outcomes = list(self.generate_layers(stack_name=stack_name, region=region, force=force).values())
+        if STACK_FAILED in outcomes or STACK_SKIPPED in outcomes:
+            return STACK_FAILED
+        if all(outcome == STACK_UNCHANGED for outcome in outcomes):
+            return STACK_UNCHANGED
+        return STACK_CREATED if all(outcome in (STACK_CREATED, STACK_UNCHANGED) for outcome in outcomes) \
+            else STACK_UPDATED
+
+
+def parse_target(value):
+    """
+    Parse a --target value of the form STACK:REGION[:AMI]
+    """
+    parts = value.split(':')
+    if len(parts) not in (2, 3) or not all(parts):
+        raise argparse.ArgumentTypeError('expected STACK:REGION[:AMI], got \'{}\''.format(value))
+    stack_name, region = parts[:2]
+    image_id = parts[2] if len(parts) == 3 else default_image_ids.get(region)
+    if not image_id:
+        raise argparse.ArgumentTypeError('no default AMI for {} - use STACK:REGION:AMI'.format(region))
+    return stack_name, region, image_id
+
+
+def traffic_shifter(stack_name, region, stages=DEFAULT_STAGES, bake_seconds=60, layered=False):
+    """
+    Create a TrafficShifter for a deployed blue/green stack (its edge layer's stack, if layered)
+    """
+    if layered:
+        stack_name = layer_stack_name(stack_name, 'edge')
+    session = boto3.session.Session(region_name=region)
+    return TrafficShifter.from_stack(
+        cloudformation_client(region, session),
+        session.client('elbv2', region_name=region),
+        stack_name,
+        listener='SimpleWebAppListener',
+        target_groups=dict((colour, 'SimpleWebAppTargetGroup' + colour) for colour in DEPLOYMENT_COLOURS),
+        stages=stages,
+        bake_seconds=bake_seconds,
+        echo=lambda line: print('Stack: {} ({}) {}'.format(stack_name, region, line))
+    )
+
+
+def listener_weights(stack_name, region, layered=False):
+    """
+    :return: Dict of colour -> weight the deployed blue/green listener forwards with, or None if there isn't one yet
+    """
+    try:
+        return traffic_shifter(stack_name, region, layered=layered).weights()
+    except botocore.exceptions.ClientError as e:
+        # No stack yet, or one without a blue/green listener
+        if 'does not exist' in e.response['Error'].get('Message', ''):
+            return None
+        raise
+
+
+def parse_stages(value):
+    """
+    Parse a --shiftstages value of the form PERCENT,PERCENT,...,100
+    """
+    try:
+        stages = tuple(int(part) for part in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected comma separated percentages, got \'{}\''.format(value))
+    if list(stages) != sorted(set(stages)) or stages[0] <= 0 or stages[-1] != 100:
+        raise argparse.ArgumentTypeError('expected increasing percentages ending in 100, got \'{}\''.format(value))
+    return stages
+
+
+def parse_instance_types(value):
+    """
+    Parse an --appinstancetypes value of the form TYPE[:WEIGHT][,TYPE[:WEIGHT]...]
+    """
+    instance_types = []
+    for item in value.split(','):
+        instance_type, _, weight = item.strip().partition(':')
+        if not instance_type or (weight and not weight.isdigit()):
+            raise argparse.ArgumentTypeError('expected TYPE[:WEIGHT][,...], got \'{}\''.format(value))
+        instance_types.append((instance_type, int(weight or 1)))
+    return instance_types
+
+
+def parse_cpu_steps(value):
+    """
+    Parse a --scalingcpusteps value of the form HIGH,LOW
+    """
+    try:
+        high, low = [float(part) for part in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected HIGH,LOW CPU percentages, got \'{}\''.format(value))
+    if not 0 <= low < high <= 100:
+        raise argparse.ArgumentTypeError('expected 0 <= LOW < HIGH <= 100, got \'{}\''.format(value))
+    return high, low
+
+
+def parse_schedule(value):
+    """
+    Parse a --scalingschedule value of the form 'CRON=MIN:MAX[:DESIRED]'
+    """
+    recurrence, _, sizes = value.rpartition('=')
+    parts = sizes.split(':')
+    if not recurrence or len(parts) not in (2, 3) or not all(part.isdigit() for part in parts):
+        raise argparse.ArgumentTypeError('expected \'CRON=MIN:MAX[:DESIRED]\', got \'{}\''.format(value))
+    min_size, max_size = int(parts[0]), int(parts[1])
+    desired_size = int(parts[2]) if len(parts) == 3 else None
+    return recurrence.strip(), min_size, max_size, desired_size
 
 
 if __name__ == "__main__":
@@ -252,16 +740,274 @@ if __name__ == "__main__":
     parser.add_argument('--region', nargs='?', help='Region to deploy into (default: \'eu-west-1\')', default=default_region)
     parser.add_argument('--allowedingress', nargs='?', help='Ingress IP to Whitelist (default: \'0.0.0.0/0\')',
                         default=default_allowed_ingress)
+    parser.add_argument('--target', action='append', type=parse_target, default=[],
+                        help='STACK:REGION[:AMI] to deploy to, instead of --stackname/--region. Repeat to deploy '
+                             'several stacks/regions concurrently')
+    parser.add_argument('--parallelism', type=int, default=DEFAULT_PARALLELISM,
+                        help='Maximum number of targets deployed at once (default: {})'.format(DEFAULT_PARALLELISM))
+    parser.add_argument('--force', action='store_true',
+                        help='Deploy even if the template is unchanged since the last deploy from this machine')
+    parser.add_argument('--watch', action='store_true',
+                        help='Stream stack events until each deploy finishes, then print the ALB DNS name')
+    parser.add_argument('--appengine', choices=APP_ENGINES,
+                        help='App server engine - Flask app or asyncio static file server (default: \'flask\')',
+                        default=default_app_engine)
+    parser.add_argument('--appworkers', type=int, help='App server worker processes (default: one per core)',
+                        default=default_app_workers)
+    parser.add_argument('--appbacklog', type=int, help='App server listen backlog per worker (default: 128)',
+                        default=default_app_backlog)
+    parser.add_argument('--appmaxrequests', type=int,
+                        help='Recycle app server workers after this many requests (default: 10000, 0 = never)',
+                        default=default_app_max_requests)
+    parser.add_argument('--assetstore',
+                        help='s3://BUCKET[/PREFIX] to upload the app server files to as one archive, instead of '
+                             'inlining them into the template')
+    parser.add_argument('--appruntime', choices=APP_RUNTIMES, default=default_app_runtime,
+                        help='Install the app server runtime from the network at boot, or from a prebaked archive '
+                             'uploaded to --assetstore (default: \'install\')')
+    parser.add_argument('--packerrecipe', metavar='PATH',
+                        help='Write a Packer template for an AMI with the prebaked --appengine runtime installed, '
+                             'then exit')
+    parser.add_argument('--minsize', type=int, default=default_asg_min_size,
+                        help='Minimum number of app servers (default: {})'.format(default_asg_min_size))
+    parser.add_argument('--maxsize', type=int, default=default_asg_max_size,
+                        help='Maximum number of app servers (default: {})'.format(default_asg_max_size))
+    parser.add_argument('--desiredsize', type=int, default=default_asg_desired_size,
+                        help='Initial number of app servers, when no dynamic scaling is configured (default: {})'
+                        .format(default_asg_desired_size))
+    parser.add_argument('--scalingcpu', type=float, metavar='PERCENT',
+                        help='Add/remove app servers to keep average CPU at this percentage')
+    parser.add_argument('--scalingrequests', type=float, metavar='COUNT',
+                        help='Add/remove app servers to keep ALB requests per server per minute at this count')
+    parser.add_argument('--scalingcpusteps', type=parse_cpu_steps, metavar='HIGH,LOW',
+                        help='Step scaling on CPU alarms - scale out at HIGH %%, in at LOW %%')
+    parser.add_argument('--scalingschedule', type=parse_schedule, action='append', default=[],
+                        metavar='CRON=MIN:MAX[:DESIRED]',
+                        help='Scheduled change of group size (UTC), eg. \'0 8 * * 1-5=2:6\'. Repeatable')
+    parser.add_argument('--appinstancetypes', type=parse_instance_types, metavar='TYPE[:WEIGHT],...',
+                        help='App server instance type(s), eg. \'c5.large,m5.large\' - several types are mixed in '
+                             'one group, weighted by capacity (default: \'{}\')'.format(default_app_instance_type))
+    parser.add_argument('--ondemandbase', type=int, default=0,
+                        help='App server capacity that is always on-demand (default: 0)')
+    parser.add_argument('--spotpercentage', type=int, default=0, choices=range(0, 101), metavar='PERCENT',
+                        help='Percentage of app server capacity above --ondemandbase to run on spot, with capacity '
+                             'rebalancing (default: 0)')
+    parser.add_argument('--unlimitedcredits', action='store_true',
+                        help='Run T-family app servers in unlimited mode, so they are never throttled to baseline CPU')
+    parser.add_argument('--placement', choices=('cluster', 'spread', 'partition'),
+                        help='Launch app servers into a placement group with this strategy')
+    parser.add_argument('--launchtemplate', action='store_true',
+                        help='Use a launch template for the app servers even when no option above needs one')
+    parser.add_argument('--azs', type=int, metavar='COUNT',
+                        help='Spread the network over COUNT AZs, with app servers and a NAT gateway in each '
+                             '(default: app servers in a single private subnet)')
+    parser.add_argument('--lbprofile', choices=sorted(ELBV2_PROFILES),
+                        help='ALB and target group tuning - routing algorithm, slow start, connection draining, '
+                             'timeouts and health checks (default: AWS defaults)')
+    parser.add_argument('--cdn', action='store_true',
+                        help='Serve through a CloudFront distribution in front of the ALB, caching static content')
+    parser.add_argument('--cdnpriceclass', choices=('PriceClass_100', 'PriceClass_200', 'PriceClass_All'),
+                        default='PriceClass_100',
+                        help='CloudFront edge locations to serve from (default: \'PriceClass_100\')')
+    parser.add_argument('--cache', metavar='NODE_TYPE',
+                        help='Add a Redis cache tier of this node type (eg. cache.t3.micro) for the app servers\' '
+                             'cache-aside helper (flask engine only)')
+    parser.add_argument('--cachereplicas', type=int, default=0, choices=range(0, 6), metavar='COUNT',
+                        help='Redis read replicas, with automatic failover (Multi-AZ with --azs) (default: 0)')
+    parser.add_argument('--layered', action='store_true',
+                        help='Deploy as one stack per layer (network, security, data, edge, compute), in parallel '
+                             'where they don\'t depend on each other, redeploying only the layers that changed')
+    parser.add_argument('--deployment', choices=DEPLOYMENT_STRATEGIES, default=default_deployment_strategy,
+                        help='How app servers are updated - rolling in place, replacing the whole group, or '
+                             'blue-green with staged traffic shifting (default: \'rolling\')')
+    parser.add_argument('--batchpercent', type=int, metavar='PERCENT',
+                        help='Rolling deployments replace this percentage of app servers per batch (default: one '
+                             'at a time)')
+    parser.add_argument('--deploycolour', choices=[colour.lower() for colour in DEPLOYMENT_COLOURS], default='green',
+                        help='Blue-green colour to deploy to and shift traffic to - alternate between deploys '
+                             '(default: \'green\')')
+    parser.add_argument('--shiftstages', type=parse_stages, default=DEFAULT_STAGES, metavar='PERCENT,...,100',
+                        help='Blue-green traffic percentages to step through (default: \'{}\')'.format(
+                            ','.join(str(stage) for stage in DEFAULT_STAGES)))
+    parser.add_argument('--bakeseconds', type=int, default=60,
+                        help='How long each blue-green stage must stay healthy (default: 60)')
+    parser.add_argument('--shift', action='store_true',
+                        help='Shift traffic to --deploycolour without deploying, eg. after a failed shift')
+    parser.add_argument('--rollback', action='store_true',
+                        help='Send all traffic back to the colour other than --deploycolour, without deploying')
+    parser.add_argument('--appdevserver', action='store_true',
+                        help='Run the Flask development server on the app servers instead of the pre-fork server')
+    parser.add_argument('--templateformat', choices=TEMPLATE_FORMATS, default='json',
+                        help='Format templates are sent to CloudFormation in (default: json)')
+    parser.add_argument('--compact', action='store_true',
+                        help='Minify templates and factor repeated values into a mapping')
+    parser.add_argument('--templatestore',
+                        help='s3://BUCKET[/PREFIX] to upload templates too big to send inline to (default: '
+                             '--assetstore)')
+    parser.add_argument('--synthonly', '--synth-only', nargs='?', const='-', metavar='PATH',
+                        help='Write the template to PATH (default: stdout) without deploying it or loading the AWS SDK')
+    parser.add_argument('--analyze', action='store_true',
+                        help='Check the template for dependency cycles and dangling references, and estimate its '
+                             'critical path, without deploying')
     args = parser.parse_args()
 
-    stack = SimpleWebApp(
-        stack_name=args.stackname,
-        region=args.region,
-        keypair_name=args.keypair,
-        allowed_ingress=args.allowedingress
-    )
-    stack.build_stack()
-    stack.generate_stack(
-        stack_name=args.stackname,
-        region=args.region
+    if not args.target and args.region not in default_image_ids:
+        parser.error('no default AMI for {} - use --target {}:{}:AMI'.format(args.region, args.stackname, args.region))
+    targets = args.target or [(args.stackname, args.region, default_image_ids[args.region])]
+    if args.appruntime == 'prebaked' and not args.assetstore:
+        parser.error('--appruntime prebaked needs --assetstore')
+    for option, url in (('--assetstore', args.assetstore), ('--templatestore', args.templatestore)):
+        # CloudFormation and the instances can only fetch from S3
+        if url and not is_s3_url(url):
+            parser.error('{} must be an s3://BUCKET[/PREFIX] URL'.format(option))
+    if not args.minsize <= args.desiredsize <= args.maxsize:
+        parser.error('app server sizes must satisfy --minsize <= --desiredsize <= --maxsize')
+    if args.unlimitedcredits and not all(instance_type.startswith('t') for instance_type, _ in
+                                         args.appinstancetypes or [(default_app_instance_type, 1)]):
+        parser.error('--unlimitedcredits only applies to T-family --appinstancetypes')
+    if args.azs is not None and args.azs < 2:
+        parser.error('--azs must be at least 2 (the ALB needs subnets in two AZs)')
+    if args.batchpercent is not None and not 0 < args.batchpercent <= 100:
+        parser.error('--batchpercent must be between 1 and 100')
+    deploy_colour = args.deploycolour.capitalize()
+    live_colour = [colour for colour in DEPLOYMENT_COLOURS if colour != deploy_colour][0]
+
+    if args.packerrecipe:
+        _, region, image_id = targets[0]
+        with open(args.packerrecipe, 'w') as f:
+            json.dump(RuntimeBundle(args.appengine).packer_recipe(source_ami=image_id, region=region), f, indent=2)
+        print('Packer recipe written to {} - use the AMI it builds with --target STACK:REGION:AMI'.format(
+            args.packerrecipe))
+        sys.exit(0)
+
+    # Rendering without deploying builds no object stores (so never loads the AWS SDK) and publishes no bundles
+    offline = bool(args.synthonly or args.analyze)
+
+    def app(stack_name, region, image_id, live_template=None, live_weights=None):
+        return SimpleWebApp(
+            stack_name=stack_name,
+            region=region,
+            keypair_name=args.keypair,
+            image_id=image_id,
+            allowed_ingress=args.allowedingress,
+            app_engine=args.appengine,
+            app_workers=args.appworkers,
+            app_backlog=args.appbacklog,
+            app_max_requests=args.appmaxrequests,
+            app_dev_server=args.appdevserver,
+            asset_store=object_store_from_url(args.assetstore, region=region)
+            if args.assetstore and not offline else None,
+            bundle_placeholders=bool(args.assetstore) and offline,
+            app_runtime=args.appruntime,
+            asg_min_size=args.minsize,
+            asg_max_size=args.maxsize,
+            asg_desired_size=args.desiredsize,
+            scaling_cpu_target=args.scalingcpu,
+            scaling_request_target=args.scalingrequests,
+            scaling_cpu_steps=args.scalingcpusteps,
+            scaling_schedules=args.scalingschedule,
+            app_launch_template=args.launchtemplate,
+            app_instance_types=args.appinstancetypes,
+            on_demand_base=args.ondemandbase,
+            on_demand_percentage=100 - args.spotpercentage,
+            unlimited_credits=args.unlimitedcredits,
+            placement_strategy=args.placement,
+            az_count=args.azs,
+            deployment_strategy=args.deployment,
+            batch_percent=args.batchpercent,
+            deploy_colour=deploy_colour,
+            lb_profile=args.lbprofile,
+            cdn=args.cdn,
+            cdn_price_class=args.cdnpriceclass,
+            cache_node_type=args.cache,
+            cache_replicas=args.cachereplicas,
+            layered=args.layered,
+            template_format=args.templateformat,
+            compact_template=args.compact,
+            template_store=object_store_from_url(args.templatestore or args.assetstore, region=region)
+            if (args.templatestore or args.assetstore) and not offline else None,
+            live_template=live_template,
+            live_weights=live_weights
+        )
+
+    if args.synthonly:
+        stack_name, region, image_id = targets[0]
+        stack = app(stack_name, region, image_id)
+        stack.build_stack()
+        body = serialise_template(json.loads(stack.template.to_json()), args.templateformat, compact=args.compact)
+        if args.synthonly == '-':
+            sys.stdout.write(body + '\n')
+        else:
+            with open(args.synthonly, 'w') as f:
+                f.write(body + '\n')
+        sys.exit(0)
+
+    if args.analyze:
+        stack_name, region, image_id = targets[0]
+        stack = app(stack_name, region, image_id)
+        stack.build_stack()
+        analysis = analyze(stack.template.to_dict())
+        print(format_analysis(analysis))
+        sys.exit(1 if analysis['cycles'] or analysis['dangling'] else 0)
+
+    def deployment(stack_name, region, image_id):
+        def shift():
+            shifter = traffic_shifter(stack_name, region, stages=args.shiftstages, bake_seconds=args.bakeseconds,
+                                      layered=args.layered)
+            return 'shifted' if shifter.shift(deploy_colour, live_colour) else STACK_FAILED
+
+        def rollback():
+            traffic_shifter(stack_name, region, layered=args.layered).rollback(live_colour)
+            return 'rolled back'
+
+        def deploy():
+            blue_green = args.deployment == 'blue-green'
+            live_template = live_weights = None
+            if blue_green:
+                # The listener says which colour is live, whatever the last deploy or shift from here was
+                live_weights = listener_weights(stack_name, region, layered=args.layered)
+                if live_weights and live_weights.get(deploy_colour):
+                    print('Stack: {} ({}) {} is serving {}% of traffic - deploy --deploycolour {}, or --shift or '
+                          '--rollback first'.format(stack_name, region, deploy_colour.lower(),
+                                                    100 * live_weights[deploy_colour] // sum(live_weights.values()),
+                                                    live_colour.lower()))
+                    return STACK_FAILED
+                # Pin the live colour to what is actually deployed, whoever deployed it
+                compute_stack = layer_stack_name(stack_name, 'compute') if args.layered else stack_name
+                live_template = deployed_template(cloudformation_client(region), compute_stack)
+            stack = app(stack_name, region, image_id, live_template, live_weights)
+            stack.build_stack()
+            result = stack.generate(
+                stack_name=stack_name,
+                region=region,
+                force=args.force,
+                # Traffic can only be shifted once the stack has finished updating
+                watch=args.watch or blue_green
+            )
+            if blue_green and result in (STACK_CREATED, STACK_UPDATED) and shift() == STACK_FAILED:
+                return STACK_FAILED
+            return result
+
+        if args.rollback:
+            return rollback
+        if args.shift:
+            return shift
+        return deploy
+
+    if not (args.templatestore or args.assetstore or args.shift or args.rollback):
+        # Fail before deploying anything, rather than once per target at deploy time
+        for stack_name, region, image_id in targets:
+            stack = app(stack_name, region, image_id)
+            stack.build_stack()
+            for name, size in sorted(stack.oversized_templates(stack_name, layered=args.layered).items()):
+                parser.error('the {} template is {:,} bytes even compacted, over the {:,} bytes CloudFormation '
+                             'accepts inline - use --assetstore or --templatestore'.format(
+                                 name, size, TEMPLATE_BODY_LIMIT))
+
+    results = deploy_in_parallel(
+        [('{} ({})'.format(stack_name, region), deployment(stack_name, region, image_id))
+         for stack_name, region, image_id in targets],
+        parallelism=args.parallelism
     )
+    print(format_report(results))
+    sys.exit(0 if all(result.succeeded for result in results) else 1)
@@ -1,12 +1,139 @@
-from flask import Flask
+from flask import Flask, Response, abort, g, request
+from simple_web_app_static import StaticCache, DEFAULT_MAX_AGE
+from simple_web_app_prefork import PreforkServer
+from simple_web_app_metrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE, UNMATCHED_ROUTE
+import argparse
+import os
 
-app = Flask(__name__, static_url_path='')
+try:
+    from simple_web_app_cache import cache_from_environ
+except ImportError:
+    # Only shipped when the app has a cache tier
+    cache_from_environ = None
 
+app = Flask(__name__, static_folder=None)
 
-@app.route('/')
-def root():
-    return app.send_static_file('index.html')
+static_root = os.environ.get('SIMPLE_WEB_APP_STATIC',
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+static_cache = StaticCache(static_root, max_age=int(os.environ.get('SIMPLE_WEB_APP_MAX_AGE', DEFAULT_MAX_AGE)))
+static_cache.load()
+
+
+class NoCache(object):
+    """
+    Stands in for the cache-aside helper when there is no cache tier: every call runs the loader
+    """
+    def get_or_load(self, key, loader, ttl=None):
+        return loader()
+
+    def invalidate(self, key):
+        pass
+
+    def cached(self, prefix, ttl=None):
+        return lambda func: func
+
+
+# Cache-aside for anything expensive to produce, eg. `cache.get_or_load(key, loader)` or `@cache.cached('prefix')`.
+# Backed by Redis when the app has a cache tier, otherwise every call runs the loader.
+cache = cache_from_environ() if cache_from_environ else NoCache()
+
+
+def route_label():
+    return request.url_rule.rule if request.url_rule else UNMATCHED_ROUTE
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_route = route_label()
+    g.request_started = metrics.begin(g.request_route)
+
+
+@app.after_request
+def note_response_metrics(response):
+    g.response_status = response.status_code
+    g.response_bytes = response.content_length or 0
+    return response
+
+
+@app.teardown_request
+def record_request_metrics(exception=None):
+    # Runs even when a view raises and after_request is skipped, so the in-flight gauge always comes back down
+    if 'request_started' in g:
+        metrics.end(g.request_route, g.get('response_status', 500), g.pop('request_started'),
+                    g.get('response_bytes', 0))
+
+
+@app.route('/healthz')
+def healthz():
+    """
+    Liveness - the process is up and serving (used by the ALB health check)
+    """
+    return Response('ok\n', mimetype='text/plain', headers=[('Cache-Control', 'no-store')])
+
+
+@app.route('/readyz')
+def readyz():
+    """
+    Readiness - the static content has been loaded
+    """
+    if not static_cache.files:
+        return Response('static content not loaded\n', status=503, mimetype='text/plain',
+                        headers=[('Cache-Control', 'no-store')])
+    return Response('ready\n', mimetype='text/plain', headers=[('Cache-Control', 'no-store')])
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE, headers=[('Cache-Control', 'no-store')])
+
+
+@app.route('/', defaults={'path': ''})
+@app.route('/<path:path>')
+def root(path):
+    static_file = static_cache.lookup('/' + path)
+    if static_file is None:
+        abort(404)
+
+    variant = static_file.negotiate(request.headers.get('Accept-Encoding'))
+    headers = static_file.headers(variant)
+    if static_file.not_modified(variant,
+                                if_none_match=request.headers.get('If-None-Match'),
+                                if_modified_since=request.headers.get('If-Modified-Since')):
+        return Response(status=304, headers=headers)
+    return Response(variant.body, headers=headers)
+
+
+metrics = Metrics(rule.rule for rule in app.url_map.iter_rules())
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
 
 
 if __name__ == "__main__":
-    app.run(port=80, host='0.0.0.0')
+    # Defaults come from the environment file written by cfn-init (see simple_web_app.service)
+    parser = argparse.ArgumentParser(description='Simple web app')
+    parser.add_argument('--dev', action='store_true', default=os.environ.get('SIMPLE_WEB_APP_SERVER') == 'dev',
+                        help='Run the Flask development server instead of the pre-fork server')
+    parser.add_argument('--host', default=os.environ.get('SIMPLE_WEB_APP_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=env_int('SIMPLE_WEB_APP_PORT', 80))
+    parser.add_argument('--workers', type=int, default=env_int('SIMPLE_WEB_APP_WORKERS', 0),
+                        help='Worker processes (default: one per core)')
+    parser.add_argument('--backlog', type=int, default=env_int('SIMPLE_WEB_APP_BACKLOG', 128))
+    parser.add_argument('--max-requests', type=int, default=env_int('SIMPLE_WEB_APP_MAX_REQUESTS', 10000),
+                        help='Recycle workers after this many requests (0 = never)')
+    args = parser.parse_args()
+
+    if args.dev:
+        app.run(port=args.port, host=args.host)
+    else:
+        server = PreforkServer(app,
+                               host=args.host,
+                               port=args.port,
+                               workers=args.workers,
+                               backlog=args.backlog,
+                               max_requests=args.max_requests,
+                               max_requests_jitter=args.max_requests // 10,
+                               post_fork=metrics.set_slot)
+        metrics.allocate(server.workers)
+        server.run()
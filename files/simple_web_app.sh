@@ -1,2 +1,5 @@
 #!/bin/bash
-/bin/python /etc/simple_web_app.py
\ No newline at end of file
+if [ "${SIMPLE_WEB_APP_ENGINE}" = "asyncio" ]; then
+    exec /bin/python3 /etc/simple_web_app_async.py
+fi
+exec /bin/python /etc/simple_web_app.py
\ No newline at end of file
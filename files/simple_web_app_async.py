@@ -0,0 +1,416 @@
+"""
+asyncio static file engine for the simple web app (Python 3).
+
+An alternative to the Flask app that serves the static root directly: small files come from the in-memory
+StaticCache, large files are streamed with sendfile. Supports HTTP/1.1 keep-alive, conditional requests and
+single byte ranges. Runs one event loop per worker under the same pre-fork supervisor as the Flask app.
+"""
+from simple_web_app_prefork import PreforkServer
+from simple_web_app_static import StaticCache, DEFAULT_MAX_AGE
+from simple_web_app_metrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE, UNMATCHED_ROUTE
+from urllib.parse import unquote
+import argparse
+import asyncio
+import email.utils
+import os
+import random
+import signal
+import time
+
+# Files above this size are streamed from disk rather than held in memory
+SENDFILE_THRESHOLD = 64 * 1024
+# Fallback chunk size where loop.sendfile() isn't available (Python < 3.7)
+READ_CHUNK_SIZE = 256 * 1024
+# Longer than the ALB's default 60s idle timeout, so the ALB closes idle connections rather than us
+KEEPALIVE_TIMEOUT = 65
+MAX_HEADER_SIZE = 64 * 1024
+SHUTDOWN_GRACE_PERIOD = 10
+STATIC_ROUTE = 'static'
+PROBE_ROUTES = ('/healthz', '/readyz', '/metrics')
+
+REASONS = {
+    200: 'OK',
+    206: 'Partial Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    416: 'Range Not Satisfiable',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status):
+        super(HttpError, self).__init__(status)
+        self.status = status
+
+
+def http_date(cache={}):
+    now = int(time.time())
+    if cache.get('now') != now:
+        cache['now'] = now
+        cache['value'] = email.utils.formatdate(now, usegmt=True)
+    return cache['value']
+
+
+def parse_range(header, size):
+    """
+    Parse a Range header against a representation of the given size. Only single byte ranges are honoured; anything
+    else is ignored, which means serving the full representation (as RFC 7233 allows).
+
+    :param header: Raw Range header
+    :param size: Size of the representation
+    :return: (start, end) inclusive, or None to ignore the header
+    :raises HttpError: 416 if the range can't be satisfied
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise HttpError(416)
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise HttpError(416)
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+class Request(object):
+    __slots__ = ('method', 'path', 'version', 'headers')
+
+    def __init__(self, method, path, version, headers):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
+
+
+async def read_request(reader, keep_alive_timeout=KEEPALIVE_TIMEOUT):
+    """
+    Read and parse one request head from a connection
+
+    :param reader: asyncio StreamReader
+    :param keep_alive_timeout: Seconds to wait for the next request on an idle connection
+    :return: Request, or None if the client closed the connection
+    :raises HttpError: if the request is malformed
+    """
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), keep_alive_timeout)
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+        return None
+    except asyncio.LimitOverrunError:
+        raise HttpError(431)
+
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise HttpError(400)
+    if not version.startswith('HTTP/1.'):
+        raise HttpError(400)
+
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise HttpError(400)
+        headers[name.strip().lower()] = value.strip()
+
+    if 'transfer-encoding' in headers:
+        raise HttpError(400)
+    # Drain any body so the connection stays usable
+    length = headers.get('content-length')
+    if length:
+        try:
+            await reader.readexactly(int(length))
+        except (ValueError, asyncio.IncompleteReadError):
+            raise HttpError(400)
+
+    path = unquote(target.split('?', 1)[0])
+    if not path.startswith('/') or '/../' in path + '/':
+        raise HttpError(400)
+    return Request(method, path, version, headers)
+
+
+class StaticFileServer(object):
+    def __init__(self, cache, metrics, keep_alive_timeout=KEEPALIVE_TIMEOUT):
+        """
+        Per-worker connection handler
+
+        :param cache: Loaded StaticCache
+        :param metrics: Metrics to record requests in
+        :param keep_alive_timeout: Seconds to keep an idle connection open - must outlast the ALB's idle timeout
+        """
+        self.cache = cache
+        self.metrics = metrics
+        self.keep_alive_timeout = keep_alive_timeout
+        self.connections = set()
+        self.busy = set()
+        self.requests_handled = 0
+        self.alive = True
+        self.stopped = None
+
+    def write_response(self, writer, status, headers, keep_alive, body=b''):
+        """
+        Write a response head and (in-memory) body. They go out in a single write, as separate small writes on a
+        keep-alive connection run into Nagle/delayed ACK stalls.
+        """
+        lines = ['HTTP/1.1 {} {}'.format(status, REASONS[status]), 'Date: ' + http_date()]
+        lines.extend('{}: {}'.format(name, value) for name, value in headers)
+        lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        return status, len(body)
+
+    def text(self, writer, status, body, keep_alive, content_type='text/plain', headers=()):
+        body = body.encode('utf-8')
+        headers = [('Content-Type', content_type), ('Content-Length', len(body))] + list(headers)
+        return self.write_response(writer, status, headers, keep_alive, body)
+
+    def error(self, writer, status, keep_alive=False, headers=()):
+        return self.text(writer, status, '{} {}\n'.format(status, REASONS[status]), keep_alive, headers=headers)
+
+    def route_label(self, path):
+        if path in PROBE_ROUTES:
+            return path
+        if path in self.cache.files or path in self.cache.large_files:
+            return STATIC_ROUTE
+        return UNMATCHED_ROUTE
+
+    async def handle_connection(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            while self.alive:
+                try:
+                    request = await read_request(reader, self.keep_alive_timeout)
+                    if request is None:
+                        break
+                    self.busy.add(writer)
+                    keep_alive = request.keep_alive and self.alive
+                    route = self.route_label(request.path)
+                    started = self.metrics.begin(route)
+                    status, body_bytes = 500, 0
+                    try:
+                        status, body_bytes = await self.respond(request, writer, keep_alive)
+                    finally:
+                        self.metrics.end(route, status, started, body_bytes)
+                except HttpError as e:
+                    self.error(writer, e.status)
+                    keep_alive = False
+                self.requests_handled += 1
+                self.busy.discard(writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.busy.discard(writer)
+            self.connections.discard(writer)
+            writer.close()
+            if not self.alive and not self.connections and not self.stopped.done():
+                self.stopped.set_result(None)
+
+    async def respond(self, request, writer, keep_alive):
+        """
+        Respond to a request
+
+        :return: (status, body bytes sent)
+        """
+        if request.method not in ('GET', 'HEAD'):
+            return self.error(writer, 405, keep_alive, headers=[('Allow', 'GET, HEAD')])
+
+        no_store = [('Cache-Control', 'no-store')]
+        if request.path == '/healthz':
+            return self.text(writer, 200, 'ok\n', keep_alive, headers=no_store)
+        if request.path == '/readyz':
+            if not (self.cache.files or self.cache.large_files):
+                return self.text(writer, 503, 'static content not loaded\n', keep_alive, headers=no_store)
+            return self.text(writer, 200, 'ready\n', keep_alive, headers=no_store)
+        if request.path == '/metrics':
+            return self.text(writer, 200, self.metrics.render(), keep_alive, content_type=METRICS_CONTENT_TYPE,
+                             headers=no_store)
+
+        static_file = self.cache.lookup(request.path)
+        large_file = None
+        if static_file is None:
+            large_file = static_file = self.cache.lookup_large(request.path)
+        if static_file is None:
+            return self.error(writer, 404, keep_alive)
+
+        # Byte ranges always apply to the identity representation
+        byte_range = None
+        range_header = request.headers.get('range')
+        if range_header and self.if_range_matches(static_file, request.headers.get('if-range')):
+            variant = static_file.variants['identity']
+        else:
+            range_header = None
+            variant = static_file.negotiate(request.headers.get('accept-encoding'))
+
+        headers = static_file.headers(variant) + [('Accept-Ranges', 'bytes')]
+        if static_file.not_modified(variant,
+                                    if_none_match=request.headers.get('if-none-match'),
+                                    if_modified_since=request.headers.get('if-modified-since')):
+            return self.write_response(writer, 304, headers, keep_alive)
+
+        size = large_file.size if large_file else len(variant.body)
+        if range_header:
+            try:
+                byte_range = parse_range(range_header, size)
+            except HttpError:
+                return self.error(writer, 416, keep_alive, headers=[('Content-Range', 'bytes */{}'.format(size))])
+
+        status, start, count = 200, 0, size
+        if byte_range:
+            status, start, count = 206, byte_range[0], byte_range[1] - byte_range[0] + 1
+            headers.append(('Content-Range', 'bytes {}-{}/{}'.format(byte_range[0], byte_range[1], size)))
+        headers.append(('Content-Length', count))
+        if request.method == 'HEAD':
+            return self.write_response(writer, status, headers, keep_alive)
+        if large_file:
+            self.write_response(writer, status, headers, keep_alive)
+            await self.send_file(writer, large_file.path, start, count)
+            return status, count
+        body = variant.body[start:start + count] if byte_range else variant.body
+        return self.write_response(writer, status, headers, keep_alive, body)
+
+    @staticmethod
+    def if_range_matches(static_file, if_range):
+        if not if_range:
+            return True
+        if if_range.startswith('"'):
+            return if_range == static_file.variants['identity'].etag
+        return if_range == static_file.last_modified
+
+    @staticmethod
+    async def send_file(writer, path, offset, count):
+        """
+        Stream part of a file to the client, zero-copy where the event loop supports it
+
+        :param writer: asyncio StreamWriter
+        :param path: File to send
+        :param offset: Byte offset to start at
+        :param count: Number of bytes to send
+        """
+        loop = asyncio.get_event_loop()
+        await writer.drain()
+        with open(path, 'rb') as f:
+            if hasattr(loop, 'sendfile'):
+                await loop.sendfile(writer.transport, f, offset, count)
+                return
+            f.seek(offset)
+            while count > 0:
+                chunk = f.read(min(READ_CHUNK_SIZE, count))
+                if not chunk:
+                    break
+                writer.write(chunk)
+                count -= len(chunk)
+                await writer.drain()
+
+    def stop(self):
+        """
+        Stop taking new requests, close idle keep-alive connections and let in-flight requests finish
+        """
+        self.alive = False
+        for writer in list(self.connections - self.busy):
+            writer.close()
+        if not self.connections and not self.stopped.done():
+            self.stopped.set_result(None)
+
+
+class AsyncPreforkServer(PreforkServer):
+    def __init__(self, cache, keep_alive_timeout=KEEPALIVE_TIMEOUT, **kwargs):
+        """
+        Pre-fork supervisor running an asyncio StaticFileServer in each worker
+
+        :param cache: Loaded StaticCache
+        :param keep_alive_timeout: Seconds to keep an idle connection open
+        :param kwargs: See PreforkServer
+        """
+        self.metrics = Metrics((STATIC_ROUTE,) + PROBE_ROUTES)
+        super(AsyncPreforkServer, self).__init__(app=None, post_fork=self.metrics.set_slot, **kwargs)
+        self.metrics.allocate(self.workers)
+        self.cache = cache
+        self.keep_alive_timeout = keep_alive_timeout
+
+    def run_worker(self, listener):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        handler = StaticFileServer(self.cache, self.metrics, self.keep_alive_timeout)
+        handler.stopped = loop.create_future()
+
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            loop.add_signal_handler(signum, handler.stop)
+
+        limit = 0
+        if self.max_requests:
+            limit = self.max_requests + random.randint(0, self.max_requests_jitter)
+
+        async def recycle():
+            while handler.alive:
+                await asyncio.sleep(1)
+                if limit and handler.requests_handled >= limit:
+                    handler.stop()
+
+        listener.setblocking(False)
+        server = loop.run_until_complete(asyncio.start_server(handler.handle_connection, sock=listener,
+                                                              limit=MAX_HEADER_SIZE))
+        loop.create_task(recycle())
+        loop.run_until_complete(handler.stopped)
+        server.close()
+        loop.run_until_complete(asyncio.wait_for(server.wait_closed(), SHUTDOWN_GRACE_PERIOD))
+        loop.close()
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+if __name__ == "__main__":
+    # Defaults come from the environment file written by cfn-init (see simple_web_app.service)
+    parser = argparse.ArgumentParser(description='Simple web app (asyncio engine)')
+    parser.add_argument('--static', default=os.environ.get('SIMPLE_WEB_APP_STATIC', os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'static')), help='Directory to serve')
+    parser.add_argument('--host', default=os.environ.get('SIMPLE_WEB_APP_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=env_int('SIMPLE_WEB_APP_PORT', 80))
+    parser.add_argument('--workers', type=int, default=env_int('SIMPLE_WEB_APP_WORKERS', 0),
+                        help='Worker processes (default: one per core)')
+    parser.add_argument('--backlog', type=int, default=env_int('SIMPLE_WEB_APP_BACKLOG', 128))
+    parser.add_argument('--max-requests', type=int, default=env_int('SIMPLE_WEB_APP_MAX_REQUESTS', 10000),
+                        help='Recycle workers after this many requests (0 = never)')
+    parser.add_argument('--keep-alive', type=int, default=env_int('SIMPLE_WEB_APP_KEEPALIVE', KEEPALIVE_TIMEOUT),
+                        help='Seconds to keep idle connections open (default: {})'.format(KEEPALIVE_TIMEOUT))
+    args = parser.parse_args()
+
+    static_cache = StaticCache(args.static, max_age=env_int('SIMPLE_WEB_APP_MAX_AGE', DEFAULT_MAX_AGE))
+    static_cache.load(max_file_size=SENDFILE_THRESHOLD)
+    AsyncPreforkServer(static_cache,
+                       host=args.host,
+                       port=args.port,
+                       workers=args.workers,
+                       backlog=args.backlog,
+                       max_requests=args.max_requests,
+                       keep_alive_timeout=args.keep_alive,
+                       max_requests_jitter=args.max_requests // 10).run()
@@ -0,0 +1,400 @@
+"""
+Cache-aside for the simple web app: a bounded in-process LRU in front of Redis, with request coalescing so that only
+one caller runs the loader for a key at a time - threads in a worker share one flight, and workers and instances
+share one via a short-lived Redis lock.
+
+RedisClient speaks just enough of the Redis protocol for this, so the app servers need no extra packages. LocalRedis is
+an in-process stand-in with the same interface, used when no Redis endpoint is configured, eg. running the app
+locally.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+DEFAULT_TTL = 300
+DEFAULT_LOCAL_TTL = 5
+DEFAULT_LOCAL_ENTRIES = 1024
+# Returned by caches on a miss, as None is a valid cached value
+MISSING = object()
+
+
+class CacheError(Exception):
+    pass
+
+
+class LruCache(object):
+    def __init__(self, max_entries=DEFAULT_LOCAL_ENTRIES, clock=time.time):
+        """
+        Bounded, thread-safe in-process cache with per-entry expiry
+
+        :param max_entries: Entries to keep before evicting the least recently used (0 = cache nothing)
+        :param clock: Time source
+        """
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: The cached value, or MISSING
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= self.clock():
+                return MISSING
+            # Re-inserting moves the entry to the most recently used end
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, self.clock() + ttl)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+def encode_command(args):
+    parts = [('*{}\r\n'.format(len(args))).encode('ascii')]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode('utf-8')
+        parts.append(('${}\r\n'.format(len(arg))).encode('ascii'))
+        parts.append(arg)
+        parts.append(b'\r\n')
+    return b''.join(parts)
+
+
+class RedisClient(object):
+    def __init__(self, host, port=6379, timeout=0.25, retry_interval=1.0, clock=time.time):
+        """
+        Minimal blocking Redis client. The connection is opened lazily, and reopened after a fork or an error.
+
+        :param host: Redis host
+        :param port: Redis port
+        :param timeout: Connect and read timeout in seconds - a slow cache should fall back to the loader quickly
+        :param retry_interval: Seconds to fail fast for after a connection error, rather than every command waiting
+                               out the timeout while Redis is unreachable
+        :param clock: Time source
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self.retry_at = 0
+        self.sock = None
+        self.reader = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.reader.close()
+                self.sock.close()
+            except (socket.error, IOError):
+                pass
+        self.sock = self.reader = None
+
+    def connect(self):
+        self.close()
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        self.pid = os.getpid()
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise IOError('connection closed by Redis')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload
+        if kind == b'-':
+            raise CacheError(payload.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            if len(data) != length + 2:
+                raise IOError('connection closed by Redis')
+            return data[:-2]
+        if kind == b'*':
+            length = int(payload)
+            return None if length < 0 else [self.read_reply() for _ in range(length)]
+        raise IOError('unexpected reply from Redis: {!r}'.format(line))
+
+    def command(self, *args):
+        """
+        Run a command and return its reply
+
+        :raises CacheError: if Redis is unreachable or returns an error
+        """
+        with self.lock:
+            if self.clock() < self.retry_at:
+                raise CacheError('{}:{}: unavailable'.format(self.host, self.port))
+            try:
+                # A forked worker must not share its parent's connection
+                if self.sock is None or self.pid != os.getpid():
+                    self.connect()
+                self.sock.sendall(encode_command(args))
+                return self.read_reply()
+            except (socket.error, IOError, ValueError) as e:
+                self.close()
+                self.retry_at = self.clock() + self.retry_interval
+                raise CacheError('{}:{}: {}'.format(self.host, self.port, e))
+
+    def get(self, key):
+        return self.command('GET', key)
+
+    def set(self, key, value, ttl=None, nx=False):
+        """
+        :param ttl: Expiry in seconds (fractions allowed)
+        :param nx: Only set the key if it doesn't exist
+        :return: True if the key was set
+        """
+        args = ['SET', key, value]
+        if ttl:
+            args.extend(['PX', max(1, int(ttl * 1000))])
+        if nx:
+            args.append('NX')
+        return self.command(*args) is not None
+
+    def delete(self, key):
+        return self.command('DEL', key)
+
+
+class LocalRedis(object):
+    def __init__(self, clock=time.time):
+        """
+        In-process stand-in for RedisClient, with the same methods and expiry semantics
+
+        :param clock: Time source
+        """
+        self.clock = clock
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= self.clock():
+                del self.data[key]
+                return None
+            return entry[0]
+
+    def set(self, key, value, ttl=None, nx=False):
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        with self.lock:
+            entry = self.data.get(key)
+            if nx and entry is not None and (entry[1] is None or entry[1] > self.clock()):
+                return False
+            self.data[key] = (value, self.clock() + ttl if ttl else None)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            return 1 if self.data.pop(key, None) is not None else 0
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class CacheAside(object):
+    def __init__(self, backend, ttl=DEFAULT_TTL, local_entries=DEFAULT_LOCAL_ENTRIES, local_ttl=DEFAULT_LOCAL_TTL,
+                 lock_ttl=10, lock_wait=5, poll_interval=0.05, namespace='simple_web_app', clock=time.time,
+                 sleep=time.sleep):
+        """
+        Cache-aside over a Redis-like backend. Values must be JSON serialisable. A failing backend is treated as a
+        miss, so requests still succeed (just more slowly) while Redis is unavailable.
+
+        :param backend: RedisClient or LocalRedis
+        :param ttl: Default seconds to keep values in Redis
+        :param local_entries: Size of the in-process LRU in front of Redis (0 = no local cache)
+        :param local_ttl: Seconds to keep values in the local LRU - short, as invalidations only reach Redis
+        :param lock_ttl: Seconds a fleet-wide loader lock is held before it lapses (eg. if its holder died)
+        :param lock_wait: Seconds to wait for another worker's loader before running the loader anyway
+        :param poll_interval: Seconds between checks while waiting for another worker's loader
+        :param namespace: Prefix for Redis keys
+        :param clock: Time source
+        :param sleep: Sleep function
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.local = LruCache(local_entries, clock)
+        self.local_ttl = local_ttl
+        self.lock_ttl = lock_ttl
+        self.lock_wait = lock_wait
+        self.poll_interval = poll_interval
+        self.namespace = namespace
+        self.clock = clock
+        self.sleep = sleep
+        self.flights = {}
+        self.flights_lock = threading.Lock()
+        self.stats = dict((name, 0) for name in ('local_hits', 'hits', 'misses', 'coalesced', 'errors'))
+
+    def redis_key(self, key):
+        return '{}:{}'.format(self.namespace, key)
+
+    def count(self, name):
+        # Stats are approximate - they're not worth a lock on the hot path
+        self.stats[name] += 1
+
+    def remote_get(self, key):
+        try:
+            value = self.backend.get(key)
+        except CacheError:
+            self.count('errors')
+            return MISSING
+        return MISSING if value is None else json.loads(value.decode('utf-8'))
+
+    def remote_set(self, key, value, ttl, nx=False):
+        try:
+            return self.backend.set(key, value, ttl=ttl, nx=nx)
+        except CacheError:
+            self.count('errors')
+            return None
+
+    def remote_delete(self, key):
+        try:
+            self.backend.delete(key)
+        except CacheError:
+            self.count('errors')
+
+    def get_or_load(self, key, loader, ttl=None):
+        """
+        Return a cached value, or load and cache it. Concurrent callers for the same key share a single load.
+
+        :param key: Cache key
+        :param loader: Called with no arguments to produce the value on a miss
+        :param ttl: Seconds to keep the value in Redis (default: the cache's ttl)
+        :return: The value - shared between callers, so treat it as read-only
+        """
+        value = self.local.get(key)
+        if value is not MISSING:
+            self.count('local_hits')
+            return value
+
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            self.count('coalesced')
+            return flight.wait()
+
+        try:
+            flight.value = self.fetch(key, loader, self.ttl if ttl is None else ttl)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.flights_lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def fetch(self, key, loader, ttl):
+        redis_key = self.redis_key(key)
+        value = self.remote_get(redis_key)
+        if value is not MISSING:
+            self.count('hits')
+        else:
+            self.count('misses')
+            value = self.load(redis_key, loader, ttl)
+        self.local.set(key, value, min(self.local_ttl, ttl))
+        return value
+
+    def load(self, redis_key, loader, ttl):
+        """
+        Run the loader under a fleet-wide lock, or wait for whoever holds the lock to fill the key
+        """
+        lock_key = redis_key + ':lock'
+        token = uuid.uuid4().hex
+        # If Redis is down (None) there's nothing to coordinate through, so just load
+        if self.remote_set(lock_key, token, self.lock_ttl, nx=True) is False:
+            deadline = self.clock() + self.lock_wait
+            while self.clock() < deadline:
+                self.sleep(self.poll_interval)
+                value = self.remote_get(redis_key)
+                if value is not MISSING:
+                    return value
+            # The lock holder is slow or gone - load regardless rather than fail the request
+            return self.store(redis_key, loader(), ttl)
+
+        try:
+            return self.store(redis_key, loader(), ttl)
+        finally:
+            # Only release our own lock - it may have lapsed and been taken by someone else meanwhile
+            try:
+                if self.backend.get(lock_key) == token.encode('ascii'):
+                    self.backend.delete(lock_key)
+            except CacheError:
+                self.count('errors')
+
+    def store(self, redis_key, value, ttl):
+        if ttl > 0:
+            self.remote_set(redis_key, json.dumps(value, sort_keys=True, separators=(',', ':')), ttl)
+        return value
+
+    def invalidate(self, key):
+        """
+        Drop a key from Redis and this process's LRU (other processes' LRUs expire it within local_ttl)
+        """
+        self.local.delete(key)
+        self.remote_delete(self.redis_key(key))
+
+    def cached(self, prefix, ttl=None):
+        """
+        Decorator caching a function's result, keyed on prefix and its positional arguments
+
+        :param prefix: Key prefix, eg. the function's name
+        :param ttl: Seconds to keep results in Redis (default: the cache's ttl)
+        """
+        def decorator(func):
+            def wrapper(*args):
+                key = ':'.join([prefix] + [str(arg) for arg in args])
+                return self.get_or_load(key, lambda: func(*args), ttl)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return decorator
+
+
+def cache_from_environ(environ=os.environ):
+    """
+    Create the app's cache: Redis at $SIMPLE_WEB_APP_CACHE_HOST:$SIMPLE_WEB_APP_CACHE_PORT if set, otherwise an
+    in-process LocalRedis
+    """
+    host = environ.get('SIMPLE_WEB_APP_CACHE_HOST')
+    backend = RedisClient(host, int(environ.get('SIMPLE_WEB_APP_CACHE_PORT', 6379))) if host else LocalRedis()
+    return CacheAside(backend, ttl=int(environ.get('SIMPLE_WEB_APP_CACHE_TTL', DEFAULT_TTL)))
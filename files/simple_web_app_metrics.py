@@ -0,0 +1,161 @@
+"""
+Low-overhead request metrics for the simple web app, rendered in the Prometheus text format.
+
+Counters live in an anonymous shared memory map laid out as one region per pre-fork worker slot. Each worker only
+ever writes to its own region (so no cross-process locking is needed) and /metrics sums all regions, so a scrape
+landing on any worker sees the whole instance. A recycled worker takes over its slot's counters, keeping them
+monotonic.
+"""
+from timeit import default_timer
+import bisect
+import ctypes
+import mmap
+import threading
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+UNMATCHED_ROUTE = 'unmatched'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Per-route fields, followed by the histogram buckets (the last one being +Inf)
+REQUESTS = 0
+DURATION_SUM_US = len(STATUS_CLASSES)
+BYTES = DURATION_SUM_US + 1
+IN_FLIGHT = BYTES + 1
+BUCKETS = IN_FLIGHT + 1
+
+
+class Metrics(object):
+    def __init__(self, routes, slots=1, prefix='simple_web_app'):
+        """
+        Per-route request counters, latency histograms, in-flight gauges and byte counters
+
+        :param routes: Route labels to track - anything else is counted as 'unmatched'
+        :param slots: Number of worker slots sharing the counters (see allocate)
+        :param prefix: Metric name prefix
+        """
+        self.routes = list(routes)
+        if UNMATCHED_ROUTE not in self.routes:
+            self.routes.append(UNMATCHED_ROUTE)
+        self.route_index = dict((route, idx) for idx, route in enumerate(self.routes))
+        self.prefix = prefix
+        self.stride = BUCKETS + len(LATENCY_BUCKETS) + 1
+        self.lock = threading.Lock()
+        self.allocate(slots)
+
+    def allocate(self, slots):
+        """
+        (Re)allocate zeroed shared counters. Must be called before forking workers.
+
+        :param slots: Number of worker slots
+        """
+        self.slots = slots
+        self.buffer = mmap.mmap(-1, ctypes.sizeof(ctypes.c_int64) * slots * len(self.routes) * self.stride)
+        self.counters = (ctypes.c_int64 * (slots * len(self.routes) * self.stride)).from_buffer(self.buffer)
+        self.slot = 0
+
+    def set_slot(self, slot):
+        """
+        Select the slot this process writes to (called in each worker after fork)
+
+        :param slot: Worker slot index
+        """
+        self.slot = slot
+
+    def offset(self, route):
+        idx = self.route_index.get(route, self.route_index[UNMATCHED_ROUTE])
+        return (self.slot * len(self.routes) + idx) * self.stride
+
+    def begin(self, route):
+        """
+        Mark a request as in flight
+
+        :param route: Route label
+        :return: Start time, to pass to end()
+        """
+        with self.lock:
+            self.counters[self.offset(route) + IN_FLIGHT] += 1
+        return default_timer()
+
+    def end(self, route, status, started, body_bytes):
+        """
+        Record a finished request
+
+        :param route: Route label
+        :param status: HTTP status code
+        :param started: Value returned by begin()
+        :param body_bytes: Response body size
+        """
+        duration = default_timer() - started
+        offset = self.offset(route)
+        counters = self.counters
+        with self.lock:
+            counters[offset + IN_FLIGHT] -= 1
+            counters[offset + REQUESTS + min(max(status // 100, 1), 5) - 1] += 1
+            counters[offset + DURATION_SUM_US] += int(duration * 1000000)
+            counters[offset + BYTES] += body_bytes
+            counters[offset + BUCKETS + bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def totals(self):
+        """
+        Sum the counters across all slots
+
+        :return: Dict of route -> list of field values
+        """
+        totals = {}
+        counters = self.counters
+        for idx, route in enumerate(self.routes):
+            values = [0] * self.stride
+            for slot in range(self.slots):
+                offset = (slot * len(self.routes) + idx) * self.stride
+                for field in range(self.stride):
+                    values[field] += counters[offset + field]
+            totals[route] = values
+        return totals
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format
+
+        :return: Exposition text
+        """
+        totals = self.totals()
+        name = self.prefix
+        lines = [
+            '# HELP {}_requests_total Requests handled, by route and status class'.format(name),
+            '# TYPE {}_requests_total counter'.format(name),
+        ]
+        for route in self.routes:
+            for idx, status_class in enumerate(STATUS_CLASSES):
+                if totals[route][REQUESTS + idx]:
+                    lines.append('{}_requests_total{{route="{}",code="{}"}} {}'.format(
+                        name, route, status_class, totals[route][REQUESTS + idx]))
+
+        lines += [
+            '# HELP {}_request_duration_seconds Request latency, by route'.format(name),
+            '# TYPE {}_request_duration_seconds histogram'.format(name),
+        ]
+        for route in self.routes:
+            cumulative = 0
+            for idx, bound in enumerate(LATENCY_BUCKETS + (float('inf'),)):
+                cumulative += totals[route][BUCKETS + idx]
+                lines.append('{}_request_duration_seconds_bucket{{route="{}",le="{}"}} {}'.format(
+                    name, route, '+Inf' if bound == float('inf') else repr(bound), cumulative))
+            lines.append('{}_request_duration_seconds_sum{{route="{}"}} {}'.format(
+                name, route, totals[route][DURATION_SUM_US] / 1000000.0))
+            lines.append('{}_request_duration_seconds_count{{route="{}"}} {}'.format(name, route, cumulative))
+
+        lines += [
+            '# HELP {}_requests_in_flight Requests currently being handled, by route'.format(name),
+            '# TYPE {}_requests_in_flight gauge'.format(name),
+        ]
+        for route in self.routes:
+            lines.append('{}_requests_in_flight{{route="{}"}} {}'.format(name, route, totals[route][IN_FLIGHT]))
+
+        lines += [
+            '# HELP {}_response_bytes_total Response body bytes served, by route'.format(name),
+            '# TYPE {}_response_bytes_total counter'.format(name),
+        ]
+        for route in self.routes:
+            lines.append('{}_response_bytes_total{{route="{}"}} {}'.format(name, route, totals[route][BYTES]))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,206 @@
+"""
+Pre-fork WSGI server for the simple web app.
+
+A supervisor process opens one SO_REUSEPORT listener per worker slot and forks a worker onto each, so the kernel
+spreads incoming connections across the workers. Workers are recycled after a (jittered) number of requests; the
+supervisor keeps the listeners open, so connections queued on a slot survive its worker being replaced.
+"""
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+import errno
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import time
+
+# Not exported by the socket module on Python 2, but the value is fixed on Linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+# Workers that die quicker than this are assumed to be crashing, and respawns are throttled
+MIN_WORKER_LIFETIME = 1.0
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class ListenerWSGIServer(WSGIServer):
+    def __init__(self, listener, handler_class=QuietRequestHandler):
+        """
+        WSGI server that serves on an already bound and listening socket
+
+        :param listener: Listening socket
+        :param handler_class: Request handler class
+        """
+        WSGIServer.__init__(self, listener.getsockname(), handler_class, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener
+        host, port = listener.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.requests_handled = 0
+        self.setup_environ()
+
+    def process_request(self, request, client_address):
+        self.requests_handled += 1
+        WSGIServer.process_request(self, request, client_address)
+
+
+def create_listener(host, port, backlog):
+    """
+    Create a listening socket that can share its port with the other workers
+
+    :param host: Address to bind to
+    :param port: Port to bind to
+    :param backlog: Accept queue length
+    :return: Listening socket
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+class PreforkServer(object):
+    def __init__(self, app, host='0.0.0.0', port=80, workers=0, backlog=128, max_requests=10000,
+                 max_requests_jitter=1000, post_fork=None):
+        """
+        Pre-fork supervisor
+
+        :param app: WSGI application
+        :param host: Address to listen on
+        :param port: Port to listen on
+        :param workers: Number of worker processes (0 = one per core)
+        :param backlog: Accept queue length per worker
+        :param max_requests: Recycle a worker after this many requests (0 = never)
+        :param max_requests_jitter: Random extra requests per worker, so workers don't all recycle at once
+        :param post_fork: Called with the worker's slot index in each new worker, before it starts serving
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers or multiprocessing.cpu_count()
+        self.backlog = backlog
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.post_fork = post_fork
+        self.listeners = []
+        self.children = {}
+        self.alive = True
+
+    def run(self):
+        """
+        Open the listeners, start the workers and supervise them until SIGTERM/SIGINT
+        """
+        self.listeners = [create_listener(self.host, self.port, self.backlog) for _ in range(self.workers)]
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        for slot in range(self.workers):
+            self.spawn_worker(slot)
+
+        while self.alive:
+            try:
+                pid, _ = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    time.sleep(MIN_WORKER_LIFETIME)
+                    continue
+                raise
+            slot, started = self.children.pop(pid, (None, None))
+            if slot is None or not self.alive:
+                continue
+            if time.time() - started < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            self.spawn_worker(slot)
+
+        self.stop_workers()
+
+    def spawn_worker(self, slot):
+        """
+        Fork a worker onto a listener slot
+
+        :param slot: Index of the listener to serve on
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (slot, time.time())
+            return
+        status = 0
+        try:
+            if self.post_fork:
+                self.post_fork(slot)
+            self.run_worker(self.listeners[slot])
+        except Exception:
+            status = 1
+            sys.excepthook(*sys.exc_info())
+        finally:
+            os._exit(status)
+
+    def run_worker(self, listener):
+        """
+        Worker loop - serve requests until recycled or told to stop
+
+        :param listener: Listening socket to serve on
+        """
+        state = {'alive': True}
+
+        def stop(signum, frame):
+            state['alive'] = False
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, stop)
+
+        server = ListenerWSGIServer(listener)
+        server.set_app(self.app)
+        # Wake up regularly to notice signals, rather than blocking in accept()
+        server.timeout = 1.0
+        limit = 0
+        if self.max_requests:
+            limit = self.max_requests + random.randint(0, self.max_requests_jitter)
+
+        while state['alive'] and not (limit and server.requests_handled >= limit):
+            server.handle_request()
+
+    def signal_workers(self, signum):
+        """
+        Send a signal to every worker
+
+        :param signum: Signal to send
+        """
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def stop_workers(self):
+        """
+        Ask all workers to finish their current request and exit, then wait for them
+        """
+        self.signal_workers(signal.SIGTERM)
+        while self.children:
+            try:
+                pid, _ = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            self.children.pop(pid, None)
+
+    def handle_stop(self, signum, frame):
+        # os.wait() is retried after signal handlers, so wake the supervisor loop by stopping the workers
+        self.alive = False
+        self.signal_workers(signal.SIGTERM)
+
+    def handle_reload(self, signum, frame):
+        # Workers exit on SIGHUP and get respawned by the supervisor loop
+        self.signal_workers(signal.SIGHUP)
@@ -0,0 +1,252 @@
+"""
+In-memory static content cache for the simple web app.
+
+Everything under the static root is read once at startup and kept in memory as identity, gzip and (when the brotli
+module is installed) brotli variants, so serving a request is a dict lookup rather than a stat/open/read. Callers
+that can stream from disk (eg. with sendfile) may leave files over a size limit uncached.
+"""
+import email.utils
+import hashlib
+import mimetypes
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_MAX_AGE = 300
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+# Below this size the compression framing costs more than it saves
+MIN_COMPRESS_SIZE = 256
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+# Preferred order when the client rates several codings equally
+ENCODING_PREFERENCE = ('br', 'gzip', 'identity')
+
+
+def gzip_compress(body, level=GZIP_LEVEL):
+    """
+    Gzip a body with a zeroed header timestamp, so the output (and its ETag) is stable across restarts
+
+    :param body: Bytes to compress
+    :param level: Compression level
+    :return: Gzipped bytes
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def parse_accept_encoding(header):
+    """
+    Parse an Accept-Encoding header into a dict of coding -> q-value
+
+    :param header: Raw header value (may be None)
+    :return: Dict of codings, eg. {'gzip': 1.0, 'br': 0.5}
+    """
+    codings = {}
+    if not header:
+        return codings
+    for item in header.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+class StaticVariant(object):
+    __slots__ = ('body', 'etag', 'encoding')
+
+    def __init__(self, body, etag, encoding):
+        self.body = body
+        self.etag = etag
+        self.encoding = encoding
+
+
+class StaticFile(object):
+    def __init__(self, body, mtime, content_type, max_age=DEFAULT_MAX_AGE):
+        """
+        A single static file and its encoded variants
+
+        :param body: File contents (bytes)
+        :param mtime: Modification time of the file on disk
+        :param content_type: Content-Type to serve the file with
+        :param max_age: Cache-Control max-age, in seconds
+        """
+        self.content_type = content_type
+        self.mtime = int(mtime)
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+        self.cache_control = 'public, max-age={}'.format(max_age)
+        digest = hashlib.sha256(body).hexdigest()[:32]
+
+        # Strong ETags must differ per representation, hence the coding suffix
+        self.variants = {'identity': StaticVariant(body, '"{}"'.format(digest), None)}
+        if self.compressible and len(body) >= MIN_COMPRESS_SIZE:
+            gzipped = gzip_compress(body)
+            if len(gzipped) < len(body):
+                self.variants['gzip'] = StaticVariant(gzipped, '"{}-gzip"'.format(digest), 'gzip')
+            if brotli is not None:
+                brotlied = brotli.compress(body, quality=BROTLI_QUALITY)
+                if len(brotlied) < len(body):
+                    self.variants['br'] = StaticVariant(brotlied, '"{}-br"'.format(digest), 'br')
+
+    @property
+    def compressible(self):
+        return self.content_type.startswith(COMPRESSIBLE_TYPES)
+
+    def negotiate(self, accept_encoding):
+        """
+        Pick the best variant for an Accept-Encoding header
+
+        :param accept_encoding: Raw Accept-Encoding header (may be None)
+        :return: StaticVariant
+        """
+        codings = parse_accept_encoding(accept_encoding)
+        best, best_q = self.variants['identity'], 0.0
+        for coding in ENCODING_PREFERENCE:
+            variant = self.variants.get(coding)
+            if variant is None or coding == 'identity':
+                continue
+            q = codings.get(coding, codings.get('*', 0.0))
+            if q > best_q:
+                best, best_q = variant, q
+        return best
+
+    def headers(self, variant):
+        """
+        Response headers for a variant
+
+        :param variant: StaticVariant being served
+        :return: List of (name, value) header tuples
+        """
+        headers = [
+            ('Content-Type', self.content_type),
+            ('ETag', variant.etag),
+            ('Last-Modified', self.last_modified),
+            ('Cache-Control', self.cache_control),
+        ]
+        if len(self.variants) > 1:
+            headers.append(('Vary', 'Accept-Encoding'))
+        if variant.encoding:
+            headers.append(('Content-Encoding', variant.encoding))
+        return headers
+
+    def not_modified(self, variant, if_none_match=None, if_modified_since=None):
+        """
+        Evaluate conditional request headers (If-None-Match takes precedence, as per RFC 7232)
+
+        :param variant: StaticVariant that would be served
+        :param if_none_match: Raw If-None-Match header (may be None)
+        :param if_modified_since: Raw If-Modified-Since header (may be None)
+        :return: True if a 304 should be sent
+        """
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            if '*' in tags:
+                return True
+            # If-None-Match uses the weak comparison function, so ignore any W/ prefix
+            return any((tag[2:] if tag.startswith('W/') else tag) == variant.etag for tag in tags)
+        if if_modified_since:
+            parsed = email.utils.parsedate_tz(if_modified_since)
+            if parsed is None:
+                return False
+            return self.mtime <= email.utils.mktime_tz(parsed)
+        return False
+
+
+class LargeStaticFile(StaticFile):
+    def __init__(self, path, stat, content_type, max_age=DEFAULT_MAX_AGE):
+        """
+        A static file that is served from disk rather than memory. Only the identity variant exists, and the ETag
+        is derived from size and mtime so that the file never has to be read up front.
+
+        :param path: Path of the file on disk
+        :param stat: os.stat() result for the file
+        :param content_type: Content-Type to serve the file with
+        :param max_age: Cache-Control max-age, in seconds
+        """
+        self.path = path
+        self.size = stat.st_size
+        self.content_type = content_type
+        self.mtime = int(stat.st_mtime)
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+        self.cache_control = 'public, max-age={}'.format(max_age)
+        etag = '"{:x}-{:x}"'.format(self.mtime, self.size)
+        self.variants = {'identity': StaticVariant(None, etag, None)}
+
+
+class StaticCache(object):
+    def __init__(self, root, index='index.html', max_age=DEFAULT_MAX_AGE):
+        """
+        Cache of every file under a static root, keyed by URL path
+
+        :param root: Directory to serve, eg. /etc/static
+        :param index: File to serve for directory paths
+        :param max_age: Cache-Control max-age, in seconds
+        """
+        self.root = root
+        self.index = index
+        self.max_age = max_age
+        self.files = {}
+        self.large_files = {}
+
+    def load(self, max_file_size=None):
+        """
+        (Re)load every file under the root into memory
+
+        :param max_file_size: Files bigger than this are not read, only recorded in large_files (None = no limit)
+        :return: Number of files loaded
+        """
+        files = {}
+        large_files = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                if content_type.startswith('text/'):
+                    content_type += '; charset=utf-8'
+                url = '/' + os.path.relpath(path, self.root).replace(os.sep, '/')
+                if max_file_size is not None and stat.st_size > max_file_size:
+                    large_files[url] = LargeStaticFile(path, stat, content_type, self.max_age)
+                else:
+                    with open(path, 'rb') as f:
+                        files[url] = StaticFile(f.read(), stat.st_mtime, content_type, self.max_age)
+                if filename == self.index:
+                    index_url = url[:-len(filename)]
+                    if url in files:
+                        files[index_url] = files[url]
+                    else:
+                        large_files[index_url] = large_files[url]
+        self.files = files
+        self.large_files = large_files
+        return len(files) + len(large_files)
+
+    def lookup(self, path):
+        """
+        Find the cached file for a URL path
+
+        :param path: URL path, eg. '/' or '/index.html'
+        :return: StaticFile, or None if there is no such file
+        """
+        return self.files.get(path)
+
+    def lookup_large(self, path):
+        """
+        Find a file that was too big to cache
+
+        :param path: URL path
+        :return: LargeStaticFile, or None if there is no such file
+        """
+        return self.large_files.get(path)
@@ -0,0 +1,152 @@
+"""
+Pack the files shipped to the app servers into a single content-addressed tar.gz, delivered through cfn-init sources
+rather than inlined into the launch configuration metadata.
+
+The archive is a concatenation of gzip members, one per file (gzip readers, tar and cfn-init included, treat that as
+one stream). Compressed members are cached by content hash, so a rebuild after one file changed only compresses that
+file. Everything that could vary between builds - timestamps, owners, file order - is fixed, so the same inputs always
+give a byte-identical archive and the same object name.
+"""
+from metadata.instance_metadata import APP_SERVER_FILES, files_dir
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tempfile
+
+DEFAULT_BUILD_DIR = os.path.join(os.path.expanduser('~'), '.simple_web_app', 'build')
+# Timestamp given to every archived file (override with the usual reproducible-builds variable)
+BUNDLE_MTIME = int(os.environ.get('SOURCE_DATE_EPOCH', 1577836800))
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tar_member(path, data, mode):
+    """
+    A single tar entry (header, data and padding) with fixed ownership and timestamp
+
+    :param path: Path inside the archive
+    :param data: File contents
+    :param mode: Permission bits
+    :return: Bytes
+    """
+    info = tarfile.TarInfo(path)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = BUNDLE_MTIME
+    info.uid = info.gid = 0
+    info.uname = info.gname = 'root'
+    padding = -len(data) % tarfile.BLOCKSIZE
+    return info.tobuf(tarfile.GNU_FORMAT) + data + b'\0' * padding
+
+
+def gzip_member(data):
+    """
+    Gzip bytes with an empty file name and zero timestamp, so the output only depends on the input
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class AssetBundle(object):
+    def __init__(self, files=APP_SERVER_FILES, source_dir=None, build_dir=None):
+        """
+        :param files: (file in source_dir, path on the instance, mode) tuples to pack
+        :param source_dir: Directory the files are read from (default: files/)
+        :param build_dir: Directory for archives and cached members (default: $SIMPLE_WEB_APP_BUILD_DIR or
+                          ~/.simple_web_app/build)
+        """
+        self.files = files
+        self.source_dir = source_dir or files_dir()
+        self.build_dir = build_dir or os.environ.get('SIMPLE_WEB_APP_BUILD_DIR', DEFAULT_BUILD_DIR)
+
+    def manifest(self):
+        """
+        :return: List of {'path', 'mode', 'sha256', 'size'} dicts, one per file, in archive order
+        """
+        manifest = []
+        for name, target, mode in sorted(self.files, key=lambda entry: entry[1]):
+            source = os.path.join(self.source_dir, name)
+            manifest.append({
+                'path': target.lstrip('/'),
+                'mode': mode,
+                'sha256': file_digest(source),
+                'size': os.path.getsize(source),
+                'source': name,
+            })
+        return manifest
+
+    @staticmethod
+    def bundle_id(manifest):
+        canonical = json.dumps([(entry['path'], entry['mode'], entry['sha256']) for entry in manifest],
+                               separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:24]
+
+    def write_atomic(self, path, data):
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def member(self, entry):
+        """
+        The compressed archive member for a manifest entry, from the cache if it was built before
+        """
+        member_dir = os.path.join(self.build_dir, 'members')
+        if not os.path.isdir(member_dir):
+            os.makedirs(member_dir)
+        key = hashlib.sha256('{}:{}:{}'.format(entry['path'], entry['mode'], entry['sha256']).encode('utf-8'))
+        path = os.path.join(member_dir, key.hexdigest() + '.gz')
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read(), False
+        with open(os.path.join(self.source_dir, entry['source']), 'rb') as f:
+            member = gzip_member(tar_member(entry['path'], f.read(), int(entry['mode'], 8)))
+        self.write_atomic(path, member)
+        return member, True
+
+    def build(self):
+        """
+        Build the archive, reusing it outright if an identical one exists and reusing cached members otherwise
+
+        :return: (archive name, local path, list of files that had to be recompressed)
+        """
+        manifest = self.manifest()
+        name = 'app-assets-{}.tar.gz'.format(self.bundle_id(manifest))
+        path = os.path.join(self.build_dir, name)
+        if os.path.exists(path):
+            return name, path, []
+
+        members = []
+        rebuilt = []
+        for entry in manifest:
+            member, built = self.member(entry)
+            members.append(member)
+            if built:
+                rebuilt.append(entry['path'])
+        # End of archive marker
+        members.append(gzip_member(b'\0' * tarfile.BLOCKSIZE * 2))
+        self.write_atomic(path, b''.join(members))
+        return name, path, rebuilt
+
+    def publish(self, store):
+        """
+        Build the archive and upload it, if the store doesn't already have it
+
+        :param store: S3ObjectStore
+        :return: URL of the archive
+        """
+        name, path, rebuilt = self.build()
+        if rebuilt:
+            print("Asset bundle {} rebuilt ({})".format(name, ', '.join(rebuilt)))
+        return store.put(name, path)
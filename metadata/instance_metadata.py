@@ -2,55 +2,188 @@ from troposphere import Base64, Join
 import os
 
 
-def generate_app_server_userdata(stack_name, region):
-    return Base64(Join('', ["""#!/bin/bash
-/usr/bin/easy_install --script-dir /opt/aws/bin https://s3.amazonaws.com/cloudformation-examples/aws-cfn-bootstrap-latest.tar.gz
-/opt/aws/bin/cfn-init --resource AppServerLaunchConfig --stack """, stack_name, """ --region """, region,
-"""
-rpm -Uvh https://dl.fedoraproject.org/pub/epel/epel-release-latest-7.noarch.rpm
+APP_ENGINES = ('flask', 'asyncio')
+# 'install' fetches packages on every boot, 'prebaked' installs a runtime archive built ahead of time
+APP_RUNTIMES = ('install', 'prebaked')
+# Where prebaked runtimes are unpacked on the instances
+RUNTIME_DIR = '/opt/simple_web_app/runtime'
+
+ENGINE_RUNTIME_INSTALL = {
+    'flask': """rpm -Uvh https://dl.fedoraproject.org/pub/epel/epel-release-latest-7.noarch.rpm
 yum install -y python-pip
 pip install flask
-systemctl enable simple_web_app
-/opt/aws/bin/cfn-signal -e 0 --resource AppServerASG --stack """, stack_name,
+pip install brotli || true
+""",
+    'asyncio': """yum install -y python3
+pip3 install brotli || true
+""",
+}
+
+# Files shipped to the app servers: (file in files/, path on the instance, mode)
+APP_SERVER_FILES = (
+    ('simple_web_app.py', '/etc/simple_web_app.py', '000644'),
+    ('simple_web_app_static.py', '/etc/simple_web_app_static.py', '000644'),
+    ('simple_web_app_metrics.py', '/etc/simple_web_app_metrics.py', '000644'),
+    ('simple_web_app_cache.py', '/etc/simple_web_app_cache.py', '000644'),
+    ('simple_web_app_prefork.py', '/etc/simple_web_app_prefork.py', '000644'),
+    ('simple_web_app_async.py', '/etc/simple_web_app_async.py', '000644'),
+    ('simple_web_app.sh', '/etc/simple_web_app.sh', '000750'),
+    ('index.html', '/etc/static/index.html', '000644'),
+    ('simple_web_app.service', '/etc/systemd/system/simple_web_app.service', '000644'),
+)
+# Files only one engine runs - the other engine's are left off its servers
+ENGINE_FILES = {
+    'flask': ('simple_web_app.py',),
+    'asyncio': ('simple_web_app_async.py',),
+}
+# Only shipped to flask apps with a cache tier; without it the flask app's cache helper just calls the loader
+CACHE_FILE = 'simple_web_app_cache.py'
+
+
+def app_server_files(engine='flask', cache=False):
+    """
+    :param engine: App engine to run - 'flask' or 'asyncio'
+    :param cache: Whether the app has a cache tier
+    :return: The entries of APP_SERVER_FILES the app servers need
+    """
+    skipped = set(name for other, names in ENGINE_FILES.items() if other != engine for name in names)
+    if not cache or engine != 'flask':
+        skipped.add(CACHE_FILE)
+    return tuple(entry for entry in APP_SERVER_FILES if entry[0] not in skipped)
+
+
+def generate_runtime_install(runtime):
+    """
+    Userdata commands that install a prebaked runtime (see metadata.runtime_bundle) instead of fetching packages from
+    EPEL and PyPI. Nothing is downloaded if the AMI was baked with the same runtime.
+
+    :param runtime: Dict with the runtime archive's 'url', 'sha256' and 'id'
+    :return: Shell commands
+    """
+    return """if [ ! -e {dir}/.installed-{id} ]; then
+curl -sSf -o /tmp/runtime.tar.gz {url} && \\
+echo "{sha256}  /tmp/runtime.tar.gz" | sha256sum -c && \\
+mkdir -p {dir} && tar xzf /tmp/runtime.tar.gz -C {dir} && \\
+{dir}/install.sh
+rm -f /tmp/runtime.tar.gz
+fi
+""".format(dir=RUNTIME_DIR, **runtime)
+
+
+def generate_app_server_userdata(stack_name, region, engine='flask', runtime=None, resource='AppServerLaunchConfig',
+                                 signal_resource='AppServerASG'):
+    """
+    Generate the app servers' userdata
+
+    :param stack_name: Name of the stack the instances belong to, eg. Ref('AWS::StackName')
+    :param region: Region the stack is in
+    :param engine: App engine to install a runtime for - 'flask' or 'asyncio'
+    :param runtime: Prebaked runtime to install (see generate_runtime_install) - None to install from the network
+    :param resource: Logical name of the resource holding the cfn-init metadata (launch configuration or template)
+    :param signal_resource: Logical name of the ASG to signal once the instance is ready
+    :return: Base64 encoded userdata
+    """
+    runtime_install = generate_runtime_install(runtime) if runtime else ENGINE_RUNTIME_INSTALL[engine]
+    return Base64(Join('', ["""#!/bin/bash
+[ -x /opt/aws/bin/cfn-init ] || /usr/bin/easy_install --script-dir /opt/aws/bin https://s3.amazonaws.com/cloudformation-examples/aws-cfn-bootstrap-latest.tar.gz
+/opt/aws/bin/cfn-init --resource {} --stack """.format(resource), stack_name, """ --region """, region,
+"""
+""", runtime_install, """systemctl enable simple_web_app
+/opt/aws/bin/cfn-signal -e 0 --resource {} --stack """.format(signal_resource), stack_name,
 " --region ", region,
 """
 systemctl start simple_web_app
 """]))
 
 
-def generate_app_server_metadata():
+def files_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files')
+
+
+def read_file(name):
+    """
+    Read one of the files shipped in files/
+
+    :param name: File name, relative to files/
+    :return: File contents
+    """
+    with open(os.path.join(files_dir(), name), 'r') as f:
+        return f.read()
+
+
+def file_entry(content, mode='000644'):
+    return {
+        'content': content,
+        'mode': mode,
+        'owner': 'root',
+        'group': 'root'
+    }
+
+
+def generate_app_server_environment(engine='flask', dev_server=False, workers=0, backlog=128, max_requests=10000,
+                                    keep_alive=None, cache_endpoint=None):
+    """
+    Render the app server's environment file (read by simple_web_app.service)
+
+    :param engine: App engine to run - 'flask' or 'asyncio'
+    :param dev_server: Run the Flask development server instead of the pre-fork server (flask engine only)
+    :param workers: Number of worker processes (0 = one per core)
+    :param backlog: Accept queue length per worker
+    :param max_requests: Recycle workers after this many requests (0 = never)
+    :param keep_alive: Seconds to keep idle connections open (asyncio engine only, default: the engine's own)
+    :param cache_endpoint: (host, port) of the Redis cache, eg. GetAtts of a replication group (flask engine only)
+    :return: Environment file contents - a Join if cache_endpoint needs resolving by CloudFormation
+    """
+    settings = [
+        ('SIMPLE_WEB_APP_ENGINE', engine),
+        ('SIMPLE_WEB_APP_SERVER', 'dev' if dev_server else 'prefork'),
+        ('SIMPLE_WEB_APP_WORKERS', workers),
+        ('SIMPLE_WEB_APP_BACKLOG', backlog),
+        ('SIMPLE_WEB_APP_MAX_REQUESTS', max_requests),
+    ]
+    if keep_alive:
+        settings.append(('SIMPLE_WEB_APP_KEEPALIVE', keep_alive))
+    environment = ''.join('{}={}\n'.format(key, value) for key, value in settings)
+    if cache_endpoint:
+        host, port = cache_endpoint
+        return Join('', [environment, 'SIMPLE_WEB_APP_CACHE_HOST=', host, '\nSIMPLE_WEB_APP_CACHE_PORT=', port, '\n'])
+    return environment
+
+
+def generate_app_server_metadata(engine='flask', dev_server=False, workers=0, backlog=128, max_requests=10000,
+                                 bundle_url=None, keep_alive=None, cache_endpoint=None):
+    """
+    Generate the cfn-init metadata for the app servers
+
+    :param engine: App engine to run - 'flask' or 'asyncio'
+    :param dev_server: Run the Flask development server instead of the pre-fork server (flask engine only)
+    :param workers: Number of worker processes (0 = one per core)
+    :param backlog: Accept queue length per worker
+    :param max_requests: Recycle workers after this many requests (0 = never)
+    :param bundle_url: URL of an asset bundle (see metadata.asset_bundle) to unpack instead of inlining the files
+    :param keep_alive: Seconds to keep idle connections open (asyncio engine only, default: the engine's own)
+    :param cache_endpoint: (host, port) of the Redis cache (flask engine only)
+    :return: Metadata dictionary
+    """
+    files = {
+        '/etc/sysconfig/simple_web_app': file_entry(generate_app_server_environment(engine=engine,
+                                                                                    dev_server=dev_server,
+                                                                                    workers=workers,
+                                                                                    backlog=backlog,
+                                                                                    max_requests=max_requests,
+                                                                                    keep_alive=keep_alive,
+                                                                                    cache_endpoint=cache_endpoint))
+    }
+    sources = {}
+    if bundle_url:
+        # Archive paths are relative to /
+        sources['/'] = bundle_url
+    else:
+        for name, target, mode in app_server_files(engine, cache=bool(cache_endpoint)):
+            files[target] = file_entry(read_file(name), mode)
     return {
             'packages': {},
-            'sources': {},
-            'files': {
-                '/etc/simple_web_app.py': {
-                    'content': open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                                                 '../files/simple_web_app.py'), 'r').read(),
-                    'mode': '000644',
-                    'owner': 'root',
-                    'group': 'root'
-                },
-                '/etc/simple_web_app.sh': {
-                    'content': open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                                                 '../files/simple_web_app.sh'), 'r').read(),
-                    'mode': '000750',
-                    'owner': 'root',
-                    'group': 'root'
-                },
-                '/etc/static/index.html': {
-                    'content': open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                                                 '../files/index.html'), 'r').read(),
-                    'mode': '000644',
-                    'owner': 'root',
-                    'group': 'root'
-                },
-                '/etc/systemd/system/simple_web_app.service': {
-                    'content': open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                                                 '../files/simple_web_app.service'), 'r').read(),
-                    'mode': '000644',
-                    'owner': 'root',
-                    'group': 'root'
-                }
-            },
+            'sources': sources,
+            'files': files,
             'commands': {}
         }
@@ -0,0 +1,194 @@
+"""
+Prebaked app server runtimes. Instead of installing EPEL, pip and Flask from the network on every boot, the Python
+packages for an engine are downloaded once at build time into a wheelhouse, locked by sha256, and packed into a
+content-addressed archive. Instances fetch that one archive and install it with pip --no-index, or skip even that on
+an AMI built from the generated Packer recipe.
+"""
+from metadata.asset_bundle import tar_member, gzip_member, file_digest
+from metadata.instance_metadata import RUNTIME_DIR
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+DEFAULT_BUILD_DIR = os.path.join(os.path.expanduser('~'), '.simple_web_app', 'build')
+PLATFORMS = ('manylinux2014_x86_64', 'manylinux1_x86_64', 'linux_x86_64')
+
+# Complete, pinned dependency closures (wheels are fetched with --no-deps) for the interpreter each engine runs under
+# on CentOS 7
+ENGINE_RUNTIMES = {
+    'flask': {
+        'python': '/bin/python',
+        'python_version': '2.7',
+        'abi': 'cp27mu',
+        'requirements': ('pip==20.3.4', 'setuptools==44.1.1', 'flask==1.1.4', 'werkzeug==1.0.1', 'jinja2==2.11.3',
+                         'markupsafe==1.1.1', 'itsdangerous==1.1.0', 'click==7.1.2', 'brotli==1.0.9'),
+        'system_packages': (),
+    },
+    'asyncio': {
+        'python': '/bin/python3',
+        'python_version': '3.6',
+        'abi': 'cp36m',
+        'requirements': ('pip==21.3.1', 'brotli==1.0.9'),
+        # The interpreter itself can't come from a wheelhouse - bake it into the AMI to avoid yum at boot
+        'system_packages': ('python3',),
+    },
+}
+
+
+def wheel_requirement(filename, digest):
+    """
+    Pinned requirement line for a wheel, eg. 'flask==1.1.4 --hash=sha256:...'
+    """
+    name, version = filename.split('-')[:2]
+    return '{}=={} --hash=sha256:{}'.format(name.lower().replace('_', '-'), version, digest)
+
+
+class RuntimeBundle(object):
+    def __init__(self, engine='flask', build_dir=None):
+        """
+        :param engine: App engine the runtime is for - 'flask' or 'asyncio'
+        :param build_dir: Directory for wheelhouses and archives (default: $SIMPLE_WEB_APP_BUILD_DIR or
+                          ~/.simple_web_app/build)
+        """
+        self.engine = engine
+        self.runtime = ENGINE_RUNTIMES[engine]
+        self.build_dir = build_dir or os.environ.get('SIMPLE_WEB_APP_BUILD_DIR', DEFAULT_BUILD_DIR)
+
+    def spec_id(self):
+        """
+        Hash of everything that decides which wheels are downloaded
+        """
+        spec = dict(self.runtime, engine=self.engine, platforms=PLATFORMS)
+        return hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:24]
+
+    def download(self, dest):
+        """
+        Download the engine's wheels for the instances' platform and interpreter (not the local one)
+
+        :param dest: Directory to download into
+        """
+        command = [sys.executable, '-m', 'pip', 'download', '--quiet', '--no-deps', '--only-binary=:all:',
+                   '--dest', dest, '--implementation', 'cp', '--python-version', self.runtime['python_version'],
+                   '--abi', self.runtime['abi']]
+        for platform in PLATFORMS:
+            command += ['--platform', platform]
+        subprocess.check_call(command + list(self.runtime['requirements']))
+
+    def install_script(self, runtime_id):
+        """
+        Script run on the instance (or while baking an AMI) to install the unpacked runtime without network access
+        to PyPI
+        """
+        python = self.runtime['python']
+        lines = ['#!/bin/bash', 'set -e', 'cd "$(dirname "$0")"']
+        for package in self.runtime['system_packages']:
+            lines.append('rpm -q {0} >/dev/null || yum install -y {0}'.format(package))
+        # pip runs straight from its own wheel, so it doesn't need installing first
+        pip_wheel = '$(ls wheelhouse/pip-*.whl)'
+        lines += [
+            '{} {}/pip install --no-index --find-links wheelhouse --require-hashes -r requirements.lock'.format(
+                python, pip_wheel),
+            'touch {}/.installed-{}'.format(RUNTIME_DIR, runtime_id),
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def build(self):
+        """
+        Build the runtime archive for the engine, unless it was built before
+
+        :return: Dict with the archive's 'name', local 'path', 'sha256' and runtime 'id'
+        """
+        if not os.path.isdir(self.build_dir):
+            os.makedirs(self.build_dir)
+        index_path = os.path.join(self.build_dir, 'runtime-{}-{}.json'.format(self.engine, self.spec_id()))
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                built = json.load(f)
+            if os.path.exists(built['path']):
+                return built
+
+        wheelhouse = tempfile.mkdtemp(dir=self.build_dir)
+        try:
+            self.download(wheelhouse)
+            wheels = sorted(os.listdir(wheelhouse))
+            lock = ''.join(wheel_requirement(wheel, file_digest(os.path.join(wheelhouse, wheel))) + '\n'
+                           for wheel in wheels)
+            runtime_id = hashlib.sha256('{}\n{}'.format(self.engine, lock).encode('utf-8')).hexdigest()[:24]
+            members = []
+            for wheel in wheels:
+                with open(os.path.join(wheelhouse, wheel), 'rb') as f:
+                    members.append(tar_member('wheelhouse/' + wheel, f.read(), 0o644))
+            members.append(tar_member('requirements.lock', lock.encode('utf-8'), 0o644))
+            members.append(tar_member('install.sh', self.install_script(runtime_id).encode('utf-8'), 0o755))
+            members.append(b'\0' * 1024)
+        finally:
+            shutil.rmtree(wheelhouse)
+
+        name = 'runtime-{}-{}.tar.gz'.format(self.engine, runtime_id)
+        path = os.path.join(self.build_dir, name)
+        data = gzip_member(b''.join(members))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+        built = {'name': name, 'path': path, 'sha256': hashlib.sha256(data).hexdigest(), 'id': runtime_id}
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(built, f, sort_keys=True)
+        os.rename(index_path + '.tmp', index_path)
+        return built
+
+    def publish(self, store):
+        """
+        Build the runtime and upload it, if the store doesn't already have it
+
+        :param store: S3ObjectStore
+        :return: Dict with the archive's 'url', 'sha256' and runtime 'id'
+        """
+        built = self.build()
+        return {'url': store.put(built['name'], built['path']), 'sha256': built['sha256'], 'id': built['id']}
+
+    def packer_recipe(self, source_ami, region, instance_type='t2.micro', ssh_username='centos'):
+        """
+        Packer template for an AMI with the runtime and cfn-bootstrap already installed. Instances launched from it
+        find the runtime's marker file and skip the download at boot entirely.
+
+        :param source_ami: Base AMI to bake from
+        :param region: Region to build the AMI in
+        :param instance_type: Instance type for the build
+        :param ssh_username: Login user of the base AMI
+        :return: Packer template dict (write it out as JSON)
+        """
+        built = self.build()
+        return {
+            'builders': [{
+                'type': 'amazon-ebs',
+                'region': region,
+                'source_ami': source_ami,
+                'instance_type': instance_type,
+                'ssh_username': ssh_username,
+                'ami_name': 'simple-web-app-{}-{}'.format(self.engine, built['id']),
+                'tags': {'Name': 'simple-web-app-{}'.format(self.engine), 'RuntimeId': built['id']},
+            }],
+            'provisioners': [
+                {
+                    'type': 'file',
+                    'source': built['path'],
+                    'destination': '/tmp/runtime.tar.gz',
+                },
+                {
+                    'type': 'shell',
+                    'execute_command': "sudo -S sh -c '{{ .Vars }} {{ .Path }}'",
+                    'inline': [
+                        'echo "{}  /tmp/runtime.tar.gz" | sha256sum -c'.format(built['sha256']),
+                        'mkdir -p {0} && tar xzf /tmp/runtime.tar.gz -C {0}'.format(RUNTIME_DIR),
+                        '{}/install.sh'.format(RUNTIME_DIR),
+                        '/usr/bin/easy_install --script-dir /opt/aws/bin '
+                        'https://s3.amazonaws.com/cloudformation-examples/aws-cfn-bootstrap-latest.tar.gz',
+                        'rm -f /tmp/runtime.tar.gz',
+                    ],
+                },
+            ],
+        }
@@ -0,0 +1,189 @@
+from base.lazy_import import lazy_import
+from troposphere import Export, Output, Ref, Sub, GetAtt
+
+cloudfront = lazy_import('troposphere.cloudfront')
+
+# Origin Shield runs in a subset of regions - the recommended shield region for each origin region
+ORIGIN_SHIELD_REGIONS = {
+    'us-east-1': 'us-east-1',
+    'us-east-2': 'us-east-2',
+    'us-west-1': 'us-west-2',
+    'us-west-2': 'us-west-2',
+    'ca-central-1': 'us-east-1',
+    'sa-east-1': 'sa-east-1',
+    'eu-west-1': 'eu-west-1',
+    'eu-west-2': 'eu-west-2',
+    'eu-west-3': 'eu-west-2',
+    'eu-central-1': 'eu-central-1',
+    'eu-north-1': 'eu-west-2',
+    'eu-south-1': 'eu-central-1',
+    'af-south-1': 'eu-west-1',
+    'me-south-1': 'ap-south-1',
+    'ap-south-1': 'ap-south-1',
+    'ap-east-1': 'ap-southeast-1',
+    'ap-southeast-1': 'ap-southeast-1',
+    'ap-southeast-2': 'ap-southeast-2',
+    'ap-northeast-1': 'ap-northeast-1',
+    'ap-northeast-2': 'ap-northeast-2',
+    'ap-northeast-3': 'ap-northeast-1',
+}
+
+
+class Cdn(object):
+    def add_cache_policy(self, name, default_ttl=86400, min_ttl=0, max_ttl=31536000, headers=(), query_strings=(),
+                         compress=True):
+        """
+        Create a CloudFront cache policy. Cookies never form part of the cache key.
+
+        :param name: Name of the policy resource
+        :param default_ttl: Seconds to cache responses that don't send Cache-Control/Expires
+        :param min_ttl: Minimum seconds to cache for - keep at 0 so that origin no-store/no-cache responses aren't cached
+        :param max_ttl: Maximum seconds to cache for, whatever the origin asks for
+        :param headers: Request headers to include in the cache key (and so forward to the origin)
+        :param query_strings: Query string parameters to include in the cache key
+        :param compress: Cache gzip and brotli responses separately, keyed on a normalised Accept-Encoding
+        :return: Cache policy CFN object
+        """
+        # CloudFront rejects Accept-Encoding keys on a policy that never caches anything
+        compress = compress and max_ttl > 0
+        policy = self.template.add_resource(cloudfront.CachePolicy(
+            name,
+            CachePolicyConfig=cloudfront.CachePolicyConfig(
+                Name=Sub('${AWS::StackName}-' + name),
+                DefaultTTL=default_ttl,
+                MinTTL=min_ttl,
+                MaxTTL=max_ttl,
+                ParametersInCacheKeyAndForwardedToOrigin=cloudfront.ParametersInCacheKeyAndForwardedToOrigin(
+                    CookiesConfig=cloudfront.CacheCookiesConfig(CookieBehavior='none'),
+                    HeadersConfig=cloudfront.CacheHeadersConfig(HeaderBehavior='whitelist', Headers=list(headers))
+                    if headers else cloudfront.CacheHeadersConfig(HeaderBehavior='none'),
+                    QueryStringsConfig=cloudfront.CacheQueryStringsConfig(QueryStringBehavior='whitelist',
+                                                                          QueryStrings=list(query_strings))
+                    if query_strings else cloudfront.CacheQueryStringsConfig(QueryStringBehavior='none'),
+                    EnableAcceptEncodingGzip=compress,
+                    EnableAcceptEncodingBrotli=compress
+                )
+            )
+        ))
+        return policy
+
+    def add_origin_request_policy(self, name, headers=(), query_strings=False, cookies=False):
+        """
+        Create a CloudFront origin request policy, for values to forward to the origin without adding them to the
+        cache key. Anything in the cache policy's key is forwarded regardless.
+
+        :param name: Name of the policy resource
+        :param headers: Extra request headers to forward
+        :param query_strings: Forward all query strings
+        :param cookies: Forward all cookies
+        :return: Origin request policy CFN object
+        """
+        return self.template.add_resource(cloudfront.OriginRequestPolicy(
+            name,
+            OriginRequestPolicyConfig=cloudfront.OriginRequestPolicyConfig(
+                Name=Sub('${AWS::StackName}-' + name),
+                CookiesConfig=cloudfront.OriginRequestCookiesConfig(CookieBehavior='all' if cookies else 'none'),
+                HeadersConfig=cloudfront.OriginRequestHeadersConfig(HeaderBehavior='whitelist', Headers=list(headers))
+                if headers else cloudfront.OriginRequestHeadersConfig(HeaderBehavior='none'),
+                QueryStringsConfig=cloudfront.OriginRequestQueryStringsConfig(
+                    QueryStringBehavior='all' if query_strings else 'none')
+            )
+        ))
+
+    def cdn_cache_behavior(self, path_pattern, origin_id, cache_policy, origin_request_policy=None, compress=True,
+                           methods=('GET', 'HEAD')):
+        """
+        Create a cache behaviour for a path pattern, eg. to keep some paths out of the cache
+
+        :param path_pattern: Path pattern, eg. '/metrics' or '/img/*'
+        :param origin_id: Id of the origin to send matching requests to
+        :param cache_policy: Name of the cache policy resource
+        :param origin_request_policy: Name of the origin request policy resource (optional)
+        :param compress: Let CloudFront compress responses the origin sent uncompressed
+        :param methods: Allowed (and cached) HTTP methods
+        :return: Cache behaviour CFN object
+        """
+        behavior = cloudfront.CacheBehavior(
+            PathPattern=path_pattern,
+            TargetOriginId=origin_id,
+            CachePolicyId=Ref(cache_policy),
+            ViewerProtocolPolicy='redirect-to-https',
+            Compress=compress,
+            AllowedMethods=list(methods),
+            CachedMethods=list(methods)
+        )
+        if origin_request_policy:
+            behavior.OriginRequestPolicyId = Ref(origin_request_policy)
+        return behavior
+
+    def add_cloudfront_distribution(self, name, origin_domain, cache_policy, origin_request_policy=None,
+                                    origin_shield_region=None, behaviors=(), origin_id='Origin', origin_port=80,
+                                    origin_keepalive=30, price_class='PriceClass_100', comment=''):
+        """
+        Create a CloudFront distribution in front of an HTTP origin (eg. an ALB). Viewers are redirected to HTTPS on
+        the distribution's default certificate, and served over HTTP/2 or HTTP/3.
+
+        :param name: Name for the distribution
+        :param origin_domain: DNS name of the origin
+        :param cache_policy: Name of the cache policy resource for the default behaviour
+        :param origin_request_policy: Name of the origin request policy resource for the default behaviour
+        :param origin_shield_region: Region to run Origin Shield in, so all edge locations fill from one regional
+                                     cache rather than each going to the origin (None = no Origin Shield)
+        :param behaviors: Additional cache behaviours (see cdn_cache_behavior)
+        :param origin_id: Id for the origin
+        :param origin_port: HTTP port of the origin
+        :param origin_keepalive: Seconds CloudFront keeps idle origin connections open - keep it below the origin's
+                                 idle timeout
+        :param price_class: Edge locations to use - PriceClass_100, PriceClass_200 or PriceClass_All
+        :param comment: Description of the distribution
+        :return: Distribution CFN object
+        """
+        origin = cloudfront.Origin(
+            Id=origin_id,
+            DomainName=origin_domain,
+            CustomOriginConfig=cloudfront.CustomOriginConfig(
+                HTTPPort=origin_port,
+                OriginProtocolPolicy='http-only',
+                OriginKeepaliveTimeout=origin_keepalive,
+                OriginReadTimeout=30
+            )
+        )
+        if origin_shield_region:
+            origin.OriginShield = cloudfront.OriginShield(Enabled=True, OriginShieldRegion=origin_shield_region)
+
+        default_behavior = cloudfront.DefaultCacheBehavior(
+            TargetOriginId=origin_id,
+            CachePolicyId=Ref(cache_policy),
+            ViewerProtocolPolicy='redirect-to-https',
+            Compress=True,
+            AllowedMethods=['GET', 'HEAD'],
+            CachedMethods=['GET', 'HEAD']
+        )
+        if origin_request_policy:
+            default_behavior.OriginRequestPolicyId = Ref(origin_request_policy)
+
+        config = cloudfront.DistributionConfig(
+            Enabled=True,
+            Comment=comment,
+            Origins=[origin],
+            DefaultCacheBehavior=default_behavior,
+            HttpVersion='http2and3',
+            IPV6Enabled=True,
+            PriceClass=price_class
+        )
+        if behaviors:
+            config.CacheBehaviors = list(behaviors)
+
+        distribution = self.template.add_resource(cloudfront.Distribution(
+            name,
+            DistributionConfig=config,
+            Tags=[{'Key': 'Name', 'Value': name}]
+        ))
+
+        self.template.add_output(Output(
+            name + "DNS",
+            Value=GetAtt(name, "DomainName"),
+            Description=u"CloudFront DNS Name.",
+            Export=Export(Sub("${AWS::StackName}-" + name + "DNS"))
+        ))
+        return distribution
@@ -1,7 +1,314 @@
-from troposphere import ec2, Export, Output, Ref, Sub, Join, GetAtt
-from troposphere.autoscaling import AutoScalingGroup, LaunchConfiguration
-from troposphere.policies import UpdatePolicy, AutoScalingRollingUpdate
-import troposphere.elasticloadbalancingv2 as elbv2
+from base.bulk_resources import add_objects, build_objects, spec_rows
+from base.lazy_import import lazy_import
+from troposphere import Export, Output, Ref, Sub, Join, GetAtt, encode_to_dict
+from collections import OrderedDict
+import functools
+import ipaddress
+import json
+import math
+
+ec2 = lazy_import('troposphere.ec2')
+autoscaling = lazy_import('troposphere.autoscaling')
+cloudwatch = lazy_import('troposphere.cloudwatch')
+policies = lazy_import('troposphere.policies')
+elbv2 = lazy_import('troposphere.elasticloadbalancingv2')
+
+
+class Elbv2Profile(object):
+    ROUTING_ALGORITHMS = ('round_robin', 'least_outstanding_requests')
+
+    def __init__(self, name, routing_algorithm='round_robin', slow_start=0, deregistration_delay=300,
+                 idle_timeout=60, http2=True, client_keep_alive=3600, health_check_interval=30,
+                 health_check_timeout=5, healthy_threshold=5, unhealthy_threshold=2):
+        """
+        A validated set of ALB and target group performance settings, applied together. The defaults are AWS's own.
+
+        :param name: Profile name
+        :param routing_algorithm: round_robin, or least_outstanding_requests to favour the least busy target
+        :param slow_start: Seconds over which a new target's share of traffic ramps up (0 = off, otherwise 30-900).
+                           ALBs only support slow start with round robin routing
+        :param deregistration_delay: Seconds to let in-flight requests drain from a deregistering target (0-3600)
+        :param idle_timeout: Seconds a client or target connection may sit idle before the ALB closes it (1-4000)
+        :param http2: Accept HTTP/2 from clients
+        :param client_keep_alive: Seconds a client connection is kept open for reuse, however busy (60-604800)
+        :param health_check_interval: Seconds between health checks (5-300)
+        :param health_check_timeout: Seconds to wait for a health check response (2-120, less than the interval)
+        :param healthy_threshold: Passed checks before a target receives traffic (2-10)
+        :param unhealthy_threshold: Failed checks before a target stops receiving traffic (2-10)
+        """
+        if routing_algorithm not in self.ROUTING_ALGORITHMS:
+            raise ValueError('Profile {}: unknown routing algorithm {} (expected one of {})'.format(
+                name, routing_algorithm, ', '.join(self.ROUTING_ALGORITHMS)))
+        for setting, value, low, high in (('slow_start', slow_start, 0, 900),
+                                          ('deregistration_delay', deregistration_delay, 0, 3600),
+                                          ('idle_timeout', idle_timeout, 1, 4000),
+                                          ('client_keep_alive', client_keep_alive, 60, 604800),
+                                          ('health_check_interval', health_check_interval, 5, 300),
+                                          ('health_check_timeout', health_check_timeout, 2, 120),
+                                          ('healthy_threshold', healthy_threshold, 2, 10),
+                                          ('unhealthy_threshold', unhealthy_threshold, 2, 10)):
+            if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+                raise ValueError('Profile {}: {} must be a whole number from {} to {}, got {!r}'.format(
+                    name, setting, low, high, value))
+        if 0 < slow_start < 30:
+            raise ValueError('Profile {}: slow_start must be 0 (off) or at least 30, got {}'.format(name, slow_start))
+        if slow_start and routing_algorithm != 'round_robin':
+            raise ValueError('Profile {}: slow_start needs round_robin routing'.format(name))
+        if health_check_timeout >= health_check_interval:
+            raise ValueError('Profile {}: health_check_timeout must be less than health_check_interval'.format(name))
+        self.name = name
+        self.routing_algorithm = routing_algorithm
+        self.slow_start = slow_start
+        self.deregistration_delay = deregistration_delay
+        self.idle_timeout = idle_timeout
+        self.http2 = bool(http2)
+        self.client_keep_alive = client_keep_alive
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.healthy_threshold = healthy_threshold
+        self.unhealthy_threshold = unhealthy_threshold
+
+    def lb_attributes(self):
+        """
+        :return: Load balancer attributes, in the form create_elbv2 takes
+        """
+        return [
+            {'key': 'idle_timeout.timeout_seconds', 'value': str(self.idle_timeout)},
+            {'key': 'routing.http2.enabled', 'value': str(self.http2).lower()},
+            {'key': 'client_keep_alive.seconds', 'value': str(self.client_keep_alive)},
+        ]
+
+    def target_group_attributes(self):
+        """
+        :return: Target group attributes, in the form elbv2_target_group takes
+        """
+        return [
+            {'key': 'load_balancing.algorithm.type', 'value': self.routing_algorithm},
+            {'key': 'slow_start.duration_seconds', 'value': str(self.slow_start)},
+            {'key': 'deregistration_delay.timeout_seconds', 'value': str(self.deregistration_delay)},
+        ]
+
+    def health_check_details(self):
+        """
+        :return: Health check timings, with the keys elbv2_health_check_info uses
+        """
+        return {
+            'health_check_interval': self.health_check_interval,
+            'health_check_timeout': self.health_check_timeout,
+            'healthy_threshold': self.healthy_threshold,
+            'unhealthy_threshold': self.unhealthy_threshold,
+        }
+
+
+# Named performance profiles for create_elbv2 and elbv2_target_group
+ELBV2_PROFILES = {
+    # Send each request to the least busy server, drain quickly and react to failures within ~20s
+    'low-latency': Elbv2Profile(
+        'low-latency',
+        routing_algorithm='least_outstanding_requests',
+        deregistration_delay=30,
+        health_check_interval=10,
+        health_check_timeout=5,
+        healthy_threshold=2,
+        unhealthy_threshold=2
+    ),
+    # Reuse long-lived connections, and ramp new servers up gently so a scale-out doesn't swamp cold instances
+    'high-throughput': Elbv2Profile(
+        'high-throughput',
+        routing_algorithm='round_robin',
+        slow_start=60,
+        deregistration_delay=120,
+        idle_timeout=300,
+        client_keep_alive=7200,
+        health_check_interval=15,
+        health_check_timeout=5,
+        healthy_threshold=3,
+        unhealthy_threshold=3
+    ),
+}
+
+
+# Columns of add_target_groups' spec table, and the values of those a row may leave out
+TARGET_GROUP_COLUMNS = ('name', 'protocol', 'port', 'vpc_id', 'health_check_details', 'matcher',
+                        'target_group_attributes', 'targets', 'profile')
+TARGET_GROUP_DEFAULTS = {
+    'health_check_details': {},
+    'matcher': None,
+    'target_group_attributes': False,
+    'targets': [],
+    'profile': None,
+}
+
+SECURITY_GROUP_PROTOCOLS = ('tcp', 'udp', 'icmp')
+# Kinds of rule source (or destination, for egress) -> the rule property that holds it
+SECURITY_GROUP_RULE_PROPERTIES = {
+    'ingress': {'cidr': 'CidrIp', 'cidr6': 'CidrIpv6', 'prefix_list': 'SourcePrefixListId',
+                'security_group': 'SourceSecurityGroupId'},
+    'egress': {'cidr': 'CidrIp', 'cidr6': 'CidrIpv6', 'prefix_list': 'DestinationPrefixListId',
+               'security_group': 'DestinationSecurityGroupId'},
+}
+# Inline egress rule allowing only localhost. CloudFormation keeps the default allow-all egress on a SG with no inline
+# egress rules, so this stands in when all of a SG's egress rules are resources of their own.
+SECURITY_GROUP_NO_EGRESS = {'IpProtocol': '-1', 'CidrIp': '127.0.0.1/32'}
+
+
+def security_group_rule_source(source):
+    """
+    Work out what kind of source a security group dict rule has
+
+    :param source: A CIDR ('10.0.0.0/16', '::/0' or a Join), a managed prefix list id ('pl-...'), a security group
+                   (Ref, GetAtt or 'sg-...'), or an explicit {kind: value} (eg. {'prefix_list': Ref('Prefixes')})
+    :return: Tuple of kind ('cidr', 'cidr6', 'prefix_list' or 'security_group') and value
+    """
+    if isinstance(source, dict) and len(source) == 1 and list(source)[0] in SECURITY_GROUP_RULE_PROPERTIES['ingress']:
+        return list(source.items())[0]
+    if isinstance(source, str):
+        if source.startswith('pl-'):
+            return 'prefix_list', source
+        if source.startswith('sg-'):
+            return 'security_group', source
+        return ('cidr6' if ':' in source else 'cidr'), source
+    if isinstance(source, Join):
+        return 'cidr', source
+    return 'security_group', source
+
+
+def parse_port_range(protocol, port):
+    """
+    :param protocol: 'tcp', 'udp' or 'icmp'
+    :param port: For tcp/udp, a port (22 or '22'), a range ('8000-8100') or 'all'. For icmp, a type ('8'), a type and
+                 code ('3:4') or 'all'.
+    :return: Tuple of FromPort and ToPort - for icmp, the type and code (-1 = any)
+    """
+    port = str(port)
+    if protocol == 'icmp':
+        if port in ('all', '-1'):
+            return -1, -1
+        icmp_type, _, code = port.partition(':')
+        return int(icmp_type), int(code) if code else -1
+    if port == 'all':
+        return 0, 65535
+    low, _, high = port.partition('-')
+    low, high = int(low), int(high or low)
+    if not 0 <= low <= high <= 65535:
+        raise ValueError('Invalid {} port range {}'.format(protocol, port))
+    return low, high
+
+
+def merge_port_ranges(protocol, ranges):
+    """
+    Merge overlapping and adjacent port ranges, eg. 80, 81-90 and 85-443 into 80-443
+
+    :param protocol: 'tcp', 'udp' or 'icmp'
+    :param ranges: (from, to) tuples
+    :return: Sorted list of merged (from, to) tuples
+    """
+    if protocol == 'icmp':
+        ranges = set(ranges)
+        if (-1, -1) in ranges:
+            return [(-1, -1)]
+        # Any code of a type covers each of its codes
+        return sorted(r for r in ranges if r[1] == -1 or (r[0], -1) not in ranges)
+    merged = []
+    for low, high in sorted(ranges):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(high, merged[-1][1]))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+@functools.lru_cache(maxsize=None)
+def parse_network(cidr):
+    return ipaddress.ip_network(cidr, strict=False)
+
+
+def aggregate_cidrs(cidrs):
+    """
+    Collapse overlapping and adjacent CIDRs, eg. 10.0.0.0/25 and 10.0.0.128/25 into 10.0.0.0/24
+
+    :param cidrs: IPv4 or IPv6 CIDR strings (all the same version)
+    :return: List of CIDR strings
+    """
+    if len(cidrs) < 2:
+        return list(cidrs)
+    return [str(network) for network in ipaddress.collapse_addresses(parse_network(cidr) for cidr in cidrs)]
+
+
+def covers(rule, other):
+    """
+    :return: Whether rule allows everything other allows, for literal CIDR rules
+    """
+    protocol, low, high, kind, cidr = rule
+    other_protocol, other_low, other_high, other_kind, other_cidr = other
+    if (protocol, kind) != (other_protocol, other_kind) or rule == other:
+        return False
+    if protocol == 'icmp':
+        ports = (low, high) in ((-1, -1), (other_low, other_high)) or (high == -1 and low == other_low)
+    else:
+        ports = low <= other_low and other_high <= high
+    return ports and parse_network(other_cidr).subnet_of(parse_network(cidr))
+
+
+def security_group_rule_label(name, direction, protocol, from_port, to_port):
+    """
+    :return: Name prefix for a rule resource of SG name, eg. 'AppSG22', 'AppSGEgressUdp53' or 'AppSGIcmpAll'
+    """
+    if protocol == 'icmp':
+        ports = 'All' if from_port == -1 else str(from_port)
+    else:
+        ports = str(from_port) if from_port == to_port else '{}to{}'.format(from_port, to_port)
+    return '{}{}{}{}'.format(name, '' if direction == 'ingress' else 'Egress',
+                             '' if protocol == 'tcp' else protocol.capitalize(), ports)
+
+
+def compile_security_group_rules(rules):
+    """
+    Compile a security group dict's rules into as few rules as allow the same traffic: each source's ports are merged
+    into ranges, CIDRs allowed the same ports are aggregated, and CIDR rules covered by a broader rule are dropped
+
+    :param rules: Dict of protocol ('tcp', 'udp' or 'icmp') -> port (see parse_port_range) -> list of sources (see
+                  security_group_rule_source)
+    :return: List of (protocol, from_port, to_port, kind, source) tuples
+    """
+    if not rules:
+        return []
+    # (kind, source) -> protocol -> port ranges, in the order sources first appear
+    by_source = OrderedDict()
+    for protocol, ports in rules.items():
+        if protocol not in SECURITY_GROUP_PROTOCOLS:
+            raise ValueError('Unsupported security group protocol {} - expected one of {}'.format(
+                protocol, ', '.join(SECURITY_GROUP_PROTOCOLS)))
+        for port, sources in ports.items():
+            for source in sources:
+                kind, value = security_group_rule_source(source)
+                key = (kind, value if isinstance(value, str) else json.dumps(encode_to_dict(value), sort_keys=True))
+                entry = by_source.setdefault(key, {'kind': kind, 'source': value, 'ports': OrderedDict()})
+                entry['ports'].setdefault(protocol, []).append(parse_port_range(protocol, port))
+
+    # Literal CIDRs allowed exactly the same ports can be aggregated
+    groups = OrderedDict()
+    for key, entry in by_source.items():
+        ports = tuple((protocol, tuple(merge_port_ranges(protocol, ranges)))
+                      for protocol, ranges in sorted(entry['ports'].items()))
+        literal_cidr = entry['kind'] in ('cidr', 'cidr6') and isinstance(entry['source'], str)
+        groups.setdefault((entry['kind'], ports) if literal_cidr else key + (ports,), []).append(entry['source'])
+
+    compiled = []
+    for key, sources in groups.items():
+        kind, ports = key[0], key[-1]
+        if kind in ('cidr', 'cidr6') and all(isinstance(source, str) for source in sources):
+            sources = aggregate_cidrs(sources)
+        for source in sources:
+            for protocol, ranges in ports:
+                compiled += [(protocol, low, high, kind, source) for low, high in ranges]
+
+    literal = [rule for rule in compiled if rule[3] in ('cidr', 'cidr6') and isinstance(rule[4], str)]
+    kept = []
+    for rule in compiled:
+        if rule not in kept and not (len(literal) > 1 and any(covers(other, rule) for other in literal)):
+            kept.append(rule)
+    return kept
 
 
 class Ec2(object):
@@ -63,7 +370,7 @@ class Ec2(object):
         :param metadata: Any metadata, eg. files, packages etc.
         :param userdata: Any userdata
         """
-        launch_config = LaunchConfiguration(
+        launch_config = autoscaling.LaunchConfiguration(
             name,
             ImageId=image_id,
             SecurityGroups=security_groups,
@@ -79,6 +386,113 @@ class Ec2(object):
 
         self.template.add_resource(launch_config)
 
+    def add_ec2_launch_template(self,
+                                name,
+                                security_groups,
+                                keypair,
+                                image_id='ami-14913f63',
+                                instance_type='t2.micro',
+                                metadata=None,
+                                userdata=None,
+                                cpu_credits=None,
+                                ebs_optimized=False,
+                                placement_group=None,
+                                detailed_monitoring=False):
+        """
+        Create a Launch Template - the successor to Launch Configurations, needed for mixed instance types and spot
+
+        :param name: Name of the Launch Template
+        :param security_groups: SG IDs to assign to the instances
+        :param keypair: Key pair to use to launch the instances
+        :param image_id: AMI ID to spin up the instances from
+        :param instance_type: Default instance type (a mixed instances policy can override it)
+        :param metadata: Any metadata, eg. files, packages etc.
+        :param userdata: Any userdata
+        :param cpu_credits: 'unlimited' or 'standard' for T-family instances - unlimited instances are never
+                            throttled to their baseline once credits run out
+        :param ebs_optimized: Dedicated EBS bandwidth (always on for Nitro families such as c5/m5)
+        :param placement_group: Name of a placement group to launch into (see add_placement_group)
+        :param detailed_monitoring: 1-minute CloudWatch metrics, so scaling policies react faster
+        :return: Launch Template CFN object
+        """
+        data = ec2.LaunchTemplateData(
+            ImageId=image_id,
+            InstanceType=instance_type,
+            KeyName=keypair,
+            SecurityGroupIds=security_groups,
+            BlockDeviceMappings=[ec2.LaunchTemplateBlockDeviceMapping(
+                DeviceName=mapping['DeviceName'],
+                Ebs=ec2.EBSBlockDevice(DeleteOnTermination=mapping['Ebs']['DeleteOnTermination'])
+            ) for mapping in self.block_device_default],
+            EbsOptimized=ebs_optimized,
+            Monitoring=ec2.Monitoring(Enabled=detailed_monitoring)
+        )
+        if userdata:
+            data.UserData = userdata
+        if cpu_credits:
+            data.CreditSpecification = ec2.LaunchTemplateCreditSpecification(CpuCredits=cpu_credits)
+        if placement_group:
+            data.Placement = ec2.Placement(GroupName=Ref(placement_group))
+
+        launch_template = ec2.LaunchTemplate(
+            name,
+            LaunchTemplateData=data
+        )
+        if metadata:
+            launch_template.Metadata = metadata
+
+        self.template.add_resource(launch_template)
+        return launch_template
+
+    def add_placement_group(self, name, strategy='spread'):
+        """
+        Create a placement group
+
+        :param name: Name of the placement group
+        :param strategy: cluster (low latency between instances, single AZ), spread (separate hardware) or partition
+        :return: Placement group CFN object
+        """
+        placement_group = ec2.PlacementGroup(name, Strategy=strategy)
+        self.template.add_resource(placement_group)
+        return placement_group
+
+    def create_mixed_instances_policy(self,
+                                      launch_template_name,
+                                      instance_types,
+                                      on_demand_base=0,
+                                      on_demand_percentage=100,
+                                      spot_allocation_strategy='capacity-optimized'):
+        """
+        Create a mixed instances policy, letting an ASG spread capacity over several instance types and spot
+
+        :param launch_template_name: Name of the Launch Template to launch from
+        :param instance_types: List of (instance type, weight) tuples - the weight is the capacity units one instance
+                               counts for, eg. [('c5.large', 1), ('c5.xlarge', 2)]
+        :param on_demand_base: Capacity always provided by on-demand instances
+        :param on_demand_percentage: Percentage of capacity above the base that is on-demand, the rest is spot
+        :param spot_allocation_strategy: capacity-optimized (fewest interruptions) or lowest-price
+        :return: Mixed instances policy CFN object
+        """
+        return autoscaling.MixedInstancesPolicy(
+            LaunchTemplate=autoscaling.LaunchTemplate(
+                LaunchTemplateSpecification=self.launch_template_specification(launch_template_name),
+                Overrides=[autoscaling.LaunchTemplateOverrides(InstanceType=instance_type,
+                                                               WeightedCapacity=str(weight))
+                           for instance_type, weight in instance_types]
+            ),
+            InstancesDistribution=autoscaling.InstancesDistribution(
+                OnDemandBaseCapacity=on_demand_base,
+                OnDemandPercentageAboveBaseCapacity=on_demand_percentage,
+                SpotAllocationStrategy=spot_allocation_strategy
+            )
+        )
+
+    def launch_template_specification(self, launch_template_name):
+        return autoscaling.LaunchTemplateSpecification(
+            LaunchTemplateId=Ref(launch_template_name),
+            Version=GetAtt(launch_template_name, 'LatestVersionNumber')
+        )
+
     def add_autoscaling_group(self,
                               name,
                               launch_configuration_name,
@@ -87,41 +501,282 @@ class Ec2(object):
                               min_size=1,
                               max_size=2,
                               health_check_type='EC2',
-                              target_group_arns=[]):
+                              target_group_arns=[],
+                              launch_template_name=None,
+                              mixed_instances_policy=None,
+                              capacity_rebalance=False,
+                              update_policy=None,
+                              creation_policy=None):
         """
         Create Autoscaling Group
 
         :param name: Name of the ASG
-        :param launch_configuration_name: Which launch configuration to use to create instances
+        :param launch_configuration_name: Which launch configuration to use to create instances (None when using a
+                                          launch template)
         :param subnets: Subnet to spin up instances in
-        :param desired_size: Desired number of instances
+        :param desired_size: Desired number of instances - None to leave it to scaling policies, which stops every
+                             stack update from resetting the group to a fixed size
         :param min_size: Minimum number of instances
         :param max_size: Maximum number of instances
         :param health_check_type: Health check type
         :param target_group_arns: ARN of the target group(s), if any
+        :param launch_template_name: Which launch template to use to create instances, if not a launch configuration
+        :param mixed_instances_policy: Mixed instances policy (see create_mixed_instances_policy), instead of
+                                       launch_template_name
+        :param capacity_rebalance: Replace spot instances proactively when AWS signals they're at elevated risk of
+                                   interruption
+        :param update_policy: How instances are replaced on update (default: one at a time, see
+                              rolling_update_policy)
+        :param creation_policy: Signals to wait for before the group counts as created, if any
         """
-        auto_scaling_group = AutoScalingGroup(
+        auto_scaling_group = autoscaling.AutoScalingGroup(
             name,
-            DesiredCapacity=desired_size,
             Tags=[{'Key': 'Name', 'Value': name, 'PropagateAtLaunch': True}],
-            LaunchConfigurationName=Ref(launch_configuration_name),
             MinSize=min_size,
             MaxSize=max_size,
             VPCZoneIdentifier=subnets,
             HealthCheckType=health_check_type,
             HealthCheckGracePeriod=60,
             TargetGroupARNs=target_group_arns,
-            UpdatePolicy=UpdatePolicy(
-                AutoScalingRollingUpdate=AutoScalingRollingUpdate(
-                    PauseTime='PT1H',
-                    MinInstancesInService=min_size,
-                    MaxBatchSize='1',
-                    WaitOnResourceSignals=True
-                )
-            )
+            UpdatePolicy=update_policy or self.rolling_update_policy(min_in_service=min_size)
         )
+        if creation_policy:
+            auto_scaling_group.CreationPolicy = creation_policy
+        if mixed_instances_policy:
+            auto_scaling_group.MixedInstancesPolicy = mixed_instances_policy
+        elif launch_template_name:
+            auto_scaling_group.LaunchTemplate = self.launch_template_specification(launch_template_name)
+        else:
+            auto_scaling_group.LaunchConfigurationName = Ref(launch_configuration_name)
+        if capacity_rebalance:
+            auto_scaling_group.CapacityRebalance = True
+        if desired_size is not None:
+            auto_scaling_group.DesiredCapacity = desired_size
         self.template.add_resource(auto_scaling_group)
 
+    def rolling_update_policy(self, min_in_service, batch_size=1, pause_time='PT1H', min_successful_percent=None):
+        """
+        Create an update policy that replaces instances in place, a batch at a time
+
+        :param min_in_service: Instances kept in service throughout the update
+        :param batch_size: Instances replaced at once
+        :param pause_time: How long to wait for each batch's signals before giving up
+        :param min_successful_percent: Percentage of each batch that must signal success (default: all)
+        :return: Update policy CFN object
+        """
+        rolling_update = policies.AutoScalingRollingUpdate(
+            PauseTime=pause_time,
+            MinInstancesInService=min_in_service,
+            MaxBatchSize=str(batch_size),
+            WaitOnResourceSignals=True
+        )
+        if min_successful_percent is not None:
+            rolling_update.MinSuccessfulInstancesPercent = min_successful_percent
+        return policies.UpdatePolicy(AutoScalingRollingUpdate=rolling_update)
+
+    def percent_rolling_update_policy(self, min_size, max_size, batch_percent, pause_time='PT15M'):
+        """
+        Create a rolling update policy whose batch size is a percentage of the group, so large groups roll in a
+        handful of batches rather than one instance at a time
+
+        :param min_size: Group minimum size
+        :param max_size: Group maximum size
+        :param batch_percent: Percentage of the group's maximum size replaced per batch
+        :param pause_time: How long to wait for each batch's signals before giving up
+        :return: Update policy CFN object
+        """
+        batch_size = max(1, int(math.ceil(max_size * batch_percent / 100.0)))
+        # CloudFormation needs MinInstancesInService below MaxSize to have room to replace a batch
+        return self.rolling_update_policy(
+            min_in_service=max(0, min(min_size, max_size - batch_size)),
+            batch_size=batch_size,
+            pause_time=pause_time
+        )
+
+    def replacing_update_policy(self):
+        """
+        Create an update policy that builds a whole new group alongside the old one, and only deletes the old group
+        once the new one has signalled (use with signal_creation_policy). Rolling back is just deleting the new group.
+
+        :return: Update policy CFN object
+        """
+        return policies.UpdatePolicy(AutoScalingReplacingUpdate=policies.AutoScalingReplacingUpdate(WillReplace=True))
+
+    def signal_creation_policy(self, count, timeout='PT15M', min_successful_percent=100):
+        """
+        Create a creation policy that waits for instances to signal (cfn-signal) before a group counts as created
+
+        :param count: Number of signals to wait for
+        :param timeout: How long to wait for them
+        :param min_successful_percent: Percentage of instances that must signal success
+        :return: Creation policy CFN object
+        """
+        return policies.CreationPolicy(
+            ResourceSignal=policies.ResourceSignal(Count=count, Timeout=timeout),
+            AutoScalingCreationPolicy=policies.AutoScalingCreationPolicy(
+                MinSuccessfulInstancesPercent=min_successful_percent)
+        )
+
+    def add_target_tracking_policy(self,
+                                   name,
+                                   asg_name,
+                                   target_value,
+                                   metric_type='ASGAverageCPUUtilization',
+                                   resource_label=None,
+                                   disable_scale_in=False,
+                                   estimated_warmup=300):
+        """
+        Create a target tracking scaling policy, which adds and removes instances to keep a metric at a target value
+
+        :param name: Name of the policy
+        :param asg_name: Name of the ASG to scale
+        :param target_value: Value to hold the metric at, eg. 50 (% CPU) or 1000 (requests per target per minute)
+        :param metric_type: Predefined metric - ASGAverageCPUUtilization, ASGAverageNetworkIn,
+                            ASGAverageNetworkOut or ALBRequestCountPerTarget
+        :param resource_label: Required for ALBRequestCountPerTarget - see alb_request_count_resource_label()
+        :param disable_scale_in: Only ever scale out
+        :param estimated_warmup: Seconds before a new instance's metrics count towards the group
+        :return: Scaling policy CFN object
+        """
+        metric = autoscaling.PredefinedMetricSpecification(PredefinedMetricType=metric_type)
+        if resource_label is not None:
+            metric.ResourceLabel = resource_label
+        elif metric_type == 'ALBRequestCountPerTarget':
+            raise ValueError('ALBRequestCountPerTarget scaling needs a resource_label')
+
+        policy = autoscaling.ScalingPolicy(
+            name,
+            AutoScalingGroupName=Ref(asg_name),
+            PolicyType='TargetTrackingScaling',
+            EstimatedInstanceWarmup=estimated_warmup,
+            TargetTrackingConfiguration=autoscaling.TargetTrackingConfiguration(
+                PredefinedMetricSpecification=metric,
+                TargetValue=float(target_value),
+                DisableScaleIn=disable_scale_in
+            )
+        )
+        self.template.add_resource(policy)
+        return policy
+
+    def alb_request_count_resource_label(self, lb_name, target_group_name):
+        """
+        Resource label identifying an ALB target group, for ALBRequestCountPerTarget scaling
+
+        :param lb_name: Name of the ALB resource
+        :param target_group_name: Name of the target group resource
+        :return: app/<lb-name>/<lb-id>/targetgroup/<tg-name>/<tg-id>
+        """
+        return Join('/', [GetAtt(lb_name, 'LoadBalancerFullName'), GetAtt(target_group_name, 'TargetGroupFullName')])
+
+    def add_step_scaling_policy(self,
+                                name,
+                                asg_name,
+                                metric_name,
+                                threshold,
+                                comparison,
+                                steps,
+                                namespace='AWS/EC2',
+                                statistic='Average',
+                                period=60,
+                                evaluation_periods=2,
+                                dimensions=None,
+                                adjustment_type='ChangeInCapacity',
+                                estimated_warmup=300):
+        """
+        Create a step scaling policy and the CloudWatch alarm that triggers it
+
+        :param name: Name of the policy (the alarm is named <name>Alarm)
+        :param asg_name: Name of the ASG to scale
+        :param metric_name: CloudWatch metric, eg. CPUUtilization
+        :param threshold: Alarm threshold
+        :param comparison: Alarm comparison, eg. GreaterThanOrEqualToThreshold or LessThanOrEqualToThreshold
+        :param steps: List of (lower, upper, adjustment) tuples - bounds are relative to the threshold, None is
+                      unbounded, eg. [(0, 15, 1), (15, None, 2)] adds 1 instance up to 15 over the threshold, 2 above
+        :param namespace: Metric namespace
+        :param statistic: Metric statistic
+        :param period: Metric period, in seconds
+        :param evaluation_periods: Periods the threshold must be breached for
+        :param dimensions: Metric dimensions as a dict (default: the ASG)
+        :param adjustment_type: ChangeInCapacity, PercentChangeInCapacity or ExactCapacity
+        :param estimated_warmup: Seconds before a new instance's metrics count towards the group
+        :return: Scaling policy CFN object
+        """
+        step_adjustments = []
+        for lower, upper, adjustment in steps:
+            step = autoscaling.StepAdjustments(ScalingAdjustment=adjustment)
+            if lower is not None:
+                step.MetricIntervalLowerBound = lower
+            if upper is not None:
+                step.MetricIntervalUpperBound = upper
+            step_adjustments.append(step)
+
+        policy = autoscaling.ScalingPolicy(
+            name,
+            AutoScalingGroupName=Ref(asg_name),
+            PolicyType='StepScaling',
+            AdjustmentType=adjustment_type,
+            MetricAggregationType=statistic,
+            EstimatedInstanceWarmup=estimated_warmup,
+            StepAdjustments=step_adjustments
+        )
+        self.template.add_resource(policy)
+
+        if dimensions is None:
+            dimensions = {'AutoScalingGroupName': Ref(asg_name)}
+        self.template.add_resource(cloudwatch.Alarm(
+            name + 'Alarm',
+            AlarmDescription='Triggers {}'.format(name),
+            Namespace=namespace,
+            MetricName=metric_name,
+            Statistic=statistic,
+            Period=period,
+            EvaluationPeriods=evaluation_periods,
+            Threshold=threshold,
+            ComparisonOperator=comparison,
+            Dimensions=[cloudwatch.MetricDimension(Name=key, Value=value)
+                        for key, value in sorted(dimensions.items())],
+            AlarmActions=[Ref(name)]
+        ))
+        return policy
+
+    def add_scheduled_action(self,
+                             name,
+                             asg_name,
+                             recurrence,
+                             min_size=None,
+                             max_size=None,
+                             desired_size=None,
+                             time_zone=None):
+        """
+        Create a scheduled scaling action, eg. to raise capacity ahead of a known daily peak
+
+        :param name: Name of the action
+        :param asg_name: Name of the ASG to scale
+        :param recurrence: Cron expression, eg. '0 8 * * 1-5'
+        :param min_size: Minimum number of instances from then on
+        :param max_size: Maximum number of instances from then on
+        :param desired_size: Desired number of instances at that time
+        :param time_zone: IANA time zone the cron expression is in (default: UTC)
+        :return: Scheduled action CFN object
+        """
+        if min_size is None and max_size is None and desired_size is None:
+            raise ValueError('Scheduled action {} must set at least one of min, max or desired size'.format(name))
+        action = autoscaling.ScheduledAction(
+            name,
+            AutoScalingGroupName=Ref(asg_name),
+            Recurrence=recurrence
+        )
+        if min_size is not None:
+            action.MinSize = min_size
+        if max_size is not None:
+            action.MaxSize = max_size
+        if desired_size is not None:
+            action.DesiredCapacity = desired_size
+        if time_zone:
+            action.TimeZone = time_zone
+        self.template.add_resource(action)
+        return action
+
     def add_security_group(self, name, ingress_rules, vpc, description='Description not supplied', egress_rules=[]):
         """
         Create a Security Group
@@ -170,37 +825,127 @@ class Ec2(object):
             security_group_rule.SourceSecurityGroupId = cidr_or_sg_id
         return security_group_rule
 
+    def create_security_group_rule(self, direction, protocol, from_port, to_port, kind, source):
+        """
+        Create a rule for a security group's SecurityGroupIngress or SecurityGroupEgress
+
+        :param direction: 'ingress' or 'egress'
+        :param protocol: 'tcp', 'udp' or 'icmp'
+        :param from_port: First port, or the ICMP type
+        :param to_port: Last port, or the ICMP code
+        :param kind: Kind of source/destination - 'cidr', 'cidr6', 'prefix_list' or 'security_group'
+        :param source: The source (ingress) or destination (egress)
+        :return: SG rule
+        """
+        security_group_rule = ec2.SecurityGroupRule(
+            IpProtocol=protocol,
+            FromPort=from_port,
+            ToPort=to_port,
+        )
+        setattr(security_group_rule, SECURITY_GROUP_RULE_PROPERTIES[direction][kind], source)
+        return security_group_rule
+
+    def add_security_group_rule_resource(self, name, group_id, direction, protocol, from_port, to_port, kind, source):
+        """
+        Add a rule to a security group as a resource of its own, rather than inline
+
+        :param name: Name of the rule resource
+        :param group_id: ID of the SG the rule belongs to
+        :param direction: 'ingress' or 'egress'
+        (other params as for create_security_group_rule)
+        """
+        rule_class = ec2.SecurityGroupIngress if direction == 'ingress' else ec2.SecurityGroupEgress
+        rule = rule_class(
+            name,
+            GroupId=group_id,
+            IpProtocol=protocol,
+            FromPort=from_port,
+            ToPort=to_port,
+        )
+        setattr(rule, SECURITY_GROUP_RULE_PROPERTIES[direction][kind], source)
+        return self.template.add_resource(rule)
+
     def add_security_group_from_dict(self, name, rules, vpc):
         """
-        Add a SG from dictionary of SGs
+        Add a SG from dictionary of SGs. Rules are compiled into as few as allow the same traffic (see
+        compile_security_group_rules) and kept inline in the SG. A rule whose source is this SG itself, or a SG not
+        added to the template yet, becomes a resource of its own instead, so SGs that refer to each other don't form
+        a dependency cycle. If that leaves no egress rule inline, a localhost-only one (SECURITY_GROUP_NO_EGRESS) is
+        kept inline so the default of allowing all outbound traffic is still removed.
 
         :param name: Name of the SG
-        :param rules: List of ingress rules
+        :param rules: {'ingress': {protocol: {port: [sources]}}, 'egress': {...}} - see compile_security_group_rules.
+                      No egress rules leaves the default of allowing all outbound traffic.
         :param vpc: VPC in which to create the SG
         """
-        ingress_rules = []
-        for port in rules['ingress']['tcp']:
-            sg_rules = []
-            for idx, cidr in enumerate(rules['ingress']['tcp'][port]):
-                if isinstance(cidr, str) or isinstance(cidr, Join):
-                    sg_rules.append(self.create_ingress_rule(
-                        port,
-                        port,
-                        cidr))
-                elif isinstance(cidr, Ref):
-                    self.add_ingress_rule_to_existing_sg(
-                        name='{}{}Rule{}'.format(name, port, idx + 1),
-                        dest_sg_id=Ref(name),
-                        from_port=port,
-                        to_port=port,
-                        source_sg_id=cidr,
-                    )
-            ingress_rules += sg_rules
-        self.add_security_group(
-            name,
-            ingress_rules=ingress_rules,
-            vpc=vpc,
-        )
+        self.add_security_groups_from_dicts(OrderedDict([(name, rules)]), vpc)
+
+    def add_security_groups_from_dicts(self, groups, vpc):
+        """
+        Add many SGs in one pass (see base.bulk_resources), each as add_security_group_from_dict would. SGs are added
+        in order, so a rule whose source is a SG later in groups becomes a resource of its own.
+
+        :param groups: Dict of SG name -> rules, as add_security_group_from_dict takes them
+        :param vpc: VPC in which to create the SGs
+        """
+        # SGs added so far in this batch
+        added = set()
+        order = []
+        rule_rows = []
+        rule_resource_rows = {'ingress': [], 'egress': []}
+        group_rows = []
+        output_rows = []
+        for name, rules in groups.items():
+            inline = {'ingress': [], 'egress': []}
+            egress_resources = len(rule_resource_rows['egress'])
+            for direction in ('ingress', 'egress'):
+                resource_names = {}
+                for protocol, from_port, to_port, kind, source in compile_security_group_rules(
+                        rules.get(direction, {})):
+                    properties = {
+                        'IpProtocol': protocol,
+                        'FromPort': from_port,
+                        'ToPort': to_port,
+                        SECURITY_GROUP_RULE_PROPERTIES[direction][kind]: source,
+                    }
+                    if isinstance(source, Ref) and (source.data['Ref'] == name or (
+                            source.data['Ref'] not in self.template.resources and source.data['Ref'] not in added)):
+                        label = security_group_rule_label(name, direction, protocol, from_port, to_port)
+                        resource_names[label] = resource_names.get(label, 0) + 1
+                        rule_name = '{}Rule{}'.format(label, resource_names[label])
+                        rule_resource_rows[direction].append((rule_name, dict(properties, GroupId=Ref(name))))
+                        order.append(direction)
+                    else:
+                        inline[direction].append(len(rule_rows))
+                        rule_rows.append((None, properties))
+            if len(rule_resource_rows['egress']) > egress_resources and not inline['egress']:
+                inline['egress'].append(len(rule_rows))
+                rule_rows.append((None, SECURITY_GROUP_NO_EGRESS))
+            group_rows.append((name, inline))
+            order.append('group')
+            added.add(name)
+            output_rows.append((name, {
+                'Value': Ref(name),
+                'Description': u"Security group details for {}".format(name),
+                'Export': Export(Sub("${AWS::StackName}-" + name)),
+            }))
+
+        built = build_objects(ec2.SecurityGroupRule, rule_rows)
+        group_rows = [(name, {
+            'GroupDescription': 'Description not supplied',
+            'SecurityGroupIngress': [built[index] for index in inline['ingress']],
+            'SecurityGroupEgress': [built[index] for index in inline['egress']],
+            'VpcId': vpc,
+            'Tags': [{'Key': 'Name', 'Value': name}],
+        }) for name, inline in group_rows]
+        # Each kind of resource is built in one pass, then put back in the order they were specified
+        resources = {
+            'group': iter(build_objects(ec2.SecurityGroup, group_rows)),
+            'ingress': iter(build_objects(ec2.SecurityGroupIngress, rule_resource_rows['ingress'])),
+            'egress': iter(build_objects(ec2.SecurityGroupEgress, rule_resource_rows['egress'])),
+        }
+        add_objects(self.template, resources=[next(resources[kind]) for kind in order],
+                    outputs=build_objects(Output, output_rows))
 
     def add_ingress_rule_to_existing_sg(self,
                                         name,
@@ -306,7 +1051,7 @@ class Ec2(object):
         return network_interface
 
     def create_elbv2(self, name, subnets, security_groups=[], lb_type="application", scheme="internet-facing", tags={},
-                     lb_attributes=False):
+                     lb_attributes=False, profile=None):
         """
         Creates an Amazon Load Balancer (ELBv2) - (software load balancer) not to be confused with an ELB
 
@@ -317,7 +1062,10 @@ class Ec2(object):
         :param scheme: Scheme (internet-facing, internal)
         :param tags: any tags to assign to the LB
         :param lb_attributes: Additional attributes
+        :param profile: Elbv2Profile whose attributes to apply ahead of lb_attributes
         """
+        if profile:
+            lb_attributes = profile.lb_attributes() + list(lb_attributes or [])
         load_balancer = elbv2.LoadBalancer(
             name,
             Subnets=subnets,
@@ -403,6 +1151,20 @@ class Ec2(object):
         )
         return action
 
+    def elbv2_weighted_forward_action(self, weights):
+        """
+        Create an ELBv2 listener action splitting traffic between target groups
+
+        :param weights: List of (target group ARN, weight) tuples - weights are relative, 0 sends no traffic
+        :return: Listener action CFN object
+        """
+        return elbv2.Action(
+            Type='forward',
+            ForwardConfig=elbv2.ForwardConfig(
+                TargetGroups=[elbv2.TargetGroupTuple(TargetGroupArn=arn, Weight=weight) for arn, weight in weights]
+            )
+        )
+
     def elbv2_listener_rule(self, name, actions, conditions, listener_arn, priority):
         """
         Create ELBv2 listener rule
@@ -435,7 +1197,7 @@ class Ec2(object):
         )
 
     def elbv2_target_group(self, name, protocol, port, vpc_id, health_check_details={}, matcher=None,
-                           target_group_attributes=False, targets=[]):
+                           target_group_attributes=False, targets=[], profile=None):
         """
         Create ELBv2 Target Group
 
@@ -447,52 +1209,77 @@ class Ec2(object):
         :param matcher: HTTP code to use when checking for health check response
         :param target_group_attributes: Additional target group attributes
         :param targets: Targets, if applicable
+        :param profile: Elbv2Profile whose attributes and health check timings to apply, ahead of
+                        target_group_attributes
         :return: Target Group CFN object
         """
+        return self.add_target_groups([dict(
+            name=name,
+            protocol=protocol,
+            port=port,
+            vpc_id=vpc_id,
+            health_check_details=health_check_details,
+            matcher=matcher,
+            target_group_attributes=target_group_attributes,
+            targets=targets,
+            profile=profile
+        )])[0]
+
+    def add_target_groups(self, target_groups, **defaults):
+        """
+        Create many ELBv2 Target Groups in one pass (see base.bulk_resources)
 
-        target_group = elbv2.TargetGroup(
-            name,
-            Protocol=protocol,
-            Port=port,
-            VpcId=vpc_id,
-            HealthCheckProtocol=health_check_details["health_check_protocol"],
-            HealthCheckPort=health_check_details["health_check_port"],
-            HealthCheckIntervalSeconds=health_check_details["health_check_interval"],
-            HealthyThresholdCount=health_check_details["healthy_threshold"],
-            UnhealthyThresholdCount=health_check_details["unhealthy_threshold"],
-            Targets=targets
-        )
-
-        if health_check_details.get("health_check_path"):
-            target_group.HealthCheckPath = health_check_details["health_check_path"]
-
-        if health_check_details.get("health_check_timeout"):
-            target_group.HealthCheckTimeoutSeconds = health_check_details["health_check_timeout"]
-
-        if matcher:
-            target_group.Matcher = elbv2.Matcher(
-                HttpCode=matcher
-            )
-
-        if target_group_attributes:
-            attributes = []
-            for attr in target_group_attributes:
-                attributes.append(elbv2.TargetGroupAttribute(
-                    Key=attr['key'],
-                    Value=attr['value']
-                )
-                )
-            target_group.TargetGroupAttributes = attributes
-
-        self.template.add_resource(target_group)
-        self.template.add_output(Output(
-            name,
-            Value=Ref(name),
-            Description="Target Group {} ARN".format(name),
-            Export=Export(Sub("${AWS::StackName}-" + name))
-        ))
-
-        return target_group
+        :param target_groups: Spec table - a row per target group, as a dict or as a tuple in TARGET_GROUP_COLUMNS
+                              order, of the arguments elbv2_target_group takes
+        :param defaults: Values for columns a row leaves out, eg. vpc_id=Ref('VPC')
+        :return: List of Target Group CFN objects
+        """
+        rows = spec_rows(target_groups, TARGET_GROUP_COLUMNS, dict(TARGET_GROUP_DEFAULTS, **defaults),
+                         required=('name', 'protocol', 'port', 'vpc_id'))
+        group_rows = []
+        matcher_rows = []
+        attribute_rows = []
+        for row in rows:
+            health_check_details = row['health_check_details']
+            target_group_attributes = row['target_group_attributes']
+            if row['profile']:
+                health_check_details = dict(health_check_details, **row['profile'].health_check_details())
+                target_group_attributes = (row['profile'].target_group_attributes() +
+                                           list(target_group_attributes or []))
+            if row['matcher']:
+                matcher_rows.append((None, {'HttpCode': row['matcher']}))
+            attribute_rows.append([(None, {'Key': attr['key'], 'Value': attr['value']})
+                                   for attr in target_group_attributes or []])
+            group_rows.append((row['name'], {
+                'Protocol': row['protocol'],
+                'Port': row['port'],
+                'VpcId': row['vpc_id'],
+                'HealthCheckProtocol': health_check_details["health_check_protocol"],
+                'HealthCheckPort': health_check_details["health_check_port"],
+                'HealthCheckIntervalSeconds': health_check_details["health_check_interval"],
+                'HealthyThresholdCount': health_check_details["healthy_threshold"],
+                'UnhealthyThresholdCount': health_check_details["unhealthy_threshold"],
+                'Targets': list(row['targets']),
+                'HealthCheckPath': health_check_details.get("health_check_path") or None,
+                'HealthCheckTimeoutSeconds': health_check_details.get("health_check_timeout") or None,
+            }))
+
+        matchers = iter(build_objects(elbv2.Matcher, matcher_rows))
+        attributes = iter(build_objects(elbv2.TargetGroupAttribute, [attribute for group in attribute_rows
+                                                                     for attribute in group]))
+        for (_, properties), row, group_attributes in zip(group_rows, rows, attribute_rows):
+            if row['matcher']:
+                properties['Matcher'] = next(matchers)
+            if group_attributes:
+                properties['TargetGroupAttributes'] = [next(attributes) for _ in group_attributes]
+
+        built = build_objects(elbv2.TargetGroup, group_rows)
+        add_objects(self.template, resources=built, outputs=build_objects(Output, [(row['name'], {
+            'Value': Ref(row['name']),
+            'Description': "Target Group {} ARN".format(row['name']),
+            'Export': Export(Sub("${AWS::StackName}-" + row['name'])),
+        }) for row in rows]))
+        return built
 
     def elbv2_target(self, target_id, port):
         """
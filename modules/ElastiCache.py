@@ -0,0 +1,106 @@
+from base.lazy_import import lazy_import
+from troposphere import Output, Ref, GetAtt, Tags
+
+elasticache = lazy_import('troposphere.elasticache')
+
+
+class ElastiCache(object):
+    def add_cache_subnet_group(self, name, subnets, description='Cache subnets'):
+        """
+        Adds an ElastiCache subnet group
+
+        :param name: Name of the subnet group resource
+        :param subnets: Subnet ids for cache nodes - more than one AZ is needed for Multi-AZ failover
+        :param description: Description of the subnet group
+        :return: Subnet group CFN object
+        """
+        return self.template.add_resource(elasticache.SubnetGroup(
+            name,
+            Description=description,
+            SubnetIds=subnets,
+            Tags=Tags(Name=name)
+        ))
+
+    def add_redis_parameter_group(self, name, family='redis7', maxmemory_policy='allkeys-lru', parameters={}):
+        """
+        Adds a Redis parameter group. By default, a full cache evicts the least recently used keys of any kind, which
+        suits cache-aside (ElastiCache's own default only evicts keys that have a TTL).
+
+        :param name: Name of the parameter group resource
+        :param family: Parameter group family, eg. 'redis7' - must match the engine version
+        :param maxmemory_policy: Eviction policy once memory is full
+        :param parameters: Other parameters to set
+        :return: Parameter group CFN object
+        """
+        properties = {'maxmemory-policy': maxmemory_policy}
+        properties.update(parameters)
+        return self.template.add_resource(elasticache.ParameterGroup(
+            name,
+            CacheParameterGroupFamily=family,
+            Description='{} Redis parameters'.format(name),
+            Properties=properties,
+            Tags=Tags(Name=name)
+        ))
+
+    def add_redis_replication_group(self, name, subnet_group, security_groups=[], node_type='cache.t3.micro',
+                                    replicas=0, engine_version='7.0', parameter_group=False, multi_az=False,
+                                    snapshot_retention=0, maintenance_window=False):
+        """
+        Adds a Redis replication group (cluster mode disabled): a primary plus read replicas, with automatic failover
+        to a replica if there are any. Outputs the primary's host and port, and the reader endpoint when there are
+        replicas.
+
+        :param name: Name of the replication group resource
+        :param subnet_group: Name of the cache subnet group resource
+        :param security_groups: Security group ids for the nodes
+        :param node_type: Cache node type, eg. 'cache.t3.micro'
+        :param replicas: Number of read replicas (0-5)
+        :param engine_version: Redis version
+        :param parameter_group: Name of the parameter group resource (optional - ElastiCache default if not set)
+        :param multi_az: Spread nodes across AZs and fail over across them - needs replicas and a multi-AZ subnet group
+        :param snapshot_retention: Days of daily snapshots to keep (0 = none)
+        :param maintenance_window: The maintenance window (e.g. 'sun:05:00-sun:06:00')
+        :return: Replication group CFN object
+        """
+        if not 0 <= replicas <= 5:
+            raise ValueError('A Redis replication group has 0 to 5 replicas, got {}'.format(replicas))
+        if multi_az and not replicas:
+            raise ValueError('Multi-AZ Redis needs at least one replica')
+
+        group = elasticache.ReplicationGroup(
+            name,
+            ReplicationGroupDescription='{} Redis'.format(name),
+            Engine='redis',
+            EngineVersion=engine_version,
+            CacheNodeType=node_type,
+            NumCacheClusters=replicas + 1,
+            AutomaticFailoverEnabled=replicas > 0,
+            MultiAZEnabled=multi_az,
+            CacheSubnetGroupName=Ref(subnet_group),
+            SecurityGroupIds=security_groups,
+            SnapshotRetentionLimit=snapshot_retention,
+            Tags=Tags(Name=name)
+        )
+        if parameter_group:
+            group.CacheParameterGroupName = Ref(parameter_group)
+        if maintenance_window:
+            group.PreferredMaintenanceWindow = maintenance_window
+        self.template.add_resource(group)
+
+        self.template.add_output(Output(
+            '{}Host'.format(name),
+            Value=GetAtt(name, 'PrimaryEndPoint.Address'),
+            Description='{} Redis Primary Address'.format(name)
+        ))
+        self.template.add_output(Output(
+            '{}Port'.format(name),
+            Value=GetAtt(name, 'PrimaryEndPoint.Port'),
+            Description='{} Redis Port'.format(name)
+        ))
+        if replicas:
+            self.template.add_output(Output(
+                '{}ReaderHost'.format(name),
+                Value=GetAtt(name, 'ReaderEndPoint.Address'),
+                Description='{} Redis Reader Address'.format(name)
+            ))
+        return group
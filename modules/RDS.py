@@ -1,13 +1,88 @@
-from troposphere import Output, Ref, GetAtt, If, Not, Equals
-from troposphere.rds import DBInstance
+from base.lazy_import import lazy_import
+from troposphere import Output, Ref, GetAtt, If, Not, Equals, Join, Sub
+
+iam = lazy_import('troposphere.iam')
+rds = lazy_import('troposphere.rds')
+
+GIB = 1024 * 1024 * 1024
+MIB = 1024 * 1024
+
+# Memory (GiB) of the DB instance classes tuned_mysql_parameters knows about
+DB_INSTANCE_MEMORY_GIB = {
+    'db.t2.micro': 1, 'db.t2.small': 2, 'db.t2.medium': 4, 'db.t2.large': 8, 'db.t2.xlarge': 16, 'db.t2.2xlarge': 32,
+    'db.t3.micro': 1, 'db.t3.small': 2, 'db.t3.medium': 4, 'db.t3.large': 8, 'db.t3.xlarge': 16, 'db.t3.2xlarge': 32,
+    'db.m5.large': 8, 'db.m5.xlarge': 16, 'db.m5.2xlarge': 32, 'db.m5.4xlarge': 64, 'db.m5.8xlarge': 128,
+    'db.m5.12xlarge': 192, 'db.m5.16xlarge': 256, 'db.m5.24xlarge': 384,
+    'db.r5.large': 16, 'db.r5.xlarge': 32, 'db.r5.2xlarge': 64, 'db.r5.4xlarge': 128, 'db.r5.8xlarge': 256,
+    'db.r5.12xlarge': 384, 'db.r5.16xlarge': 512, 'db.r5.24xlarge': 768,
+}
+
+STORAGE_TYPES = ('standard', 'gp2', 'gp3', 'io1', 'io2')
+
+
+def mysql_parameter_family(mysql_version):
+    """
+    :param mysql_version: MySQL engine version, eg. '5.7' or '8.0.35'
+    :return: DB parameter group family, eg. 'mysql5.7'
+    """
+    return 'mysql' + '.'.join(str(mysql_version).split('.')[:2])
+
+
+def tuned_mysql_parameters(instance_type):
+    """
+    Derive memory-related MySQL settings from an instance class. The buffer pool gets 3/4 of memory (1/2 on
+    instances under 4GiB, which need more headroom for connections and the OS), and max_connections is sized to what
+    the remaining memory can hold at ~12MiB per connection.
+
+    :param instance_type: DB instance class, eg. 'db.r5.large'
+    :return: Dict of parameter name -> value
+    """
+    if instance_type not in DB_INSTANCE_MEMORY_GIB:
+        raise ValueError('No memory size known for {} (expected one of {})'.format(
+            instance_type, ', '.join(sorted(DB_INSTANCE_MEMORY_GIB))))
+    memory = DB_INSTANCE_MEMORY_GIB[instance_type] * GIB
+    buffer_pool = memory * 3 // 4 if memory >= 4 * GIB else memory // 2
+    max_connections = min(16000, max(50, (memory - buffer_pool) // (12 * MIB)))
+    return {
+        'innodb_buffer_pool_size': str(buffer_pool),
+        # One instance per GiB of buffer pool cuts mutex contention, up to MySQL's useful limit of 8
+        'innodb_buffer_pool_instances': str(min(8, max(1, buffer_pool // GIB))),
+        'max_connections': str(max_connections),
+        'thread_cache_size': str(min(100, max(8, max_connections // 10))),
+        'tmp_table_size': str(min(64 * MIB, memory // 64)),
+        'max_heap_table_size': str(min(64 * MIB, memory // 64)),
+    }
+
+
+def validate_storage(storage_type, allocated_storage, iops):
+    """
+    Check a storage type, size and provisioned IOPS combination is one RDS MySQL accepts
+    """
+    if storage_type not in STORAGE_TYPES:
+        raise ValueError('Unknown storage type: {} (expected one of {})'.format(storage_type, ', '.join(STORAGE_TYPES)))
+    if storage_type in ('io1', 'io2'):
+        if not iops:
+            raise ValueError('{} storage needs provisioned iops'.format(storage_type))
+        if int(allocated_storage) < 100 or not 1000 <= iops <= int(allocated_storage) * 50:
+            raise ValueError('{} storage needs at least 100GiB and 1000 to 50x the size in GiB iops'.format(storage_type))
+    elif storage_type == 'gp3':
+        # Below 400GiB gp3 runs at a fixed 3000 iops baseline
+        if iops and (int(allocated_storage) < 400 or not 12000 <= iops <= 64000):
+            raise ValueError('gp3 iops can only be set from 400GiB, between 12000 and 64000')
+    elif iops:
+        raise ValueError('{} storage doesn\'t take provisioned iops'.format(storage_type))
 
 
 class Rds(object):
+    def resource_tags(self, name):
+        return [{'Key': 'Name', 'Value': name}]
+
     def add_rds_mysql_instance(self, resource_name, db_name=False, instance_id=False,
                                mysql_version='5.6', security_groups=[], parameter_group=False, subnet_group='',
                                master_username='', master_password='', multi_az='false', instance_type='db.t2.small',
                                allocated_storage='10', storage_type='standard', snapshot=False,
-                               maintenance_window=False, backup_window=False):
+                               maintenance_window=False, backup_window=False, iops=None, max_allocated_storage=None,
+                               performance_insights=False, performance_insights_retention=7):
         """
         Adds an RDS MYSQL instance. The instance can either be brand new, or created from a snapshot.
 
@@ -27,20 +102,26 @@ class Rds(object):
         :param snapshot: The URN to a snapshot if this instance is being created from a snapshot.
         :param maintenance_window: The maintenance window (e.g. 'mon:03:00-mon:05:00' - See RDS documentation for syntax)
         :param backup_window: The backup window (e.g. '02:30-03:00' - See RDS documentation for syntax)
+        :param iops: Provisioned IOPS - required for io1/io2 storage, optional for gp3 from 400GiB
+        :param max_allocated_storage: Let storage autoscale up to this many GiB (optional)
+        :param performance_insights: Enable Performance Insights
+        :param performance_insights_retention: Days to keep Performance Insights data - 7 (free tier), or a multiple
+                                               of 31 up to 731
         """
-        instance = DBInstance(resource_name,
-                              DBName=db_name,
-                              VPCSecurityGroups=security_groups,
-                              DBSubnetGroupName=subnet_group,
-                              Engine='MySQL',
-                              EngineVersion=mysql_version,
-                              MasterUsername=master_username,
-                              MasterUserPassword=master_password,
-                              MultiAZ=multi_az,
-                              DBInstanceClass=instance_type,
-                              StorageType=storage_type,
-                              AllocatedStorage=allocated_storage,
-                              Tags=self.resource_tags(resource_name))
+        validate_storage(storage_type, allocated_storage, iops)
+        instance = rds.DBInstance(resource_name,
+                                  DBName=db_name,
+                                  VPCSecurityGroups=security_groups,
+                                  DBSubnetGroupName=subnet_group,
+                                  Engine='MySQL',
+                                  EngineVersion=mysql_version,
+                                  MasterUsername=master_username,
+                                  MasterUserPassword=master_password,
+                                  MultiAZ=multi_az,
+                                  DBInstanceClass=instance_type,
+                                  StorageType=storage_type,
+                                  AllocatedStorage=allocated_storage,
+                                  Tags=self.resource_tags(resource_name))
         if snapshot:
             has_snapshot = '{}HasSnapshot'.format(resource_name)
             self.template.add_condition(has_snapshot, Not(Equals(snapshot, '')))
@@ -58,6 +139,12 @@ class Rds(object):
             instance.PreferredMaintenanceWindow = maintenance_window
         if backup_window:
             instance.PreferredBackupWindow = backup_window
+        if iops:
+            instance.Iops = iops
+        if max_allocated_storage:
+            instance.MaxAllocatedStorage = max_allocated_storage
+        if performance_insights:
+            self.enable_performance_insights(instance, performance_insights_retention)
 
         self.template.add_resource(instance)
         self.template.add_output(Output(
@@ -80,3 +167,188 @@ class Rds(object):
             Value=db_name,
             Description='{} DB Name'.format(resource_name)
         ))
+
+    def enable_performance_insights(self, instance, retention=7):
+        """
+        Turn on Performance Insights for a DB instance
+
+        :param instance: DBInstance CFN object
+        :param retention: Days to keep data - 7 (free tier), or a multiple of 31 up to 731
+        """
+        if retention != 7 and (retention % 31 or not 31 <= retention <= 731):
+            raise ValueError('Performance Insights retention must be 7, or a multiple of 31 up to 731 days')
+        instance.EnablePerformanceInsights = True
+        instance.PerformanceInsightsRetentionPeriod = retention
+
+    def add_rds_mysql_parameter_group(self, resource_name, instance_type, mysql_version='5.6', parameters={}):
+        """
+        Adds a MySQL DB parameter group with memory settings sized for an instance class (see tuned_mysql_parameters)
+
+        :param resource_name: Name of parameter group resource in CloudFormation
+        :param instance_type: The instance class the group will be used with, e.g. 'db.r5.large'
+        :param mysql_version: The version of MySQL the group is for
+        :param parameters: Parameters to set on top of (or instead of) the derived ones
+        :return: DB parameter group CFN object
+        """
+        values = tuned_mysql_parameters(instance_type)
+        values.update(parameters)
+        return self.template.add_resource(rds.DBParameterGroup(
+            resource_name,
+            Description='{} MySQL {} parameters'.format(instance_type, mysql_version),
+            Family=mysql_parameter_family(mysql_version),
+            Parameters=values,
+            Tags=self.resource_tags(resource_name)
+        ))
+
+    def add_rds_read_replica(self, resource_name, source, instance_type=None, parameter_group=False,
+                             storage_type=None, iops=None, availability_zone=False, performance_insights=False,
+                             performance_insights_retention=7):
+        """
+        Adds a read replica of an RDS MySQL instance in the same region. The source must keep automated backups (the
+        default). Storage size, engine version and credentials follow the source.
+
+        :param resource_name: Name of replica resource in CloudFormation
+        :param source: Name of the source DB instance resource
+        :param instance_type: The replica's instance class (default: same as the source)
+        :param parameter_group: The replica's parameter group (optional - RDS default will be used if not specified)
+        :param storage_type: The replica's storage type (default: same as the source)
+        :param iops: Provisioned IOPS, for io1/io2/gp3 storage
+        :param availability_zone: AZ to put the replica in (optional)
+        :param performance_insights: Enable Performance Insights
+        :param performance_insights_retention: Days to keep Performance Insights data
+        :return: DB instance CFN object
+        """
+        source_instance = self.template.resources[source]
+        replica = rds.DBInstance(resource_name,
+                                 SourceDBInstanceIdentifier=Ref(source),
+                                 Engine='MySQL',
+                                 DBInstanceClass=instance_type or source_instance.DBInstanceClass,
+                                 Tags=self.resource_tags(resource_name))
+        if storage_type:
+            validate_storage(storage_type, source_instance.AllocatedStorage, iops)
+            replica.StorageType = storage_type
+        if iops:
+            replica.Iops = iops
+        if parameter_group:
+            replica.DBParameterGroupName = parameter_group
+        if availability_zone:
+            replica.AvailabilityZone = availability_zone
+        if performance_insights:
+            self.enable_performance_insights(replica, performance_insights_retention)
+
+        self.template.add_resource(replica)
+        self.template.add_output(Output(
+            '{}Host'.format(resource_name),
+            Value=GetAtt(resource_name, 'Endpoint.Address'),
+            Description='{} DB Replica Address'.format(resource_name)
+        ))
+        self.template.add_output(Output(
+            '{}Port'.format(resource_name),
+            Value=GetAtt(resource_name, 'Endpoint.Port'),
+            Description='{} DB Replica Port'.format(resource_name)
+        ))
+        return replica
+
+    def add_rds_read_replicas(self, source, count, availability_zones=(), **kwargs):
+        """
+        Adds several read replicas of an RDS MySQL instance, plus a '<source>ReaderHosts' output listing all of
+        their addresses for clients to spread reads over
+
+        :param source: Name of the source DB instance resource
+        :param count: Number of replicas
+        :param availability_zones: AZs to spread the replicas over, in turn (optional)
+        :param kwargs: See add_rds_read_replica
+        :return: List of replica resource names
+        """
+        names = []
+        for idx in range(count):
+            name = '{}Replica{}'.format(source, idx + 1)
+            if availability_zones:
+                kwargs['availability_zone'] = availability_zones[idx % len(availability_zones)]
+            self.add_rds_read_replica(name, source, **kwargs)
+            names.append(name)
+
+        self.template.add_output(Output(
+            '{}ReaderHosts'.format(source),
+            Value=Join(',', [GetAtt(name, 'Endpoint.Address') for name in names]),
+            Description='{} DB Replica Addresses'.format(source)
+        ))
+        return names
+
+    def add_rds_proxy(self, resource_name, db_instance, secret_arn, subnets, security_groups=[],
+                      max_connections_percent=90, max_idle_connections_percent=50, borrow_timeout=120,
+                      idle_client_timeout=1800, require_tls=False):
+        """
+        Adds an RDS Proxy in front of a MySQL instance, so that many short-lived app connections share a small pool
+        of database connections. Needs MySQL 5.7 or later. The proxy signs in with the credentials in a Secrets
+        Manager secret ({"username": ..., "password": ...}), through a role created alongside it.
+
+        :param resource_name: Name of proxy resource in CloudFormation
+        :param db_instance: Name of the DB instance resource to proxy
+        :param secret_arn: ARN of the Secrets Manager secret holding the DB credentials
+        :param subnets: Subnet ids to run the proxy in (at least two AZs)
+        :param security_groups: Security group ids for the proxy
+        :param max_connections_percent: Share of the instance's max_connections the proxy may open
+        :param max_idle_connections_percent: Share of the instance's max_connections the proxy may keep idle
+        :param borrow_timeout: Seconds a client waits for a pooled connection before failing
+        :param idle_client_timeout: Seconds before an idle client connection is closed
+        :param require_tls: Only accept TLS connections from clients
+        :return: DB proxy CFN object
+        """
+        if str(self.template.resources[db_instance].EngineVersion).startswith('5.6'):
+            raise ValueError('RDS Proxy needs MySQL 5.7 or later ({} is {})'.format(
+                db_instance, self.template.resources[db_instance].EngineVersion))
+
+        role_name = '{}Role'.format(resource_name)
+        self.template.add_resource(iam.Role(
+            role_name,
+            AssumeRolePolicyDocument={
+                'Version': '2012-10-17',
+                'Statement': [{
+                    'Effect': 'Allow',
+                    'Principal': {'Service': ['rds.amazonaws.com']},
+                    'Action': ['sts:AssumeRole']
+                }]
+            },
+            Policies=[iam.Policy(
+                PolicyName='ReadDBSecret',
+                PolicyDocument={
+                    'Version': '2012-10-17',
+                    'Statement': [{
+                        'Effect': 'Allow',
+                        'Action': ['secretsmanager:GetSecretValue'],
+                        'Resource': [secret_arn]
+                    }]
+                }
+            )]
+        ))
+
+        proxy = self.template.add_resource(rds.DBProxy(
+            resource_name,
+            DBProxyName=Sub('${AWS::StackName}-' + resource_name.lower()),
+            EngineFamily='MYSQL',
+            Auth=[rds.AuthFormat(AuthScheme='SECRETS', SecretArn=secret_arn, IAMAuth='DISABLED')],
+            RoleArn=GetAtt(role_name, 'Arn'),
+            VpcSubnetIds=subnets,
+            VpcSecurityGroupIds=security_groups,
+            IdleClientTimeout=idle_client_timeout,
+            RequireTLS=require_tls
+        ))
+        self.template.add_resource(rds.DBProxyTargetGroup(
+            '{}TargetGroup'.format(resource_name),
+            DBProxyName=Ref(resource_name),
+            TargetGroupName='default',
+            DBInstanceIdentifiers=[Ref(db_instance)],
+            ConnectionPoolConfigurationInfo=rds.ConnectionPoolConfigurationInfoFormat(
+                MaxConnectionsPercent=max_connections_percent,
+                MaxIdleConnectionsPercent=max_idle_connections_percent,
+                ConnectionBorrowTimeout=borrow_timeout
+            )
+        ))
+
+        self.template.add_output(Output(
+            '{}Host'.format(resource_name),
+            Value=GetAtt(resource_name, 'Endpoint'),
+            Description='{} DB Proxy Address'.format(resource_name)
+        ))
+        return proxy
@@ -1,21 +1,116 @@
-from troposphere.ec2 import Route, SubnetRouteTableAssociation, Subnet, RouteTable, VPC, InternetGateway,\
-    VPCGatewayAttachment, EIP, NatGateway
-from troposphere import GetAtt, Ref
+from base.bulk_resources import add_objects, build_objects, spec_rows
+from base.lazy_import import lazy_import
+from troposphere import GetAtt, GetAZs, Ref, Select
+import ipaddress
+
+ec2 = lazy_import('troposphere.ec2')
+
+# (tier name, public, subnet prefix length) - one subnet per tier per AZ
+DEFAULT_TIERS = (('Public', True, 24), ('Private', False, 20))
+# Columns of add_subnets' spec table
+SUBNET_COLUMNS = ('name', 'availability_zone', 'cidr_block', 'routing_table_name', 'vpc_name')
+
+
+def allocate_cidrs(vpc_cidr, prefix_lengths):
+    """
+    Carve non-overlapping subnets out of a VPC CIDR. The largest blocks are placed first so that every block stays
+    aligned without leaving gaps.
+
+    :param vpc_cidr: VPC CIDR, eg. '10.14.0.0/16'
+    :param prefix_lengths: Prefix length of each subnet wanted, eg. [24, 24, 20, 20]
+    :return: List of CIDR strings, in the same order as prefix_lengths
+    """
+    network = ipaddress.ip_network(u'{}'.format(vpc_cidr))
+    allocated = [None] * len(prefix_lengths)
+    next_address = int(network.network_address)
+    for idx in sorted(range(len(prefix_lengths)), key=lambda i: prefix_lengths[i]):
+        if prefix_lengths[idx] < network.prefixlen:
+            raise ValueError('A /{} subnet does not fit in {}'.format(prefix_lengths[idx], vpc_cidr))
+        subnet = ipaddress.ip_network((next_address, prefix_lengths[idx]))
+        if subnet.broadcast_address > network.broadcast_address:
+            raise ValueError('{} is too small for the requested subnets'.format(vpc_cidr))
+        allocated[idx] = str(subnet)
+        next_address = int(subnet.broadcast_address) + 1
+    return allocated
 
 
 class Vpc():
-    def add_vpc(self, name):
+    def add_vpc(self, name, cidr_block='10.14.0.0/16'):
         """
         Create a VPC
 
         :param name: Name to give the VPC
+        :param cidr_block: CIDR block
         """
-        self.template.add_resource(VPC(
+        self.template.add_resource(ec2.VPC(
             name,
-            CidrBlock='10.14.0.0/16',
+            CidrBlock=cidr_block,
             )
         )
 
+    def add_topology(self, vpc_name, az_count, tiers=DEFAULT_TIERS, vpc_cidr='10.14.0.0/16', region='',
+                     nat_per_az=True):
+        """
+        Create a VPC spread over several AZs - a subnet per tier in every AZ, with CIDRs allocated automatically.
+        Public subnets share a route to an internet gateway; each AZ's private subnets route through a NAT gateway in
+        the same AZ, so outbound traffic never crosses AZs and no single NAT gateway carries it all.
+
+        :param vpc_name: Name to give the VPC
+        :param az_count: Number of AZs to use
+        :param tiers: List of (tier name, public, subnet prefix length) tuples
+        :param vpc_cidr: VPC CIDR to allocate subnets from
+        :param region: Region whose AZs to use (default: the stack's)
+        :param nat_per_az: One NAT gateway per AZ, rather than a single shared one
+        :return: Dict of tier name -> list of subnet names, one per AZ
+        """
+        public_tiers = [tier_name for tier_name, public, _ in tiers if public]
+        if not public_tiers and any(not public for _, public, _ in tiers):
+            raise ValueError('Private tiers need a public tier to put NAT gateways in')
+
+        self.add_vpc(name=vpc_name, cidr_block=vpc_cidr)
+        cidrs = iter(allocate_cidrs(vpc_cidr, [prefix_length for _ in range(az_count)
+                                               for _, _, prefix_length in tiers]))
+        public_routing_table = 'PublicRouting'
+        subnets = dict((tier_name, []) for tier_name, _, _ in tiers)
+        subnet_specs = []
+        for az in range(az_count):
+            for tier_name, public, _ in tiers:
+                name = '{}Subnet{}'.format(tier_name, az + 1)
+                if public:
+                    routing_table = public_routing_table
+                else:
+                    routing_table = '{}Routing{}'.format(tier_name, az + 1)
+                    if routing_table not in self.template.resources:
+                        self.routing_table(name=routing_table, vpc_name=vpc_name)
+                subnet_specs.append((name, Select(az, GetAZs(region)), next(cidrs), routing_table))
+                subnets[tier_name].append(name)
+        self.add_subnets(subnet_specs, vpc_name=vpc_name)
+
+        self.routing_table(name=public_routing_table, vpc_name=vpc_name)
+        if public_tiers:
+            self.add_internet_gateway(
+                name='InternetGateway',
+                routing_table_name=public_routing_table,
+                vpc_name=vpc_name
+            )
+
+        for az in range(az_count):
+            nat_gateway = 'NatGateway{}'.format(az + 1 if nat_per_az else 1)
+            if nat_gateway not in self.template.resources and any(not public for _, public, _ in tiers):
+                self.add_nat_gateway(
+                    name=nat_gateway,
+                    subnet=Ref(subnets[public_tiers[0]][az])
+                )
+            for tier_name, public, _ in tiers:
+                if not public:
+                    self.add_nat_gateway_route(
+                        name='{}RouteToInternet{}'.format(tier_name, az + 1),
+                        dest_cidr_block='0.0.0.0/0',
+                        route_table_id=Ref('{}Routing{}'.format(tier_name, az + 1)),
+                        nat_gateway_id=Ref(nat_gateway)
+                    )
+        return subnets
+
     def add_subnet(self, name, availability_zone, cidr_block, routing_table_name, vpc_name):
         """
         Create a subnet
@@ -26,26 +121,34 @@ class Vpc():
         :param routing_table_name: Name of routing table
         :param vpc_name: Name of VPC
         """
-        if isinstance(vpc_name, Ref):
-            vpc = vpc_name
-        else:
-            vpc = Ref(vpc_name)
+        self.add_subnets([(name, availability_zone, cidr_block, routing_table_name, vpc_name)])
 
-        self.template.add_resource(
-            Subnet(
-                name,
-                AvailabilityZone=availability_zone,
-                CidrBlock=cidr_block,
-                VpcId=vpc,
-        ))
+    def add_subnets(self, subnets, **defaults):
+        """
+        Create many subnets, each associated with a routing table, in one pass (see base.bulk_resources)
 
-        self.template.add_resource(
-            SubnetRouteTableAssociation(
-                "SubnetRouteTableAssociation{}".format(name),
-                SubnetId=Ref(name),
-                RouteTableId=Ref(routing_table_name),
-            )
-        )
+        :param subnets: Spec table - a row per subnet, as a dict or as a tuple in SUBNET_COLUMNS order, of the
+                        arguments add_subnet takes
+        :param defaults: Values for columns a row leaves out, eg. routing_table_name='PublicRouting'
+        """
+        rows = spec_rows(subnets, SUBNET_COLUMNS, defaults, required=SUBNET_COLUMNS)
+        subnet_rows = []
+        association_rows = []
+        for row in rows:
+            vpc = row['vpc_name'] if isinstance(row['vpc_name'], Ref) else Ref(row['vpc_name'])
+            subnet_rows.append((row['name'], {
+                'AvailabilityZone': row['availability_zone'],
+                'CidrBlock': row['cidr_block'],
+                'VpcId': vpc,
+            }))
+            association_rows.append(("SubnetRouteTableAssociation{}".format(row['name']), {
+                'SubnetId': Ref(row['name']),
+                'RouteTableId': Ref(row['routing_table_name']),
+            }))
+
+        built = zip(build_objects(ec2.Subnet, subnet_rows),
+                    build_objects(ec2.SubnetRouteTableAssociation, association_rows))
+        add_objects(self.template, resources=[resource for pair in built for resource in pair])
 
     def add_internet_gateway(self, name, routing_table_name, vpc_name):
         """
@@ -56,20 +159,20 @@ class Vpc():
         :param vpc_name: Name of VPC
         """
         self.template.add_resource(
-            InternetGateway(
+            ec2.InternetGateway(
                 name,
             )
         )
 
         self.template.add_resource(
-            VPCGatewayAttachment(
+            ec2.VPCGatewayAttachment(
                 'AttachGateway',
                 VpcId=Ref(vpc_name),
                 InternetGatewayId=Ref(name))
         )
 
         self.template.add_resource(
-            Route(
+            ec2.Route(
                 "{}IGRoute".format(vpc_name),
                 DependsOn='AttachGateway',
                 GatewayId=Ref(name),
@@ -87,12 +190,12 @@ class Vpc():
         """
         eip_name = "{}ElasticIP".format(name)
 
-        self.template.add_resource(EIP(
+        self.template.add_resource(ec2.EIP(
             eip_name,
             Domain="vpc"
         ))
 
-        self.template.add_resource(NatGateway(
+        self.template.add_resource(ec2.NatGateway(
             name,
             AllocationId=GetAtt(eip_name, 'AllocationId'),
             SubnetId=subnet
@@ -106,7 +209,7 @@ class Vpc():
         :param vpc_name: VPC name
         """
         self.template.add_resource(
-            RouteTable(
+            ec2.RouteTable(
                 name,
                 VpcId=Ref(vpc_name),
             )
@@ -122,7 +225,7 @@ class Vpc():
         :param nat_gateway_id: ID of the NAT gateway
         """
         self.template.add_resource(
-            Route(
+            ec2.Route(
                 name,
                 DestinationCidrBlock=dest_cidr_block,
                 RouteTableId=route_table_id,